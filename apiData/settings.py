@@ -11,7 +11,7 @@ https://docs.djangoproject.com/en/4.1/ref/settings/
 """
 
 from pathlib import Path
-import os, dotenv
+import os, dotenv, tempfile
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -48,7 +48,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'productDetails.middleware.request_metrics_middleware',
+    'productDetails.middleware.invalidation_polling_middleware',
     'django.middleware.security.SecurityMiddleware',
+    'productDetails.middleware.primary_pinning_middleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -93,16 +96,60 @@ WSGI_APPLICATION = 'apiData.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 
+# SQLite connection profiles, picked with SQLITE_CONNECTION_PROFILE. The pragmas are applied to every new
+# connection by productDetails/database.py.
+#  - legacy: what Django does out of the box. Rollback journal, where writers block readers, and a new connection
+#    per request.
+#  - tuned: WAL, so readers never wait on the writer, NORMAL sync (durable across application crashes, and safe
+#    with WAL), a 256MB mmap and a 64MB page cache, and connections reused for 10 minutes.
+
+SQLITE_PROFILES = {
+    'legacy': {
+        'CONN_MAX_AGE': 0,
+        'PRAGMAS': {'journal_mode': 'DELETE'},
+    },
+    'tuned': {
+        'CONN_MAX_AGE': 600,
+        'PRAGMAS': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'mmap_size': 268435456,
+            'cache_size': -65536,
+            'busy_timeout': 5000,
+            'temp_store': 'MEMORY',
+        },
+    },
+}
+
+SQLITE_CONNECTION_PROFILE = os.environ.get('SQLITE_CONNECTION_PROFILE', 'tuned')
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', SQLITE_PROFILES[SQLITE_CONNECTION_PROFILE]['CONN_MAX_AGE'])),
+        'CONN_HEALTH_CHECKS': True,
         'TEST': {
             "NAME": BASE_DIR / "test.sqlite3"
         }
     }
 }
 
+# Read replicas: a comma separated list of SQLite files in DATABASE_REPLICAS, which become the database aliases
+# replica1, replica2... They're kept in sync with the primary by the replicate_database command. Catalog reads go
+# to a replica, or all reads do if REPLICA_READ_ALL=1, and a client that writes reads from the primary for the next
+# REPLICA_STICKY_SECONDS. See productDetails/routers.py.
+
+DATABASE_REPLICAS = []
+for index, replicaName in enumerate(filter(None, os.environ.get('DATABASE_REPLICAS', '').split(','))):
+    DATABASES['replica' + str(index + 1)] = dict(DATABASES['default'], NAME=replicaName, TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS.append('replica' + str(index + 1))
+
+REPLICA_READ_ALL = os.environ.get('REPLICA_READ_ALL') == '1'
+REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+
+DATABASE_ROUTERS = ['productDetails.routers.PrimaryReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -143,4 +190,39 @@ STATIC_URL = 'static/'
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
-DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
\ No newline at end of file
+DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Number of serialized catalog responses each worker keeps in productDetails' response cache.
+
+PRODUCT_RESPONSE_CACHE_SIZE = int(os.environ.get('PRODUCT_RESPONSE_CACHE_SIZE', 512))
+
+# Verified JWT payloads and email -> userID lookups cached per worker, and for how many seconds at most.
+
+JWT_CACHE_SIZE = int(os.environ.get('JWT_CACHE_SIZE', 4096))
+JWT_CACHE_TTL = int(os.environ.get('JWT_CACHE_TTL', 300))
+
+# Where the per-route request metrics served at /metrics are kept. Every worker of a deployment has to use the same
+# directory, and at most METRICS_MAX_WORKERS workers can run at once.
+
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'apiData-metrics'))
+METRICS_MAX_WORKERS = int(os.environ.get('METRICS_MAX_WORKERS', 64))
+
+# Answer the unpaginated product listings from an in-memory columnar copy of the catalog instead of SQL. Needs NumPy.
+# See productDetails/columnar.py.
+
+COLUMNAR_ENGINE = os.environ.get('COLUMNAR_ENGINE') == '1'
+
+# Identical listing requests that arrive together share one query and serialization, waiting up to
+# COALESCE_TIMEOUT seconds for it. COALESCE_ACROSS_WORKERS=wait or stale does the same across workers through lock
+# files in COALESCE_DIR, with "stale" sending the previous response instead of waiting. At most COALESCE_MAX_RESPONSES
+# listings' responses are kept there. See productDetails/coalescing.py.
+
+COALESCE_TIMEOUT = float(os.environ.get('COALESCE_TIMEOUT', 30))
+COALESCE_ACROSS_WORKERS = os.environ.get('COALESCE_ACROSS_WORKERS', '')
+COALESCE_DIR = os.environ.get('COALESCE_DIR', os.path.join(tempfile.gettempdir(), 'apiData-coalesce'))
+COALESCE_MAX_RESPONSES = int(os.environ.get('COALESCE_MAX_RESPONSES', 1000))
+
+# Every worker and management command on the machine shares write counters in INVALIDATION_DIR, which each worker
+# checks before every request to drop what other workers' writes have made stale. See productDetails/invalidation.py.
+
+INVALIDATION_DIR = os.environ.get('INVALIDATION_DIR', os.path.join(tempfile.gettempdir(), 'apiData-invalidation'))
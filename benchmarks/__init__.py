@@ -0,0 +1,5 @@
+""" Performance benchmarks for the productDetails API.
+
+Each benchmark is a module that can be run with `python -m benchmarks.<name>`. They run against a throwaway
+SQLite database configured in benchmarks/settings.py, never against db.sqlite3 or test.sqlite3.
+"""
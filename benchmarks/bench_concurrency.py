@@ -0,0 +1,158 @@
+""" Compare the sync views under gunicorn with the async views under uvicorn at increasing concurrency.
+
+    python -m benchmarks.bench_concurrency --concurrency 100 500 1000 --duration 10
+
+Both servers are started against the benchmark database with one worker per core. Each concurrency level opens
+that many client connections which send requests back to back for --duration seconds. The response cache is
+disabled by default (--cache to enable it) so every request reaches the database. Needs gunicorn and uvicorn
+installed; results are printed as JSON.
+"""
+
+import argparse, asyncio, json, os, signal, socket, subprocess, sys, time
+from .common import setupDjango, generateCatalog
+
+SERVERS = {
+    "sync-gunicorn": (["gunicorn", "apiData.wsgi:application", "--workers", "{workers}", "--threads", "4", "--bind", "127.0.0.1:{port}",
+                       "--backlog", "2048", "--log-level", "warning"], "/api/products/asc/price/type=Shirts"),
+    "async-uvicorn": ([sys.executable, "-m", "uvicorn", "apiData.asgi:application", "--workers", "{workers}", "--host", "127.0.0.1",
+                       "--port", "{port}", "--backlog", "2048", "--log-level", "warning"], "/api/async/products/asc/price/type=Shirts"),
+}
+
+
+def freePort():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def startServer(command, port, workers, cache):
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE="benchmarks.settings")
+    if not cache:
+        env["PRODUCT_RESPONSE_CACHE_SIZE"] = "0"
+    command = [part.format(port=port, workers=workers) for part in command]
+    server = subprocess.Popen(command, env=env, start_new_session=True)
+
+    # Wait for the server to accept connections.
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    stopServer(server)
+    raise SystemExit("Server didn't start: " + " ".join(command))
+
+
+def stopServer(server):
+    os.killpg(server.pid, signal.SIGTERM)
+    server.wait(timeout=30)
+
+
+async def fetch(connection, port, path, method="GET", body=b""):
+    """ Send one request over a (possibly new) keep-alive connection. Returns the status code and the connection
+    to reuse, or None.
+    """
+    if connection is None:
+        connection = await asyncio.open_connection("127.0.0.1", port)
+    reader, writer = connection
+    head = method + " " + path + " HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: keep-alive\r\n"
+    if body:
+        head += "Content-Type: text/plain\r\nContent-Length: " + str(len(body)) + "\r\n"
+    writer.write((head + "\r\n").encode() + body)
+    await writer.drain()
+
+    statusLine = await reader.readline()
+    if not statusLine.startswith(b"HTTP/1.1 "):
+        raise ConnectionError(statusLine.decode(errors="replace").strip() or "connection closed")
+    status = int(statusLine.split()[1])
+
+    length, keepAlive = None, True
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode().partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+        elif name.lower() == "connection" and value.strip().lower() == "close":
+            keepAlive = False
+
+    if length is None:
+        await reader.read()
+        keepAlive = False
+    else:
+        await reader.readexactly(length)
+
+    if not keepAlive:
+        writer.close()
+        return status, None
+    return status, connection
+
+
+async def client(port, path, until, latencies, errors):
+    connection = None
+    while time.perf_counter() < until:
+        start = time.perf_counter()
+        try:
+            status, connection = await fetch(connection, port, path)
+            if status != 200:
+                raise ConnectionError("HTTP " + str(status))
+            latencies.append(time.perf_counter() - start)
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError):
+            errors.append(1)
+            connection = None
+    if connection is not None:
+        connection[1].close()
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000 if values else None
+
+
+async def runLevel(port, path, concurrency, duration):
+    latencies, errors = [], []
+    start = time.perf_counter()
+    until = start + duration
+    await asyncio.gather(*[client(port, path, until, latencies, errors) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "throughput": round(len(latencies) / elapsed, 1),
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[100, 500, 1000])
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--servers", nargs="+", choices=list(SERVERS), default=list(SERVERS))
+    parser.add_argument("--cache", action="store_true", help="Leave the response cache enabled.")
+    args = parser.parse_args()
+
+    setupDjango()
+    generateCatalog(args.products)
+
+    results = {}
+    for name in args.servers:
+        command, path = SERVERS[name]
+        port = freePort()
+        server = startServer(command, port, args.workers, args.cache)
+        try:
+            results[name] = [asyncio.run(runLevel(port, path, concurrency, args.duration)) for concurrency in args.concurrency]
+        finally:
+            stopServer(server)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
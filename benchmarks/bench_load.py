@@ -0,0 +1,379 @@
+""" Replay a request mix over every route in productDetails/urls.py and report latency, throughput and queries.
+
+    python -m benchmarks.bench_load run --products 100000 --requests 5000 --output base.json
+    python -m benchmarks.bench_load run --server --concurrency 16 --requests 20000 --output new.json
+    python -m benchmarks.bench_load compare base.json new.json --threshold 0.1
+
+`run` builds a synthetic catalog, customers, watchlists and countries, then replays a request mix. The mix is
+either synthetic, drawn with a fixed seed from ROUTE_WEIGHTS (change a weight with --weight "Route Name=10"), or
+recorded: --mix reads a JSON lines file of {"method", "path", "body"} requests, the format --save-mix writes a
+synthetic mix in. Request paths are replayed as given, so a recorded mix should be replayed against the same
+--products, --customers and --seed it was recorded with.
+
+In-process, requests go through the test client one at a time and each request's queries are counted by the
+metrics middleware. With --server, --concurrency keep-alive connections send them to gunicorn, and queries per
+request come from the server's /metrics. The response cache is disabled unless --cache is given.
+
+The JSON report has p50/p95/p99 latency, throughput and queries per request, overall and for each route.
+`compare` prints the metrics that are worse in the second report by more than --threshold (a fraction of the
+first report's value) and exits with status 1 if there are any. Routes with fewer than --min-requests requests
+in either report are left out, as their percentiles are mostly noise.
+"""
+
+import argparse, asyncio, json, os, random, sys, tempfile, time
+from urllib.parse import quote, urlsplit
+from .common import setupDjango, generateCatalog, generateCustomers, generateWatchlists, generateCountries, productID, STYLES, DETAILS
+
+SORTS = ["asc", "asc", "desc"]
+SORT_FIELDS = ["price", "name", "prodID", "colour"]
+FILTERS = ["type=Shirts", "colour=Black&available=Yes", "price=10,49.99", "type=Jackets&new=Yes", "colour=Blue&type=Formal"]
+LIMITS = [20, 20, 50, 100]
+SEARCH_WORDS = [word.lower() for word in STYLES + DETAILS]
+
+# How often each route comes up in a synthetic mix. Routes not listed have a weight of 1.
+ROUTE_WEIGHTS = {
+    "Field Sorted Products Data": 20,
+    "Filtered And Field Sorted Products Data": 20,
+    "Detailed Product Data": 25,
+    "Searched Products Data": 8,
+    "Field Sorted Searched Products Data": 3,
+    "Filtered And Field Sorted Searched Products Data": 3,
+    "Filtered Product Facet Counts": 5,
+    "Get User Watchlist Products": 8,
+    "Add/Remove Product in Watchlist": 4,
+    "Store Customer Details": 2,
+    # The async listings aren't paginated, so they return the whole (filtered) catalog.
+    "Async Field Sorted Products Data": 0.2,
+    "Async Filtered And Field Sorted Products Data": 1,
+}
+
+LOWER_IS_BETTER = ("p50_ms", "p95_ms", "p99_ms", "queries_per_request")
+HIGHER_IS_BETTER = ("throughput",)
+
+
+class Workload:
+    """ What the synthetic requests are built from: the generated data and the secrets the views check. """
+
+    def __init__(self, rng, seed, products, emails):
+        self.rng = rng
+        self.seed = seed
+        self.products = products
+        self.emails = emails
+        self.secret = os.environ['JWT_SECRET']
+        self.accessID = os.environ['CUSTOMER_MODEL_URL_ACCESS']
+
+    def token(self, payload):
+        from jwt import encode
+        return encode(payload, self.secret, algorithm="HS256")
+
+    def product(self):
+        return productID(self.seed, self.rng.randrange(self.products))
+
+    def email(self):
+        return self.rng.choice(self.emails)
+
+    def listing(self, filtered=False):
+        path = self.rng.choice(SORTS) + "/" + self.rng.choice(SORT_FIELDS)
+        return path + "/" + quote(self.rng.choice(FILTERS), safe="=&,") if filtered else path
+
+    def search(self):
+        return quote(" ".join(self.rng.sample(SEARCH_WORDS, self.rng.choice([1, 1, 2]))))
+
+    def limit(self):
+        return "?limit=" + str(self.rng.choice(LIMITS))
+
+
+# Route name -> function building one (method, path, body) request for it.
+ROUTE_REQUESTS = {
+    "Home": lambda w: ("GET", "/", ""),
+    "Field Sorted Products Data": lambda w: ("GET", "/api/products/" + w.listing() + w.limit(), ""),
+    "Empty Field Sort Redirection": lambda w: ("GET", "/api/products/" + w.rng.choice(SORTS) + "/", ""),
+    "Empty Sort": lambda w: ("GET", "/api/products/", ""),
+    "Return From Empty Filter": lambda w: ("GET", "/api/products/" + w.listing() + "/", ""),
+    "Filtered And Field Sorted Products Data": lambda w: ("GET", "/api/products/" + w.listing(filtered=True) + w.limit(), ""),
+    "Detailed Product Data": lambda w: ("GET", "/api/product/" + w.product(), ""),
+    "Batch Detailed Products Data": lambda w: ("GET", "/api/product/batch/" + ",".join(w.product() for _ in range(w.rng.choice([5, 10, 30]))), ""),
+    "Searched Products Data": lambda w: ("GET", "/api/search/" + w.search(), ""),
+    "Field Sorted Searched Products Data": lambda w: ("GET", "/api/search/" + w.search() + "/" + w.listing() + w.limit(), ""),
+    "Filtered And Field Sorted Searched Products Data": lambda w: ("GET", "/api/search/" + w.search() + "/" + w.listing(filtered=True) + w.limit(), ""),
+    "Product Facet Counts": lambda w: ("GET", "/api/facets", ""),
+    "Filtered Product Facet Counts": lambda w: ("GET", "/api/facets/" + quote(w.rng.choice(FILTERS), safe="=&,"), ""),
+    "Name Ordered Countries List Data": lambda w: ("GET", "/api/countries", ""),
+    "Response Cache Stats": lambda w: ("GET", "/api/cache/stats", ""),
+    "Metrics": lambda w: ("GET", "/metrics", ""),
+    "Sync Customers": lambda w: ("POST", "/customers/" + w.accessID + "/sync",
+                                 w.token({"customers": [{"email": w.email(), "name": "Customer " + str(w.rng.randrange(10))} for _ in range(20)]})),
+    "Store Customer Details": lambda w: ("GET", "/customers/" + w.accessID + "/" + w.token({"email": w.email(), "name": "Customer " + str(w.rng.randrange(10))}), ""),
+    "Get User Watchlist Products": lambda w: ("GET", "/api/watchlist/" + w.token({"email": w.email()}) + "/get", ""),
+    "Get Paginated User Watchlist Products": lambda w: ("GET", "/api/watchlist/" + w.token({"email": w.email()}) + "/get/1", ""),
+    "Add/Remove Product in Watchlist": lambda w: ("GET", "/api/watchlist/" + w.token({"email": w.email(), "prodID": w.product(), "process": w.rng.choice(["add", "remove"])}), ""),
+    "Async Field Sorted Products Data": lambda w: ("GET", "/api/async/products/" + w.listing(), ""),
+    "Async Filtered And Field Sorted Products Data": lambda w: ("GET", "/api/async/products/" + w.listing(filtered=True), ""),
+    "Async Detailed Product Data": lambda w: ("GET", "/api/async/product/" + w.product(), ""),
+    "Async Name Ordered Countries List Data": lambda w: ("GET", "/api/async/countries", ""),
+    "Async Get User Watchlist Products": lambda w: ("GET", "/api/async/watchlist/" + w.token({"email": w.email()}) + "/get", ""),
+    "Async Add/Remove Product in Watchlist": lambda w: ("GET", "/api/async/watchlist/" + w.token({"email": w.email(), "prodID": w.product(), "process": w.rng.choice(["add", "remove"])}), ""),
+}
+
+
+def syntheticMix(workload, count, weights):
+    """ `count` requests over every route, as {"route", "method", "path", "body"} dicts. """
+    from productDetails.metrics import routeNames
+
+    missing = set(routeNames()) - set(ROUTE_REQUESTS)
+    if missing:
+        raise SystemExit("No synthetic requests for these routes, add them to ROUTE_REQUESTS: " + ", ".join(sorted(missing)))
+
+    routes = [route for route in routeNames() if weights.get(route, 1) > 0]
+    chosen = workload.rng.choices(routes, [weights.get(route, 1) for route in routes], k=count)
+    mix = []
+    for route in chosen:
+        method, path, body = ROUTE_REQUESTS[route](workload)
+        mix.append({"route": route, "method": method, "path": path, "body": body})
+    return mix
+
+
+def recordedMix(path):
+    """ Read a JSON lines request mix, naming each request's route from its path. """
+    from django.urls import Resolver404, resolve
+    from productDetails.metrics import OTHER_ROUTE
+
+    mix = []
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            try:
+                route = resolve(urlsplit(request["path"]).path).url_name or OTHER_ROUTE
+            except Resolver404:
+                route = OTHER_ROUTE
+            mix.append({"route": route, "method": request.get("method", "GET"), "path": request["path"], "body": request.get("body", "")})
+    return mix
+
+
+def runInProcess(mix):
+    """ Send the mix through the test client. Returns (route, seconds, queries, ok) per request and the elapsed time. """
+    from django.test.client import Client
+    from productDetails.metrics import currentRequestMetrics
+
+    client = Client()
+    samples = []
+    started = time.perf_counter()
+    for request in mix:
+        start = time.perf_counter()
+        response = client.generic(request["method"], request["path"], request["body"], content_type="text/plain")
+        if response.streaming:
+            b"".join(response.streaming_content)
+        elapsed = time.perf_counter() - start
+        samples.append((request["route"], elapsed, currentRequestMetrics.get().queries, response.status_code < 400))
+    return samples, time.perf_counter() - started
+
+
+async def replay(port, mix, concurrency):
+    from .bench_concurrency import fetch
+
+    samples = []
+    pending = iter(mix)
+
+    async def client():
+        connection = None
+        for request in pending:
+            start = time.perf_counter()
+            try:
+                status, connection = await fetch(connection, port, request["path"], request["method"], request["body"].encode())
+                samples.append((request["route"], time.perf_counter() - start, None, status < 400))
+            except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError):
+                samples.append((request["route"], time.perf_counter() - start, None, False))
+                connection = None
+        if connection is not None:
+            connection[1].close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return samples, time.perf_counter() - started
+
+
+def scrapeQueries(port):
+    """ Total (requests, queries) per route from the server's /metrics. """
+
+    async def scrape():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n")
+        body = (await reader.read()).partition(b"\r\n\r\n")[2].decode()
+        writer.close()
+        return body
+
+    totals = {}
+    for line in asyncio.run(scrape()).splitlines():
+        for metric, position in (("productdetails_request_duration_seconds_count{", 0), ("productdetails_db_queries_total{", 1)):
+            if line.startswith(metric):
+                labels, value = line[len(metric):].rsplit("} ", 1)
+                route = json.loads(labels.partition("=")[2])
+                totals.setdefault(route, [0, 0])[position] = float(value)
+    return totals
+
+
+def runAgainstServer(mix, concurrency, workers, cache):
+    from .bench_concurrency import freePort, startServer, stopServer
+
+    # A fresh metrics directory, so /metrics only counts this run.
+    os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="bench-load-metrics-")
+    command = ["gunicorn", "apiData.wsgi:application", "--workers", "{workers}", "--threads", "4", "--bind", "127.0.0.1:{port}",
+               "--backlog", "2048", "--log-level", "warning"]
+    port = freePort()
+    server = startServer(command, port, workers, cache)
+    try:
+        samples, elapsed = asyncio.run(replay(port, mix, concurrency))
+        queryTotals = scrapeQueries(port)
+    finally:
+        stopServer(server)
+
+    queries = {route: totals[1] / totals[0] for route, totals in queryTotals.items() if totals[0]}
+    return [(route, seconds, queries.get(route), ok) for route, seconds, _, ok in samples], elapsed
+
+
+def percentile(values, fraction):
+    return round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 3) if values else None
+
+
+def summarize(samples, elapsed=None):
+    latencies = sorted(seconds for _, seconds, _, _ in samples)
+    queries = [count for _, _, count, _ in samples if count is not None]
+    summary = {
+        "requests": len(samples),
+        "errors": sum(1 for _, _, _, ok in samples if not ok),
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+        "queries_per_request": round(sum(queries) / len(queries), 2) if queries else None,
+    }
+    if elapsed is not None:
+        summary["throughput"] = round(len(samples) / elapsed, 1)
+    return summary
+
+
+def report(samples, elapsed, args):
+    routes = {}
+    for sample in samples:
+        routes.setdefault(sample[0], []).append(sample)
+    return dict(
+        summarize(samples, elapsed),
+        mode="server" if args.server else "in-process",
+        products=args.products,
+        customers=args.customers,
+        routes={route: summarize(routeSamples) for route, routeSamples in sorted(routes.items())},
+    )
+
+
+def regressions(base, new, threshold, minRequests, metrics=LOWER_IS_BETTER + HIGHER_IS_BETTER):
+    """ The metrics worse in `new` than in `base` by more than `threshold`, as (scope, metric, base, new) tuples. """
+
+    scopes = [("overall", base, new)]
+    for route in sorted(set(base["routes"]) & set(new["routes"])):
+        if min(base["routes"][route]["requests"], new["routes"][route]["requests"]) >= minRequests:
+            scopes.append((route, base["routes"][route], new["routes"][route]))
+
+    found = []
+    for scope, before, after in scopes:
+        for metric in metrics:
+            if before.get(metric) is None or after.get(metric) is None:
+                continue
+            if metric in LOWER_IS_BETTER:
+                worse = after[metric] > before[metric] * (1 + threshold) if before[metric] else after[metric] > 0
+            else:
+                worse = after[metric] < before[metric] * (1 - threshold)
+            if worse:
+                found.append((scope, metric, before[metric], after[metric]))
+    return found
+
+
+def run(args):
+    if not args.cache:
+        os.environ["PRODUCT_RESPONSE_CACHE_SIZE"] = "0"
+    setupDjango()
+
+    generateCatalog(args.products, seed=args.seed)
+    emails = generateCustomers(args.customers, seed=args.seed)
+    generateWatchlists(args.watchlist_size, args.products, seed=args.seed)
+    generateCountries(args.countries)
+
+    weights = dict(ROUTE_WEIGHTS)
+    for weight in args.weight:
+        route, _, value = weight.rpartition("=")
+        weights[route] = float(value)
+
+    if args.mix:
+        mix = recordedMix(args.mix)
+    else:
+        mix = syntheticMix(Workload(random.Random(args.seed), args.seed, args.products, emails), args.requests, weights)
+    if args.save_mix:
+        with open(args.save_mix, "w") as file:
+            for request in mix:
+                file.write(json.dumps({"method": request["method"], "path": request["path"], "body": request["body"]}) + "\n")
+
+    if args.server:
+        from django.db import connections
+        connections.close_all()
+        samples, elapsed = runAgainstServer(mix, args.concurrency, args.workers, args.cache)
+    else:
+        samples, elapsed = runInProcess(mix)
+
+    output = json.dumps(report(samples, elapsed, args), indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    print(output)
+
+
+def compare(args):
+    with open(args.base) as file:
+        base = json.load(file)
+    with open(args.new) as file:
+        new = json.load(file)
+
+    found = regressions(base, new, args.threshold, args.min_requests, args.metrics)
+    print(json.dumps({"threshold": args.threshold, "regressions": [
+        {"scope": scope, "metric": metric, "base": before, "new": after} for scope, metric, before, after in found
+    ]}, indent=2))
+    if found:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    runParser = commands.add_parser("run", help="Generate data, replay a request mix and print the JSON report.")
+    runParser.add_argument("--products", type=int, default=10000, help="Catalog size, e.g. 1000 to 1000000.")
+    runParser.add_argument("--customers", type=int, default=1000)
+    runParser.add_argument("--watchlist-size", type=int, default=10, help="Products on each customer's watchlist.")
+    runParser.add_argument("--countries", type=int, default=200)
+    runParser.add_argument("--requests", type=int, default=2000, help="Size of the synthetic mix.")
+    runParser.add_argument("--seed", type=int, default=0)
+    runParser.add_argument("--weight", action="append", default=[], metavar="ROUTE=WEIGHT", help="Change a route's weight in the synthetic mix.")
+    runParser.add_argument("--mix", help="Replay this JSON lines file of requests instead of a synthetic mix.")
+    runParser.add_argument("--save-mix", help="Write the mix that's replayed to this file.")
+    runParser.add_argument("--server", action="store_true", help="Replay against gunicorn instead of in-process.")
+    runParser.add_argument("--concurrency", type=int, default=8)
+    runParser.add_argument("--workers", type=int, default=os.cpu_count())
+    runParser.add_argument("--cache", action="store_true", help="Leave the response cache enabled.")
+    runParser.add_argument("--output", help="Also write the report to this file.")
+
+    compareParser = commands.add_parser("compare", help="Fail if a report regressed from a baseline report.")
+    compareParser.add_argument("base")
+    compareParser.add_argument("new")
+    compareParser.add_argument("--threshold", type=float, default=0.1)
+    compareParser.add_argument("--min-requests", type=int, default=20)
+    compareParser.add_argument("--metrics", nargs="+", choices=LOWER_IS_BETTER + HIGHER_IS_BETTER, default=LOWER_IS_BETTER + HIGHER_IS_BETTER,
+                               help="Only compare these, e.g. just queries_per_request for a noise-free check.")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
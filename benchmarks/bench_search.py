@@ -0,0 +1,52 @@
+""" Time the search endpoint's queries at increasing catalog sizes.
+
+    python -m benchmarks.bench_search --sizes 10000 100000 1000000
+
+Each query is timed end to end through the serializer, the way SearchedProductView runs it, and the fastest of
+--repeat runs is reported along with the number of products the search matched.
+"""
+
+import argparse
+from .common import setupDjango, generateCatalog, timeit
+
+# (label, search text, sort field or None for BM25 ranking, filterData or None)
+QUERIES = [
+    ("rare word, ranked", "waterproof quilted", None, None),
+    ("common word, ranked", "shirts", None, None),
+    ("prefix, ranked", "linen bla", None, None),
+    ("sorted by price", "waterproof quilted", "price", None),
+    ("sorted and filtered", "waterproof", "price", "colour=Black&available=Yes"),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    setupDjango()
+    from productDetails.models import Product
+    from productDetails.filters import planFilter
+    from productDetails.search import SEARCH_DEFAULT_LIMIT, rankedSearch, searchProducts
+    from productDetails.serializers import fastListedProductsSerializer
+
+    print("%10s  %-22s %10s %10s" % ("products", "query", "matches", "ms"))
+    for size in args.sizes:
+        generateCatalog(size)
+        for label, text, field, filterData in QUERIES:
+            products = Product.objects.all()
+            if filterData is not None:
+                products = products.filter(planFilter(filterData).query)
+            if field is None:
+                products = rankedSearch(products, text)[0:SEARCH_DEFAULT_LIMIT]
+            else:
+                products = searchProducts(products, text).order_by(field)
+
+            elapsed, _ = timeit(lambda: fastListedProductsSerializer.encode(products), args.repeat)
+            matches = searchProducts(Product.objects.all(), text).count()
+            print("%10d  %-22s %10d %10.2f" % (size, label, matches, elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+""" Compare the DRF ModelSerializer path with the values_list fast path for product listings.
+
+    python -m benchmarks.bench_serialization --sizes 1000 10000 100000
+"""
+
+import argparse
+from .common import setupDjango, generateCatalog, timeit
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    setupDjango()
+    from django.http import JsonResponse
+    from productDetails.models import Product
+    from productDetails.serializers import ListedProductsSerializer, fastListedProductsSerializer
+
+    print("%10s %14s %14s %9s" % ("products", "drf (ms)", "fast (ms)", "speedup"))
+    for size in args.sizes:
+        generateCatalog(size)
+        products = Product.objects.order_by("price")
+
+        drfTime, drfContent = timeit(lambda: JsonResponse(ListedProductsSerializer(products, many=True).data, safe=False).content, args.repeat)
+        fastTime, fastContent = timeit(lambda: fastListedProductsSerializer.encode(products), args.repeat)
+        if drfContent != fastContent:
+            raise SystemExit("Fast path output differs from the DRF output at " + str(size) + " products.")
+
+        print("%10d %14.1f %14.1f %8.1fx" % (size, drfTime, fastTime, drfTime / fastTime))
+
+
+if __name__ == "__main__":
+    main()
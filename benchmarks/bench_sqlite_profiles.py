@@ -0,0 +1,124 @@
+""" Compare the SQLite connection profiles under a mixed read/write load.
+
+    python -m benchmarks.bench_sqlite_profiles --workers 4 --duration 10 --write-ratio 0.2
+
+For each profile in apiData/settings.py's SQLITE_PROFILES, --workers processes send requests to the views
+in-process for --duration seconds, like that many single-threaded server workers would. Reads are catalog
+listings, product details and watchlist reads. Writes are watchlist adds/removes and customer logins. The response
+cache is disabled so every request reaches the database. Requests that fail with "database is locked" are counted
+as lock errors. Results are printed as JSON.
+"""
+
+import argparse, json, multiprocessing, os, random, time
+
+READ_ROUTES = ("listing", "detail", "watchlist")
+
+
+def worker(profile, seed, duration, writeRatio, customers, products, results):
+    os.environ["SQLITE_CONNECTION_PROFILE"] = profile
+    os.environ["PRODUCT_RESPONSE_CACHE_SIZE"] = "0"
+    from .common import setupDjango
+    setupDjango(resetDatabase=False)
+
+    from django.db.utils import OperationalError
+    from django.test.client import Client
+    from jwt import encode
+
+    rng = random.Random(seed)
+    client = Client(raise_request_exception=True)
+    secret, accessID = os.environ['JWT_SECRET'], os.environ['CUSTOMER_MODEL_URL_ACCESS']
+
+    def token(payload):
+        return encode(payload, secret, algorithm="HS256")
+
+    latencies, lockErrors = [], 0
+    until = time.perf_counter() + duration
+    while time.perf_counter() < until:
+        email = rng.choice(customers)
+        if rng.random() < writeRatio:
+            if rng.random() < 0.9:
+                path = "/api/watchlist/" + token({"email": email, "prodID": rng.choice(products), "process": rng.choice(["add", "remove"])})
+            else:
+                path = "/customers/" + accessID + "/" + token({"email": email, "name": "Customer " + str(rng.randint(0, 9))})
+        else:
+            route = rng.choice(READ_ROUTES)
+            if route == "listing":
+                path = "/api/products/asc/price/type=Shirts?limit=20"
+            elif route == "detail":
+                path = "/api/product/" + rng.choice(products)
+            else:
+                path = "/api/watchlist/" + token({"email": email}) + "/get"
+
+        start = time.perf_counter()
+        try:
+            client.get(path)
+            latencies.append(time.perf_counter() - start)
+        except OperationalError as error:
+            if "locked" not in str(error):
+                raise
+            lockErrors += 1
+    results.put((latencies, lockErrors))
+
+
+def percentile(values, fraction):
+    return round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 2) if values else None
+
+
+def runProfile(profile, args, customers, products):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    workers = [context.Process(target=worker, args=(profile, seed, args.duration, args.write_ratio, customers, products, results))
+               for seed in range(args.workers)]
+    for process in workers:
+        process.start()
+    collected = [results.get() for _ in workers]
+    for process in workers:
+        process.join()
+
+    latencies = sorted(latency for workerLatencies, _ in collected for latency in workerLatencies)
+    lockErrors = sum(errors for _, errors in collected)
+    attempted = len(latencies) + lockErrors
+    return {
+        "profile": profile,
+        "requests": len(latencies),
+        "throughput": round(len(latencies) / args.duration, 1),
+        "lock_errors": lockErrors,
+        "lock_error_rate": round(lockErrors / attempted, 4) if attempted else 0,
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+    }
+
+
+def main():
+    from django.conf import settings
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=10000)
+    parser.add_argument("--customers", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    parser.add_argument("--profiles", nargs="+", default=None, help="Profiles to compare. Defaults to all of them.")
+    args = parser.parse_args()
+
+    from .common import setupDjango, generateCatalog
+    setupDjango()
+    from django.db import connections
+    from productDetails.models import Customer, Product
+
+    generateCatalog(args.products)
+    Customer.objects.bulk_create([Customer(userID="bench-" + str(i), name="Customer", email="customer" + str(i) + "@example.com")
+                                  for i in range(args.customers)])
+    customers = list(Customer.objects.values_list("email", flat=True))
+    products = list(Product.objects.values_list("prodID", flat=True))
+
+    # The workers switch the journal mode, which needs every other connection closed.
+    connections.close_all()
+
+    results = [runProfile(profile, args, customers, products) for profile in args.profiles or list(settings.SQLITE_PROFILES)]
+    print(json.dumps({"workers": args.workers, "write_ratio": args.write_ratio, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+""" Shared setup for the benchmarks: Django configuration, a fresh database and synthetic catalog data. """
+
+import os, random, time
+from uuid import UUID
+
+COLOURS = ["Black", "White", "Grey", "Red", "Blue", "Green", "Yellow", "Orange", "Brown", "Gold"]
+TYPES = ["Shirts", "Polo Shirts", "Formal", "Jackets", "Trousers"]
+# Words the synthetic names and descriptions are built from, so search benchmarks have realistic term frequencies.
+STYLES = ["Classic", "Slim", "Relaxed", "Luxury", "Vintage", "Linen", "Cotton", "Oxford", "Striped", "Checked",
+          "Casual", "Tailored", "Oversized", "Cropped", "Heritage", "Summer", "Winter", "Everyday", "Premium", "Essential"]
+DETAILS = ["breathable", "stretch", "organic", "recycled", "waterproof", "lightweight", "brushed", "woven", "knitted",
+           "washed", "pleated", "buttoned", "zipped", "hooded", "quilted", "padded", "ribbed", "embroidered"]
+
+
+def setupDjango(resetDatabase=True):
+    """ Configure Django with the benchmark settings, optionally starting from an empty, migrated database. """
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+
+    import django
+    from django.conf import settings
+    django.setup()
+
+    if resetDatabase:
+        name = str(settings.DATABASES['default']['NAME'])
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(name + suffix):
+                os.remove(name + suffix)
+
+        from django.core.management import call_command
+        call_command("migrate", verbosity=0)
+
+
+def productID(seed, i):
+    """ Deterministic UUID-shaped product IDs, so repeated runs build the same catalog. """
+    return str(UUID(int=(seed << 64) | i))
+
+
+def generateCatalog(size, seed=0, batchSize=2000):
+    """ Replace the catalog with `size` synthetic products. """
+    from productDetails.models import Product
+
+    Product.objects.all().delete()
+    rng = random.Random(seed)
+    for start in range(0, size, batchSize):
+        Product.objects.bulk_create([
+            syntheticProduct(rng, seed, i) for i in range(start, min(start + batchSize, size))
+        ])
+
+
+def generateCustomers(count, seed=0, batchSize=2000):
+    """ Replace the customers (and so the watchlists) with `count` synthetic customers. Returns their emails. """
+    from productDetails.models import Customer
+
+    Customer.objects.all().delete()
+    emails = ["customer" + str(i) + "@example.com" for i in range(count)]
+    for start in range(0, count, batchSize):
+        Customer.objects.bulk_create([
+            Customer(userID=str(UUID(int=(seed << 64) | (1 << 63) | i)), name="Customer " + str(i), email=emails[i])
+            for i in range(start, min(start + batchSize, count))
+        ])
+    return emails
+
+
+def generateWatchlists(perCustomer, catalogSize, seed=0, batchSize=2000):
+    """ Give every customer `perCustomer` random products from a catalog built by generateCatalog(catalogSize, seed). """
+    from productDetails.models import Customer, Watchlist
+
+    rng = random.Random(seed)
+    rows = []
+    for userID in Customer.objects.values_list("userID", flat=True).order_by("userID").iterator():
+        for i in rng.sample(range(catalogSize), min(perCustomer, catalogSize)):
+            rows.append(Watchlist(watchlist_referenceID=str(UUID(int=rng.getrandbits(128))), userID_id=userID, prodID_id=productID(seed, i)))
+        if len(rows) >= batchSize:
+            Watchlist.objects.bulk_create(rows)
+            rows = []
+    Watchlist.objects.bulk_create(rows)
+
+
+def generateCountries(count):
+    """ Replace the countries with `count` synthetic ones. """
+    from productDetails.models import Country
+
+    Country.objects.all().delete()
+    Country.objects.bulk_create([Country(countryID="C" + str(i), name="Country " + str(i)) for i in range(count)])
+
+
+def syntheticProduct(rng, seed, i):
+    from productDetails.models import Product
+
+    colour, type = rng.choice(COLOURS), rng.choice(TYPES)
+    return Product(prodID=productID(seed, i), name=" ".join([rng.choice(STYLES), colour, type, str(i)]),
+                   description="A " + ", ".join(rng.sample(DETAILS, 3)) + " " + type.lower() + " in " + colour.lower() + ".",
+                   price="%d.%02d" % (rng.randint(1, 99), rng.randint(0, 99)), colour=colour, type=type,
+                   available=rng.random() < 0.75, new=rng.random() < 0.3)
+
+
+def timeit(function, repeat):
+    """ Run `function` `repeat` times and return the fastest wall time in milliseconds with the last result. """
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
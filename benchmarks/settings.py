@@ -0,0 +1,16 @@
+""" Settings for the benchmarks: the project settings pointed at a throwaway database. """
+
+import os, tempfile
+
+os.environ.setdefault('DJANGO_SECRET_KEY', 'benchmark-secret-key')
+os.environ.setdefault('JWT_SECRET', 'benchmark-jwt-secret')
+os.environ.setdefault('CUSTOMER_MODEL_URL_ACCESS', 'benchmark-access')
+
+from apiData.settings import *
+
+ALLOWED_HOSTS = ['localhost', '127.0.0.1', 'testserver']
+
+DATABASES = {
+    'default': dict(DATABASES['default'], NAME=os.environ.get('BENCHMARK_DB', os.path.join(tempfile.gettempdir(), 'apiData-benchmark.sqlite3'))),
+}
+DATABASES['default'].pop('TEST')
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class ProductdetailsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'productDetails'
+
+    def ready(self):
+        # Register the cache invalidation signal handlers, the SQLite connection profile, the query timer and the
+        # search index check run after migrate.
+        from . import signals, database, metrics, search
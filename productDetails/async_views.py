@@ -0,0 +1,123 @@
+""" ASGI-native versions of the product, countries and watchlist endpoints.
+
+These mirror the views in views.py but run on the event loop, reading through Django's async ORM, so under an
+ASGI server (`uvicorn apiData.asgi:application --workers <cores>`) a request doesn't hold a thread from the
+sync-to-async pool while it waits on the database. They share the response cache, conditional GET handling,
+filter plans and serializers with the sync views and return the same bytes. Paginated listings reuse the sync
+keyset paginator through sync_to_async, and ?stream=1 isn't supported here.
+"""
+
+from django.http import HttpResponse, JsonResponse
+from asgiref.sync import sync_to_async
+from .models import Product, Country
+from .auth import decodeToken, auserIDForEmail
+from .cache import cachedResponse, listingTags, productTag, PRODUCT_DETAILS, COUNTRIES
+from .coalescing import coalescedResponse
+from .conditional import conditionalResponse, popularityScopes, PRODUCTS_SCOPE, COUNTRIES_SCOPE, WATCHLISTS_SCOPE, POPULARITY_SCOPE
+from .filters import FilterError, planFilter
+from .pagination import orderingKeys
+from .serializers import fastListedProductsSerializer, fastDetailedProductSerializer, fastListedCountriesSerializer
+from .watchlist import InvalidWatchlistOperations, applyWatchlistOperations, parseOperations, watchlistChangeResponse
+from .views import fieldSelection, invalidFieldsResponse, paginatedProductsResponse, userWatchlist, validateFieldEntered, validateSortType, watchlistEntry
+
+
+def jsonBytesResponse(content):
+    return HttpResponse(content, content_type="application/json")
+
+
+@cachedResponse("product", lambda kwargs: [productTag(kwargs['id']), PRODUCT_DETAILS])
+@conditionalResponse(PRODUCTS_SCOPE, POPULARITY_SCOPE)
+async def detailed_product(request, id):
+    """ Display the full product information for one product only. """
+
+    serializer = fieldSelection(request, fastDetailedProductSerializer)
+    if serializer is None:
+        return invalidFieldsResponse(fastDetailedProductSerializer)
+
+    product = Product.objects.filter(prodID=id)
+    return jsonBytesResponse(await serializer.aencode(product))
+
+
+@cachedResponse("products", listingTags)
+@conditionalResponse(PRODUCTS_SCOPE, extraScopes=popularityScopes)
+@coalescedResponse("products")
+async def field_sorted_products(request, sortType, field):
+    """ Display the list of products sorted upon the user's choice. """
+
+    # Check that all the data is valid.
+    if not (validateSortType(sortType) and validateFieldEntered(field, Product)):
+        return JsonResponse({}, safe=False)
+
+    return await sortedProductsResponse(request, Product.objects.all(), field, sortType)
+
+
+@cachedResponse("filtered-products", listingTags)
+@conditionalResponse(PRODUCTS_SCOPE, extraScopes=popularityScopes)
+@coalescedResponse("filtered-products")
+async def filtered_field_sorted_products(request, sortType, field, filterData):
+    """ Display the list of chosen, filtered products sorted upon the user's choice. """
+
+    # Check that all the data is valid.
+    if not (validateSortType(sortType) and validateFieldEntered(field, Product)) or filterData == "":
+        return JsonResponse({}, safe=False)
+
+    try:
+        filterPlan = planFilter(filterData)
+    except FilterError as error:
+        return JsonResponse(error.asDict(), status=400)
+
+    return await sortedProductsResponse(request, Product.objects.filter(filterPlan.query), field, sortType)
+
+
+async def sortedProductsResponse(request, products, field, sortType):
+    serializer = fieldSelection(request, fastListedProductsSerializer)
+    if serializer is None:
+        return invalidFieldsResponse(fastListedProductsSerializer)
+
+    # Opt-in cursor pagination when a page size is requested.
+    if "limit" in request.GET:
+        return await sync_to_async(paginatedProductsResponse)(request, products, field, sortType)
+
+    products = products.order_by(*orderingKeys(field))
+    if sortType == "desc":
+        products = products.reverse()
+    return jsonBytesResponse(await serializer.aencode(products))
+
+
+@cachedResponse("countries", lambda kwargs: [COUNTRIES])
+@conditionalResponse(COUNTRIES_SCOPE)
+async def countries_list(request):
+    """ Display the list of countries available. """
+
+    countries = Country.objects.all().order_by("name")
+    return jsonBytesResponse(await fastListedCountriesSerializer.aencode(countries))
+
+
+@conditionalResponse(PRODUCTS_SCOPE, WATCHLISTS_SCOPE, POPULARITY_SCOPE)
+async def get_watchlist_products(request, jwt):
+    """ Returns the list products that were starred by the user. """
+
+    userID = await auserIDForEmail(decodeToken(jwt)['email'])
+    if userID is None:
+        return JsonResponse({}, safe=False)
+
+    watchlist_data = [watchlistEntry(reference) async for reference in userWatchlist(userID)]
+    return JsonResponse(watchlist_data, safe=False)
+
+
+async def process_watchlist_change(request, jwt):
+    """ Adds or removes products from the user's watchlist, either one product or a batch of operations. """
+
+    decoded_data = decodeToken(jwt)
+    userID = await auserIDForEmail(decoded_data['email'])
+    if userID is None:
+        return JsonResponse({}, safe=False)
+
+    try:
+        operations = parseOperations(decoded_data)
+    except InvalidWatchlistOperations as error:
+        return JsonResponse({"error": str(error)}, status=400)
+
+    # The batch runs in a transaction, which has to stay on one thread.
+    results = await sync_to_async(applyWatchlistOperations)(userID, operations)
+    return watchlistChangeResponse(decoded_data, results)
@@ -0,0 +1,120 @@
+""" Cached JWT verification and customer lookups for the watchlist and customer endpoints.
+
+The frontend sends the same token many times per session, so verified payloads are kept in a bounded LRU cache
+until the sooner of their `exp` claim and a TTL. The email -> userID mapping every watchlist request needs is
+cached the same way and kept current by the Customer signal handlers in signals.py.
+"""
+
+from django.conf import settings
+from collections import OrderedDict
+from threading import Lock
+from jwt import decode
+from jwt.exceptions import ExpiredSignatureError
+import os, time
+from .models import Customer
+
+DEFAULT_CACHE_SIZE = 4096
+DEFAULT_CACHE_TTL = 300
+
+
+class ExpiringLRUCache:
+    """ Thread-safe LRU cache whose entries each carry their own expiry time. """
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, expires):
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+CACHE_SIZE = getattr(settings, "JWT_CACHE_SIZE", DEFAULT_CACHE_SIZE)
+CACHE_TTL = getattr(settings, "JWT_CACHE_TTL", DEFAULT_CACHE_TTL)
+
+tokenCache = ExpiringLRUCache(CACHE_SIZE)
+userIDCache = ExpiringLRUCache(CACHE_SIZE)
+
+
+def decodeToken(token):
+    """ Verify and decode an HS256 token, reusing the payload of a token that's already been verified.
+
+    Raises the same exceptions as jwt.decode(). A fresh copy of the payload is returned each time, so callers
+    can modify it.
+    """
+
+    secret = os.environ['JWT_SECRET']
+    key = (secret, token)
+    payload = tokenCache.get(key)
+    if payload is None:
+        payload = decode(token, secret, algorithms=['HS256'])
+
+        # Never keep a token past its own expiry, so an expired token is always re-verified and rejected.
+        expires = time.time() + CACHE_TTL
+        if "exp" in payload:
+            expires = min(expires, float(payload["exp"]))
+            if expires <= time.time():
+                raise ExpiredSignatureError("Signature has expired")
+        tokenCache.set(key, payload, expires)
+
+    return dict(payload)
+
+
+def userIDForEmail(email):
+    """ Return the userID of the customer with this email, or None if there isn't one. """
+
+    userID = userIDCache.get(email)
+    if userID is None:
+        userID = Customer.objects.filter(email=email).values_list("userID", flat=True)[0:1]
+        userID = userID[0] if userID else None
+
+        # Unknown emails aren't cached, so a customer created by another worker is found straight away.
+        if userID is not None:
+            rememberCustomer(email, userID)
+    return userID
+
+
+async def auserIDForEmail(email):
+    """ Async version of userIDForEmail() for the ASGI views. """
+
+    userID = userIDCache.get(email)
+    if userID is None:
+        userID = await Customer.objects.filter(email=email).values_list("userID", flat=True).afirst()
+        if userID is not None:
+            rememberCustomer(email, userID)
+    return userID
+
+
+def rememberCustomer(email, userID):
+    userIDCache.set(email, userID, time.time() + CACHE_TTL)
+
+
+def forgetCustomer(email):
+    userIDCache.delete(email)
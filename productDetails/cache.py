@@ -0,0 +1,200 @@
+""" In-process cache of serialized catalog responses.
+
+The catalog changes rarely compared to how often it's read, so the JSON bodies of the listing, detail and
+countries endpoints are kept in a size-bounded LRU cache. Every entry is tagged with what it was built from
+and the post_save/post_delete handlers in signals.py drop only the entries carrying the changed model's tags.
+Bulk queryset operations (update(), bulk_create()) don't send those signals, so code using them should call
+invalidateTags() itself. Other workers' writes drop every entry of the model written to (see invalidation.py).
+"""
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe
+from asyncio import iscoroutinefunction
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+from .filters import FilterError, planFilter
+
+DEFAULT_CACHE_SIZE = 512
+
+PRODUCT_LISTINGS = "product-listings"
+PRODUCT_DETAILS = "product-details"
+# Listings sorted by watchCount, which are also dropped when the counts change.
+POPULARITY_LISTINGS = "popularity-listings"
+COUNTRIES = "countries"
+
+VALIDATOR_HEADERS = ("ETag", "Last-Modified")
+
+
+def productTag(prodID):
+    """ Tag for entries built from a single product. """
+    return "product:" + str(prodID)
+
+
+class ResponseCache:
+    """ Thread-safe LRU cache of response bodies with tag-based invalidation and usage counters. """
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.taggedKeys = {}
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        # Bumped on every invalidation so responses computed before one aren't stored afterwards.
+        self.generation = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, content, tags, generation=None):
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (content, tags)
+            for tag in tags:
+                self.taggedKeys.setdefault(tag, set()).add(key)
+
+            while len(self.entries) > self.maxSize:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, *tags):
+        """ Drop every entry carrying any of the given tags. """
+        with self.lock:
+            self.generation += 1
+            for tag in tags:
+                for key in list(self.taggedKeys.get(tag, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.taggedKeys.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "maxSize": self.maxSize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+    def _remove(self, key):
+        content, tags = self.entries.pop(key)
+        for tag in tags:
+            keys = self.taggedKeys.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.taggedKeys[tag]
+
+
+responseCache = ResponseCache(getattr(settings, "PRODUCT_RESPONSE_CACHE_SIZE", DEFAULT_CACHE_SIZE))
+
+
+def invalidateTags(*tags):
+    responseCache.invalidate(*tags)
+
+
+def listingTags(kwargs):
+    """ Tags for a product listing's entry, given its URL parameters. """
+    if kwargs.get("field") == "watchCount":
+        return [PRODUCT_LISTINGS, POPULARITY_LISTINGS]
+    return [PRODUCT_LISTINGS]
+
+
+def normalizeFilterData(filterData):
+    """ Use the canonical form of a filter string so equivalent filters share an entry. """
+    try:
+        return planFilter(filterData).canonical
+    except FilterError:
+        return filterData
+
+
+def cacheKey(endpoint, kwargs, query):
+    """ Build the cache key from the endpoint, its URL parameters and the sorted query string. """
+    params = dict(kwargs)
+    if "filterData" in params:
+        params["filterData"] = normalizeFilterData(params["filterData"])
+    return (endpoint, tuple(sorted(params.items())), tuple(sorted((name, tuple(values)) for name, values in query.lists())))
+
+
+def cachedResponse(endpoint, tags):
+    """ Serve a view's successful JSON responses from the response cache.
+
+    `tags` is called with the view's URL parameters and returns the tags the entry should be invalidated by.
+    Cached entries keep the ETag/Last-Modified headers they were built with, so conditional requests that hit
+    the cache are answered without touching the database. Works on APIView methods and on async function views.
+    """
+
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def asyncWrapper(request, *args, **kwargs):
+                key = cacheKey(endpoint, kwargs, request.GET)
+                cached = cachedResponseFor(request, key)
+                if cached is not None:
+                    return cached
+
+                generation = responseCache.generation
+                return storeResponse(key, await view(request, *args, **kwargs), tags(kwargs), generation)
+            return asyncWrapper
+
+        @wraps(view)
+        def wrapper(self, request, *args, **kwargs):
+            key = cacheKey(endpoint, kwargs, request.GET)
+            cached = cachedResponseFor(request, key)
+            if cached is not None:
+                return cached
+
+            generation = responseCache.generation
+            return storeResponse(key, view(self, request, *args, **kwargs), tags(kwargs), generation)
+        return wrapper
+    return decorator
+
+
+def cachedResponseFor(request, key):
+    """ Rebuild a cached response, or a 304 if the request's validators match it. None on a cache miss. """
+    entry = responseCache.get(key)
+    if entry is None:
+        return None
+
+    content, headers = entry
+    response = HttpResponse(content, content_type="application/json")
+    for header, value in headers:
+        response[header] = value
+    return get_conditional_response(request, etag=response.get("ETag"), last_modified=lastModifiedTimestamp(response), response=response)
+
+
+def storeResponse(key, response, tags, generation):
+    if response.status_code == 200 and not response.streaming and not getattr(response, "stale", False):
+        headers = tuple((header, response[header]) for header in VALIDATOR_HEADERS if response.has_header(header))
+        responseCache.set(key, (response.content, headers), tags, generation)
+    return response
+
+
+def lastModifiedTimestamp(response):
+    lastModified = response.get("Last-Modified")
+    return parse_http_date_safe(lastModified) if lastModified else None
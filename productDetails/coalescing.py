@@ -0,0 +1,324 @@
+""" Single-flight coalescing of identical listing requests.
+
+When many clients ask for the same listing at once, e.g. right after an invalidation or on a freshly started
+worker, the response cache misses for all of them and each would run the same query and serialization. With
+coalescedResponse(), the first of them runs the view and the others, whether they're threads or asyncio tasks,
+wait for it and get a copy of its response. Requests are identical when they have the same endpoint, URL
+parameters, query string and catalog ETag, so a request is never answered from an older catalog version than the
+one conditionalResponse validated it against.
+
+COALESCE_ACROSS_WORKERS extends this to the other worker processes. A request that runs the view first takes a
+file lock in COALESCE_DIR for its listing, and leaves the response there for the other workers when it's done.
+With "wait", a worker that finds the lock taken waits for it and then uses the response it was waiting for. With
+"stale", it sends the last response left for that listing straight away, with that response's own ETag, and only
+waits if there isn't one. Stale responses aren't stored in the response cache.
+
+Listings are told apart across workers by their URL parameters and the query parameters the views read, so junk
+parameters don't make new files. Each listing keeps one response file, replaced when it's rebuilt, and the
+oldest are removed once there are more than COALESCE_MAX_RESPONSES. Locks are shared by hashing listings onto a
+fixed number of lock files.
+"""
+
+from django.conf import settings
+from django.http import HttpResponse
+from asgiref.sync import sync_to_async
+from asyncio import iscoroutinefunction
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from functools import wraps
+from threading import Lock
+from time import monotonic, sleep
+from .cache import cacheKey
+from .metrics import currentRequestMetrics
+import asyncio, fcntl, hashlib, json, os, tempfile
+
+# How long a request waits for another one's response before building its own.
+DEFAULT_COALESCE_TIMEOUT = 30
+
+WAIT = "wait"
+STALE = "stale"
+
+LOCK_POLL_INTERVAL = 0.005
+
+# The query parameters the coalesced views read. Others don't change the response.
+SHARED_PARAMETERS = ("limit", "cursor", "fields", "stream")
+
+DEFAULT_COALESCE_MAX_RESPONSES = 1000
+LOCK_STRIPES = 256
+
+
+class SingleFlight:
+    """ The requests in flight in this worker, with counters of how they were answered. """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.flights = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.fromWorkers = 0
+        self.stale = 0
+
+    def join(self, key):
+        """ Return the Future for a key's response and whether the caller is the one who has to build it. """
+        with self.lock:
+            future = self.flights.get(key)
+            if future is not None:
+                return future, False
+            future = self.flights[key] = Future()
+            self.leaders += 1
+            return future, True
+
+    def finish(self, key, future, entry):
+        """ Hand the leader's response, or None if it can't be shared, to the requests waiting on it. """
+        with self.lock:
+            del self.flights[key]
+        future.set_result(entry)
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+        metrics = currentRequestMetrics.get()
+        if metrics is not None:
+            metrics.coalesced += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "inFlight": len(self.flights),
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "fromWorkers": self.fromWorkers,
+                "stale": self.stale,
+            }
+
+
+singleFlight = SingleFlight()
+
+
+def coalesceTimeout():
+    return getattr(settings, "COALESCE_TIMEOUT", DEFAULT_COALESCE_TIMEOUT)
+
+
+def flightKey(endpoint, kwargs, request):
+    return (cacheKey(endpoint, kwargs, request.GET), getattr(request, "catalogETag", None))
+
+
+def shareableEntry(response, etag):
+    """ What followers need to rebuild a response: (status, content type, content, ETag), or None if it's streamed. """
+    if response.streaming or getattr(response, "stale", False):
+        return None
+    return (response.status_code, response["Content-Type"], response.content, etag)
+
+
+def responseFromEntry(entry, stale=False):
+    status, contentType, content, etag = entry
+    response = HttpResponse(content, status=status, content_type=contentType)
+    if stale:
+        # Sent with the ETag it was built for, which conditionalResponse leaves in place, and kept out of the cache.
+        response.stale = True
+        if etag is not None:
+            response["ETag"] = etag
+    return response
+
+
+def sharedKey(key):
+    """ A flight key without the query parameters the views ignore. """
+    (endpoint, params, query), etag = key
+    return (endpoint, params, tuple(item for item in query if item[0] in SHARED_PARAMETERS)), etag
+
+
+class SharedResponses:
+    """ The cross-worker locks and last response of each listing, as files in COALESCE_DIR. """
+
+    def __init__(self, directory, maxResponses=DEFAULT_COALESCE_MAX_RESPONSES):
+        self.directory = directory
+        self.maxResponses = maxResponses
+
+    def paths(self, key):
+        # One response per listing, whatever catalog version it was built for, and a lock shared with other listings.
+        digest = hashlib.sha1(repr(sharedKey(key)[0]).encode()).hexdigest()
+        lockName = "stripe-" + str(int(digest[0:8], 16) % LOCK_STRIPES) + ".lock"
+        return os.path.join(self.directory, lockName), os.path.join(self.directory, digest + ".response")
+
+    def read(self, key):
+        """ The last response left for a key's listing as (fresh, entry), or None. """
+        try:
+            with open(self.paths(key)[1], "rb") as file:
+                header, content = file.read().split(b"\n", 1)
+        except (OSError, ValueError):
+            return None
+        storedKey, status, contentType, etag = json.loads(header)
+        return storedKey == repr(sharedKey(key)), (status, contentType, content, etag)
+
+    def write(self, key, entry):
+        status, contentType, content, etag = entry
+        path = self.paths(key)[1]
+        with tempfile.NamedTemporaryFile("wb", dir=self.directory, suffix=".tmp", delete=False) as file:
+            file.write(json.dumps([repr(sharedKey(key)), status, contentType, etag]).encode() + b"\n" + content)
+        os.replace(file.name, path)
+        self.evict()
+
+    def evict(self):
+        """ Remove the least recently written responses beyond maxResponses. """
+        with os.scandir(self.directory) as entries:
+            responses = [(entry.stat().st_mtime, entry.path) for entry in entries if entry.name.endswith(".response")]
+        if len(responses) <= self.maxResponses:
+            return
+        responses.sort()
+        for _, path in responses[0:len(responses) - self.maxResponses]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def open(self, key):
+        os.makedirs(self.directory, exist_ok=True)
+        return open(self.paths(key)[0], "a+b")
+
+    def tryLock(self, lockFile):
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def waitForLock(self, lockFile, timeout):
+        """ Wait up to `timeout` seconds for the worker holding the lock to finish. """
+        deadline = monotonic() + timeout
+        while not self.tryLock(lockFile):
+            if monotonic() >= deadline:
+                return False
+            sleep(LOCK_POLL_INTERVAL)
+        return True
+
+    def beforeBuilding(self, key, lockFile):
+        """ Take the listing's lock, or find a response to send instead. Returns (response, locked). """
+
+        shared = self.read(key)
+        if shared is not None and shared[0]:
+            singleFlight.count("fromWorkers")
+            return responseFromEntry(shared[1]), False
+        if self.tryLock(lockFile):
+            return None, True
+
+        if workersMode() == STALE and shared is not None:
+            singleFlight.count("stale")
+            return responseFromEntry(shared[1], stale=True), False
+        locked = self.waitForLock(lockFile, coalesceTimeout())
+        shared = self.read(key)
+        if shared is not None and shared[0]:
+            singleFlight.count("fromWorkers")
+            return responseFromEntry(shared[1]), locked
+        return None, locked
+
+    def afterBuilding(self, key, response):
+        entry = shareableEntry(response, key[1])
+        if entry is not None:
+            self.write(key, entry)
+
+
+def workersMode():
+    return getattr(settings, "COALESCE_ACROSS_WORKERS", "")
+
+
+def sharedResponses():
+    if workersMode() not in (WAIT, STALE):
+        return None
+    return SharedResponses(getattr(settings, "COALESCE_DIR", os.path.join(tempfile.gettempdir(), "apiData-coalesce")),
+                           getattr(settings, "COALESCE_MAX_RESPONSES", DEFAULT_COALESCE_MAX_RESPONSES))
+
+
+def buildAcrossWorkers(key, build):
+    """ Run build() for a key, letting only one worker at a time build the same listing when that's turned on. """
+
+    shared = sharedResponses()
+    if shared is None:
+        return build()
+
+    with shared.open(key) as lockFile:
+        response, locked = shared.beforeBuilding(key, lockFile)
+        if response is not None:
+            return response
+        response = build()
+        if locked:
+            shared.afterBuilding(key, response)
+        return response
+
+
+async def abuildAcrossWorkers(key, build):
+    """ Async version of buildAcrossWorkers(), doing the file work off the event loop. """
+
+    shared = sharedResponses()
+    if shared is None:
+        return await build()
+
+    lockFile = await sync_to_async(shared.open, thread_sensitive=False)(key)
+    try:
+        response, locked = await sync_to_async(shared.beforeBuilding, thread_sensitive=False)(key, lockFile)
+        if response is not None:
+            return response
+        response = await build()
+        if locked:
+            await sync_to_async(shared.afterBuilding, thread_sensitive=False)(key, response)
+        return response
+    finally:
+        lockFile.close()
+
+
+def coalescedResponse(endpoint):
+    """ Share one run of a view between identical concurrent requests. Goes under conditionalResponse.
+
+    Works on APIView methods and on async function views, like cachedResponse(). A request only waits for a
+    response it can reuse; if the one it waited for was streamed, or took longer than COALESCE_TIMEOUT, it runs
+    the view itself.
+    """
+
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def asyncWrapper(request, *args, **kwargs):
+                key = flightKey(endpoint, kwargs, request)
+                build = lambda: view(request, *args, **kwargs)
+                future, leader = singleFlight.join(key)
+                if not leader:
+                    try:
+                        entry = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), coalesceTimeout())
+                    except asyncio.TimeoutError:
+                        entry = None
+                    if entry is not None:
+                        singleFlight.count("coalesced")
+                        return responseFromEntry(entry)
+                    return await abuildAcrossWorkers(key, build)
+
+                entry = None
+                try:
+                    response = await abuildAcrossWorkers(key, build)
+                    entry = shareableEntry(response, key[1])
+                    return response
+                finally:
+                    singleFlight.finish(key, future, entry)
+            return asyncWrapper
+
+        @wraps(view)
+        def wrapper(self, request, *args, **kwargs):
+            key = flightKey(endpoint, kwargs, request)
+            build = lambda: view(self, request, *args, **kwargs)
+            future, leader = singleFlight.join(key)
+            if not leader:
+                try:
+                    entry = future.result(coalesceTimeout())
+                except FutureTimeoutError:
+                    entry = None
+                if entry is not None:
+                    singleFlight.count("coalesced")
+                    return responseFromEntry(entry)
+                return buildAcrossWorkers(key, build)
+
+            entry = None
+            try:
+                response = buildAcrossWorkers(key, build)
+                entry = shareableEntry(response, key[1])
+                return response
+            finally:
+                singleFlight.finish(key, future, entry)
+        return wrapper
+    return decorator
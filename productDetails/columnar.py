@@ -0,0 +1,243 @@
+""" Optional in-memory columnar index of the catalog, answering the unpaginated product listings without a query.
+
+When COLUMNAR_ENGINE is set and NumPy is installed, each worker loads every product into column arrays the first
+time a listing needs them: prices as a float64 array, available and new as boolean masks, and colour and type
+dictionary encoded as integer codes. Each product's listing JSON is encoded once at the same time. A filter then
+becomes a mask over the columns, the sort is a permutation of the rows by (field, prodID) that's built the first
+time the field is sorted on, and the response is the selected rows' JSON joined together, which is byte for byte
+what fastListedProductsSerializer.encode() returns for the same query.
+
+Product saves and deletes are applied to the columns once they commit (see signals.py), and the orderings are
+rebuilt the next time they're used. Bulk writes that skip the signals should call markStale(). Writes made by other
+workers mark it stale too (see invalidation.py). Watch count changes only touch the watchCount column, through
+refreshCounts() and markCountsStale().
+"""
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, transaction
+from threading import Lock
+from .filters import YES_NO
+from .metrics import timedSerialization
+from .models import Product
+from .serializers import fastListedProductsSerializer
+import json
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Loaded in this order, which is also the order of Product's fields.
+COLUMNS = ("prodID", "name", "description", "price", "colour", "type", "available", "new", "watchCount")
+
+# Sorted with NumPy. The other columns are free text and sorted as Python strings, which order the same way as
+# SQLite's default BINARY collation.
+NUMERIC_COLUMNS = ("price", "available", "new", "watchCount")
+ENCODED_COLUMNS = ("colour", "type")
+
+
+class ColumnarProducts:
+    """ The catalog as column arrays, with the listing JSON of each row and its orderings. """
+
+    def __init__(self, serializer=fastListedProductsSerializer):
+        self.serializer = serializer
+        self.lock = Lock()
+        self.loaded = False
+
+    def load(self):
+        """ Read the whole catalog into columns. Called with self.lock held. """
+
+        values, rows = self.fetch(Product.objects.all())
+        columns = list(zip(*values)) or [()] * len(COLUMNS)
+        self.prodIDs = list(columns[0])
+        self.text = {"prodID": self.prodIDs, "name": list(columns[1]), "description": list(columns[2])}
+        self.price = numpy.array(columns[3], dtype=numpy.float64)
+        self.available = numpy.array(columns[6], dtype=bool)
+        self.new = numpy.array(columns[7], dtype=bool)
+        self.watchCount = numpy.array(columns[8], dtype=numpy.int64)
+        self.vocabularies, self.codes = {}, {}
+        for name, column in zip(ENCODED_COLUMNS, (columns[4], columns[5])):
+            self.vocabularies[name] = {}
+            self.codes[name] = numpy.array([self.encode(name, value) for value in column], dtype=numpy.int64)
+        self.alive = numpy.ones(len(self.prodIDs), dtype=bool)
+
+        self.rowIndexes = {prodID: index for index, prodID in enumerate(self.prodIDs)}
+        self.rows = rows
+        self.encoded = [json.dumps(row, cls=DjangoJSONEncoder) for row in rows]
+        self.orderings = {}
+        self.countsStale = False
+        self.loaded = True
+
+    def fetch(self, products):
+        """ The column values and listing rows of some products, ordered by prodID and read in one transaction. """
+
+        products = products.order_by("prodID")
+        with transaction.atomic(using=products.db):
+            # The raw driver values, so prices compare exactly as they do in SQL.
+            sql, params = products.values_list(*COLUMNS).query.sql_with_params()
+            with connections[products.db].cursor() as cursor:
+                cursor.execute(sql, params)
+                values = cursor.fetchall()
+            return values, self.serializer.rows(products)
+
+    def encode(self, name, value):
+        """ The code of a colour or type, adding it to the vocabulary if it's new. """
+        vocabulary = self.vocabularies[name]
+        if value not in vocabulary:
+            vocabulary[value] = len(vocabulary)
+        return vocabulary[value]
+
+    def markStale(self):
+        """ Reload everything on next use, e.g. after a bulk write that didn't send any signals. """
+        with self.lock:
+            self.loaded = False
+
+    def markCountsStale(self):
+        """ Re-read the watchCount column the next time a listing is sorted by it. """
+        with self.lock:
+            self.countsStale = True
+
+    def refreshCounts(self, prodIDs):
+        """ Re-read the watch counts of the given products. """
+        with self.lock:
+            if self.loaded:
+                self.updateCounts(Product.objects.filter(prodID__in=prodIDs))
+
+    def updateCounts(self, products):
+        """ Copy the products' watch counts into the column. Called with self.lock held. """
+        for prodID, watchCount in products.values_list("prodID", "watchCount"):
+            index = self.rowIndexes.get(prodID)
+            if index is not None:
+                self.watchCount[index] = watchCount
+        self.orderings.pop("watchCount", None)
+
+    def refresh(self, prodIDs):
+        """ Re-read the given products, adding, updating or removing their rows. """
+
+        with self.lock:
+            if not self.loaded:
+                return
+
+            values, rows = self.fetch(Product.objects.filter(prodID__in=prodIDs))
+            values = {row[0]: row for row in values}
+            rows = {row["prodID"]: row for row in rows}
+
+            for prodID in prodIDs:
+                index = self.rowIndexes.get(prodID)
+                if prodID not in values:
+                    if index is not None:
+                        self.alive[index] = False
+                    continue
+
+                if index is None:
+                    index = self.appendRow(prodID)
+                _, name, description, price, colour, type, available, new, watchCount = values[prodID]
+                self.text["name"][index], self.text["description"][index] = name, description
+                self.price[index] = float(price)
+                self.available[index], self.new[index] = available, new
+                self.watchCount[index] = watchCount
+                self.codes["colour"][index] = self.encode("colour", colour)
+                self.codes["type"][index] = self.encode("type", type)
+                self.alive[index] = True
+                self.rows[index] = rows[prodID]
+                self.encoded[index] = json.dumps(rows[prodID], cls=DjangoJSONEncoder)
+
+            self.orderings = {}
+
+    def appendRow(self, prodID):
+        index = len(self.prodIDs)
+        self.rowIndexes[prodID] = index
+        self.prodIDs.append(prodID)
+        self.text["name"].append(None)
+        self.text["description"].append(None)
+        self.rows.append(None)
+        self.encoded.append(None)
+        self.price = numpy.append(self.price, 0.0)
+        self.available = numpy.append(self.available, False)
+        self.new = numpy.append(self.new, False)
+        self.watchCount = numpy.append(self.watchCount, 0)
+        self.alive = numpy.append(self.alive, False)
+        for name in ENCODED_COLUMNS:
+            self.codes[name] = numpy.append(self.codes[name], 0)
+        return index
+
+    def ordering(self, field):
+        """ Row indexes sorted by (field, prodID), built on first use. """
+
+        if field in self.orderings:
+            return self.orderings[field]
+
+        prodIDs = self.prodIDs
+        if field in NUMERIC_COLUMNS or field in ENCODED_COLUMNS:
+            prodIDRanks = numpy.empty(len(prodIDs), dtype=numpy.int64)
+            prodIDRanks[sorted(range(len(prodIDs)), key=prodIDs.__getitem__)] = numpy.arange(len(prodIDs))
+            if field in ENCODED_COLUMNS:
+                # Codes are numbered in the order values were first seen, so sort by each value's rank instead.
+                vocabulary = sorted(self.vocabularies[field], key=self.vocabularies[field].__getitem__)
+                ranks = numpy.empty(len(vocabulary), dtype=numpy.int64)
+                ranks[sorted(range(len(vocabulary)), key=vocabulary.__getitem__)] = numpy.arange(len(vocabulary))
+                keys = ranks[self.codes[field]] if len(vocabulary) else self.codes[field]
+            else:
+                keys = getattr(self, field)
+            order = numpy.lexsort((prodIDRanks, keys))
+        else:
+            column = self.text[field]
+            order = numpy.array(sorted(range(len(prodIDs)), key=lambda index: (column[index], prodIDs[index])), dtype=numpy.int64)
+
+        self.orderings[field] = order
+        return order
+
+    def mask(self, canonical):
+        """ The rows matching a canonical filter string (see filters.py). """
+
+        mask = self.alive.copy()
+        if not canonical:
+            return mask
+        for clause in canonical.split("&"):
+            name, _, value = clause.partition("=")
+            if name == "price":
+                minPrice, maxPrice = value.split(",")
+                mask &= (self.price >= float(minPrice)) & (self.price <= float(maxPrice))
+            elif name in ENCODED_COLUMNS:
+                codes = [self.vocabularies[name][option] for option in value.split("|") if option in self.vocabularies[name]]
+                mask &= numpy.isin(self.codes[name], codes)
+            else:
+                column = getattr(self, name)
+                mask &= column if YES_NO[value.lower()] else ~column
+        return mask
+
+    def listing(self, field, sortType, serializer, canonical=""):
+        """ The JSON body of a listing, or None if it can't be answered from the columns. """
+
+        if field not in COLUMNS or not set(serializer.names) <= set(self.serializer.names):
+            return None
+
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            elif self.countsStale and field == "watchCount":
+                self.updateCounts(Product.objects.all())
+                self.countsStale = False
+            order = self.ordering(field)
+            selected = order[self.mask(canonical)[order]]
+            if sortType == "desc":
+                selected = selected[::-1]
+            selected = selected.tolist()
+
+            with timedSerialization():
+                if serializer.names == self.serializer.names:
+                    encoded = self.encoded
+                    return ("[" + ", ".join([encoded[index] for index in selected]) + "]").encode()
+                rows, names = self.rows, serializer.names
+                return json.dumps([{name: rows[index][name] for name in names} for index in selected], cls=DjangoJSONEncoder).encode()
+
+
+productColumns = ColumnarProducts()
+
+
+def columnarEngine():
+    """ The worker's columnar index, or None if it's turned off or NumPy isn't installed. """
+    if numpy is None or not getattr(settings, "COLUMNAR_ENGINE", False):
+        return None
+    return productColumns
@@ -0,0 +1,113 @@
+""" Conditional GET support (ETag / Last-Modified) for the read endpoints.
+
+Each part of the catalog has a CatalogVersion row that's bumped whenever one of its models is written to (see
+signals.py). A response's ETag is built from the versions of the scopes it depends on and its Last-Modified is
+the latest of their write times, so both can be checked against If-None-Match/If-Modified-Since with a single
+primary key lookup and a 304 is returned before any queryset or serializer work happens.
+"""
+
+from django.db import router
+from django.db.models import F
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from asyncio import iscoroutinefunction
+from calendar import timegm
+from functools import wraps
+from .models import CatalogVersion, Watchlist
+
+PRODUCTS_SCOPE = "products"
+COUNTRIES_SCOPE = "countries"
+WATCHLISTS_SCOPE = "watchlists"
+
+# Bumped when products' watch counts change, which only matters to the responses that show or sort by them.
+POPULARITY_SCOPE = "popularity"
+
+
+def bumpCatalogVersion(*scopes):
+    """ Mark the given scopes as changed. Runs inside the caller's transaction when there is one. """
+    now = timezone.now()
+    updated = CatalogVersion.objects.filter(scope__in=scopes).update(version=F("version") + 1, modified=now)
+    if updated < len(set(scopes)):
+        for scope in scopes:
+            CatalogVersion.objects.get_or_create(scope=scope, defaults={"version": 1, "modified": now})
+
+
+def popularityScopes(kwargs):
+    """ The extra scope of a listing sorted by watchCount, for conditionalResponse(extraScopes=...). """
+    return [POPULARITY_SCOPE] if kwargs.get("field") == "watchCount" else []
+
+
+def versionRows(scopes):
+    versions = CatalogVersion.objects.all()
+    if WATCHLISTS_SCOPE in scopes:
+        # Watchlist responses are read wherever the watchlist rows are, which is usually the primary.
+        versions = versions.using(router.db_for_read(Watchlist))
+    return versions.filter(scope__in=scopes).values_list("scope", "version", "modified")
+
+
+def catalogValidators(scopes):
+    """ Return the (ETag, Last-Modified timestamp) pair for a set of scopes using one query. """
+    return validatorsFromRows(scopes, versionRows(scopes))
+
+
+async def acatalogValidators(scopes):
+    """ Async version of catalogValidators() for the ASGI views. """
+    return validatorsFromRows(scopes, [row async for row in versionRows(scopes)])
+
+
+def validatorsFromRows(scopes, rows):
+    versions = dict((row[0], row[1:]) for row in rows)
+    etag = '"' + ".".join(scope[0] + str(versions[scope][0] if scope in versions else 0) for scope in scopes) + '"'
+    modified = [versions[scope][1] for scope in scopes if scope in versions]
+    lastModified = timegm(max(modified).utctimetuple()) if modified else None
+    return etag, lastModified
+
+
+def setValidatorHeaders(response, etag, lastModified):
+    response["ETag"] = etag
+    if lastModified is not None:
+        response["Last-Modified"] = http_date(lastModified)
+    return response
+
+
+def conditionalResponse(*scopes, extraScopes=None):
+    """ Answer If-None-Match/If-Modified-Since with a 304 and tag successful responses with validators.
+
+    Last-Modified only has one second resolution, so clients should prefer the ETag, which changes on every write.
+    The view can read the request's ETag from request.catalogETag. `extraScopes`, if given, is called with the
+    view's URL parameters and returns any scopes that only some of its responses depend on.
+    """
+
+    def requestScopes(kwargs):
+        return scopes + tuple(extraScopes(kwargs)) if extraScopes is not None else scopes
+
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def asyncWrapper(request, *args, **kwargs):
+                etag, lastModified = await acatalogValidators(requestScopes(kwargs))
+                request.catalogETag = etag
+                notModified = get_conditional_response(request, etag=etag, last_modified=lastModified)
+                if notModified is not None:
+                    return notModified
+                return withValidators(await view(request, *args, **kwargs), etag, lastModified)
+            return asyncWrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            etag, lastModified = catalogValidators(requestScopes(kwargs))
+            request.catalogETag = etag
+            notModified = get_conditional_response(request, etag=etag, last_modified=lastModified)
+            if notModified is not None:
+                return notModified
+            return withValidators(view(request, *args, **kwargs), etag, lastModified)
+        return wrapper
+    return decorator
+
+
+def withValidators(response, etag, lastModified):
+    # A response that already has an ETag was built for another catalog version (see coalescing.py) and keeps it.
+    if 200 <= response.status_code < 300 and not response.has_header("ETag"):
+        setValidatorHeaders(response, etag, lastModified)
+    return response
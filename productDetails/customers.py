@@ -0,0 +1,116 @@
+""" Customer upserts keyed on email, for logins and the identity service's bulk sync.
+
+A login is a single INSERT ... ON CONFLICT(email) DO UPDATE statement that only writes when the name has
+changed. A bulk sync diffs its batch against the stored customers with one query and then upserts the new and
+changed records with executemany(), all in one transaction. Neither path goes through Model.save(), so the
+email -> userID cache and the watchlist version are updated here instead of by the signals in signals.py.
+"""
+
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import connection, connections, router, transaction
+from uuid import uuid4
+from .models import Customer
+from .auth import rememberCustomer
+from .conditional import bumpCatalogVersion, WATCHLISTS_SCOPE
+from .invalidation import publishChange
+from .database import lockForWrite
+
+MAX_CUSTOMER_BATCH = 1000
+
+
+class InvalidCustomerRecords(ValueError):
+    """ Raised when a customer record or batch can't be upserted. """
+
+
+def parseCustomer(record):
+    """ Return the (email, name) pair from a customer record, checking them against the model's limits. """
+
+    if not isinstance(record, dict) or not isinstance(record.get("email"), str) or not isinstance(record.get("name"), str):
+        raise InvalidCustomerRecords("Each customer needs an email and a name.")
+    email, name = record["email"], record["name"]
+    try:
+        validate_email(email)
+    except ValidationError:
+        raise InvalidCustomerRecords("'" + email + "' isn't a valid email address.")
+    if name == "" or len(name) > Customer._meta.get_field("name").max_length:
+        raise InvalidCustomerRecords("The name for " + email + " must be 1 to " + str(Customer._meta.get_field("name").max_length) + " characters.")
+    return email, name
+
+
+def parseCustomerBatch(decodedData):
+    customers = decodedData.get("customers")
+    if not isinstance(customers, list) or len(customers) == 0:
+        raise InvalidCustomerRecords("customers must be a non-empty list.")
+    if len(customers) > MAX_CUSTOMER_BATCH:
+        raise InvalidCustomerRecords("At most " + str(MAX_CUSTOMER_BATCH) + " customers can be sent at once.")
+    return [parseCustomer(record) for record in customers]
+
+
+def upsertSQL(returning=False):
+    """ Insert a customer, or rename the existing customer with that email if the name is different. """
+
+    quote = connection.ops.quote_name
+    table = quote(Customer._meta.db_table)
+    userID, name, email = [quote(Customer._meta.get_field(field).column) for field in ("userID", "name", "email")]
+    return ("INSERT INTO " + table + " (" + userID + ", " + name + ", " + email + ") VALUES (%s, %s, %s)"
+            + " ON CONFLICT(" + email + ") DO UPDATE SET " + name + " = excluded." + name
+            + " WHERE " + table + "." + name + " <> excluded." + name
+            + (" RETURNING " + userID if returning else ""))
+
+
+def upsertCustomer(email, name):
+    """ Create or rename the customer with this email in one statement. """
+
+    newUserID = str(uuid4())
+    with transaction.atomic():
+        with connections[router.db_for_write(Customer)].cursor() as cursor:
+            cursor.execute(upsertSQL(returning=True), [newUserID, name, email])
+            row = cursor.fetchone()
+
+        # No row comes back when the customer already exists with this name, so nothing was written.
+        if row is not None:
+            userID = row[0]
+            transaction.on_commit(lambda: rememberCustomer(email, userID))
+            publishChange(Customer)
+            if userID == newUserID:
+                bumpCatalogVersion(WATCHLISTS_SCOPE)
+
+
+def upsertCustomers(customers):
+    """ Upsert a batch of (email, name) pairs in one transaction. The last record for an email wins.
+
+    Returns the counts of inserted, updated and unchanged customers, and the userID of every email in the batch.
+    """
+
+    names = dict(customers)
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+    userIDs = {}
+    changed = []
+
+    with transaction.atomic():
+        lockForWrite(Customer)
+        existing = {email: (userID, name) for email, userID, name in Customer.objects.filter(email__in=list(names)).values_list("email", "userID", "name")}
+        for email, name in names.items():
+            if email not in existing:
+                userIDs[email] = str(uuid4())
+                counts["inserted"] += 1
+                changed.append((userIDs[email], name, email))
+                continue
+
+            userIDs[email] = existing[email][0]
+            if existing[email][1] != name:
+                counts["updated"] += 1
+                changed.append((userIDs[email], name, email))
+            else:
+                counts["unchanged"] += 1
+
+        if changed:
+            with connections[router.db_for_write(Customer)].cursor() as cursor:
+                cursor.executemany(upsertSQL(), changed)
+            publishChange(Customer)
+        if counts["inserted"]:
+            bumpCatalogVersion(WATCHLISTS_SCOPE)
+        transaction.on_commit(lambda: [rememberCustomer(email, userID) for email, userID in userIDs.items()])
+
+    return counts, userIDs
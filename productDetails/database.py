@@ -0,0 +1,76 @@
+""" SQLite connection handling: the connection profile from settings (SQLITE_PROFILES) is applied to every new
+connection, lockForWrite() lets a read-then-write transaction wait for the write lock instead of failing, and
+replicateDatabase() copies the primary over a read replica.
+"""
+
+from django.conf import settings
+from django.db import connections, router
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from .invalidation import publishEverything
+
+# The primary's state when each replica was last copied to, so workers are only told when it has been written to.
+replicatedStates = {}
+
+
+def connectionPragmas():
+    return settings.SQLITE_PROFILES[settings.SQLITE_CONNECTION_PROFILE]['PRAGMAS']
+
+
+@receiver(connection_created)
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+
+    with connection.cursor() as cursor:
+        for name, value in connectionPragmas().items():
+            cursor.execute("PRAGMA " + name + " = " + str(value))
+
+
+def lockForWrite(model):
+    """ Take SQLite's write lock at the start of the current transaction, waiting for it up to busy_timeout.
+
+    Django starts transactions with a plain BEGIN, so a transaction that reads before it writes only asks for the
+    write lock at its first write. In WAL mode that fails straight away, without waiting, if another connection
+    committed in the meantime, because the transaction's snapshot is out of date. Writing nothing to the model's
+    table as the first statement takes the lock up front instead. Must be called inside transaction.atomic().
+    """
+
+    db = router.db_for_write(model)
+    if connections[db].vendor != "sqlite":
+        return
+    table = connections[db].ops.quote_name(model._meta.db_table)
+    with connections[db].cursor() as cursor:
+        cursor.execute("UPDATE " + table + " SET rowid = rowid WHERE 0")
+
+
+def replicateDatabase(replica, primary="default", pagesPerStep=-1):
+    """ Copy the primary over a replica with SQLite's online backup API, which takes a consistent snapshot of the
+    primary without blocking its writers for more than `pagesPerStep` pages at a time (-1 copies everything at once).
+
+    The replica's readers wait on busy_timeout while its pages are replaced and then see the whole new snapshot.
+    Responses and columns built from the old snapshot are then dropped in every worker, unless the primary hasn't
+    been written to since the last copy.
+    """
+
+    source, target = connections[primary], connections[replica]
+    if source.vendor != "sqlite" or target.vendor != "sqlite":
+        raise ValueError("Replication copies SQLite files; use the database's own replication for " + source.vendor + ".")
+    if str(source.settings_dict['NAME']) == str(target.settings_dict['NAME']):
+        raise ValueError("'" + replica + "' is the same database as '" + primary + "'.")
+
+    # A connection can't be backed up while it's writing, so backup() would retry forever.
+    if source.in_atomic_block:
+        raise ValueError("The primary can't be replicated from inside one of its transactions.")
+
+    source.ensure_connection()
+    target.ensure_connection()
+    # data_version changes when other connections commit to the primary, total_changes when this one does.
+    with source.cursor() as cursor:
+        cursor.execute("PRAGMA data_version")
+        state = (id(source.connection), cursor.fetchone()[0], source.connection.total_changes)
+    source.connection.backup(target.connection, pages=pagesPerStep)
+
+    if replicatedStates.get(replica) != state:
+        replicatedStates[replica] = state
+        publishEverything()
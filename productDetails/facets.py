@@ -0,0 +1,60 @@
+""" Facet counts for the storefront sidebar.
+
+The counts for every facet come from one grouped query: products are grouped on colour, type, available, new
+and a price bucket, which gives at most a few hundred rows however large the catalog is, and each facet is then
+summed from those rows. Facet values are given the way the filter syntax spells them, so the sidebar can turn a
+count straight into a filter clause, and price buckets are given as min,max ranges.
+"""
+
+from django.conf import settings
+from django.db.models import Case, Count, IntegerField, Value, When
+from decimal import Decimal
+from .models import Product
+
+# Upper bounds of the price buckets. Products priced above the last bound share a final bucket.
+DEFAULT_PRICE_BUCKETS = ("10", "20", "50", "100")
+PRICE_BUCKETS = [Decimal(bound) for bound in getattr(settings, "FACET_PRICE_BUCKETS", DEFAULT_PRICE_BUCKETS)]
+
+FACET_NAMES = ("colour", "type", "available", "new")
+
+
+def priceBucketRanges():
+    """ The inclusive min,max range of each bucket, in the form the price filter takes. """
+
+    priceField = Product._meta.get_field("price")
+    step = Decimal(1).scaleb(-priceField.decimal_places)
+    highest = Decimal(10) ** (priceField.max_digits - priceField.decimal_places) - step
+    lowerBounds = [Decimal(0)] + PRICE_BUCKETS
+    upperBounds = [bound - step for bound in PRICE_BUCKETS] + [highest]
+    return [format(lower.normalize(), "f") + "," + format(upper.normalize(), "f") for lower, upper in zip(lowerBounds, upperBounds)]
+
+
+PRICE_RANGES = priceBucketRanges()
+
+
+def priceBucket():
+    return Case(*[When(price__lt=bound, then=Value(index)) for index, bound in enumerate(PRICE_BUCKETS)],
+                default=Value(len(PRICE_BUCKETS)), output_field=IntegerField())
+
+
+def facetCounts(products):
+    """ Count the products in a queryset per colour, type, available, new and price bucket with one query. """
+
+    groups = (products.order_by().annotate(bucket=priceBucket()).values(*FACET_NAMES, "bucket")
+              .annotate(count=Count("*")).values_list(*FACET_NAMES, "bucket", "count"))
+
+    facets = {name: {} for name in FACET_NAMES}
+    priceCounts = [0] * len(PRICE_RANGES)
+    total = 0
+    for *values, bucket, count in groups:
+        for name, value in zip(FACET_NAMES, values):
+            if isinstance(value, bool):
+                value = "Yes" if value else "No"
+            facets[name][value] = facets[name].get(value, 0) + count
+        priceCounts[bucket] += count
+        total += count
+
+    facets = {name: dict(sorted(counts.items())) for name, counts in facets.items()}
+    facets["price"] = [{"range": priceRange, "count": count} for priceRange, count in zip(PRICE_RANGES, priceCounts)]
+    facets["count"] = total
+    return facets
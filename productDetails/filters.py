@@ -0,0 +1,135 @@
+""" Parser and compiler for the filterData path segment of the filtered product listing.
+
+A filter string is made of `&` separated clauses such as `type=Shirts&colour=black|white&price=5,20&new=Yes`.
+It's parsed into a canonical form (fixed clause order, sorted and title-cased colours, lower-case names) and
+compiled into a single Q expression. Plans are memoized, both by the raw string and by the canonical form, so
+equivalent filter URLs share one plan and one response cache key.
+"""
+
+from django.db.models import Q
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+
+PLAN_CACHE_SIZE = 1024
+
+# The order clauses appear in within the canonical form.
+FILTER_NAMES = ("type", "colour", "price", "available", "new")
+YES_NO = {"yes": True, "no": False}
+
+# Bounds on price filters, which keep canonical filter strings (and the cache keys made from them) short.
+MAX_PRICE_DIGITS = 10
+MAX_PRICE_DECIMAL_PLACES = 6
+
+FilterPlan = namedtuple("FilterPlan", ["canonical", "query"])
+
+
+class FilterError(ValueError):
+    """ Raised when a filter string can't be parsed. Carries the offending clause for the 400 response. """
+
+    def __init__(self, message, clause=None):
+        super().__init__(message)
+        self.message = message
+        self.clause = clause
+
+    def asDict(self):
+        return {"error": "Invalid filter.", "detail": self.message, "clause": self.clause}
+
+
+def parsePrice(clause, value):
+    try:
+        minPrice, maxPrice = value.split(",")
+        minPrice, maxPrice = Decimal(minPrice), Decimal(maxPrice)
+    except (ValueError, InvalidOperation):
+        raise FilterError("price must be given as min,max.", clause)
+    if not (minPrice.is_finite() and maxPrice.is_finite()) or minPrice > maxPrice:
+        raise FilterError("price range is invalid.", clause)
+    return formatPriceBound(clause, minPrice) + "," + formatPriceBound(clause, maxPrice)
+
+
+def formatPriceBound(clause, price):
+    # Checked before formatting, as a bound like 1e999999 would otherwise become a million character string.
+    if price != 0 and price.adjusted() >= MAX_PRICE_DIGITS:
+        raise FilterError("price bounds can have at most " + str(MAX_PRICE_DIGITS) + " digits before the decimal point.", clause)
+    price = price.normalize()
+    if price.as_tuple().exponent < -MAX_PRICE_DECIMAL_PLACES:
+        raise FilterError("price bounds can have at most " + str(MAX_PRICE_DECIMAL_PLACES) + " decimal places.", clause)
+    return format(price, "f")
+
+
+def parseYesNo(clause, name, value):
+    if value.lower() not in YES_NO:
+        raise FilterError(name + " must be Yes or No.", clause)
+    return value.title()
+
+
+def canonicalFilter(filterData):
+    """ Validate a filter string and return its canonical form. """
+
+    clauses = {}
+    colours = set()
+
+    for clause in filterData.split("&"):
+        # A trailing or doubled & leaves empty clauses, which are ignored.
+        if clause == "":
+            continue
+
+        name, separator, value = clause.partition("=")
+        name = name.lower()
+        if separator == "" or value == "":
+            raise FilterError("Filters must be given as name=value.", clause)
+        if name not in FILTER_NAMES:
+            raise FilterError("Unknown filter '" + name + "'.", clause)
+
+        if name == "colour":
+            coloursList = [colour.title() for colour in value.split("|")]
+            if "" in coloursList:
+                raise FilterError("colour contains an empty value.", clause)
+            colours.update(coloursList)
+            continue
+
+        if name in clauses:
+            raise FilterError(name + " can only be filtered on once.", clause)
+
+        if name == "price":
+            clauses[name] = parsePrice(clause, value)
+        elif name in ("available", "new"):
+            clauses[name] = parseYesNo(clause, name, value)
+        else:
+            clauses[name] = value
+
+    if colours:
+        clauses["colour"] = "|".join(sorted(colours))
+    if not clauses:
+        raise FilterError("No filters were given.")
+
+    return "&".join(name + "=" + clauses[name] for name in FILTER_NAMES if name in clauses)
+
+
+@lru_cache(maxsize=PLAN_CACHE_SIZE)
+def compileCanonicalFilter(canonical):
+    """ Compile an already canonical filter string into one Q expression. """
+
+    query = Q()
+    for clause in canonical.split("&"):
+        name, _, value = clause.partition("=")
+        if name == "price":
+            minPrice, maxPrice = value.split(",")
+            query &= Q(price__gte=minPrice, price__lte=maxPrice)
+        elif name == "colour":
+            colourQuery = Q()
+            for colour in value.split("|"):
+                colourQuery |= Q(colour=colour)
+            query &= colourQuery
+        elif name in ("available", "new"):
+            query &= Q(**{name: YES_NO[value.lower()]})
+        else:
+            query &= Q(**{name: value})
+
+    return FilterPlan(canonical, query)
+
+
+@lru_cache(maxsize=PLAN_CACHE_SIZE)
+def planFilter(filterData):
+    """ Return the compiled FilterPlan for a raw filter string, raising FilterError if it's malformed. """
+    return compileCanonicalFilter(canonicalFilter(filterData))
@@ -0,0 +1,121 @@
+""" Cross-worker invalidation of the caches each worker process keeps.
+
+post_save and post_delete only fire in the process that wrote, so on their own the response cache, the columnar
+index and the email -> userID cache of every other worker would keep serving what they had. To tell them, each
+write to Product, Country, Customer or Watchlist also bumps that model's generation, a counter in a
+memory-mapped file in INVALIDATION_DIR that every worker (and management command) on the machine shares. Changes
+to products' watch counts are published on their own, as WATCH_COUNTS, so they don't drop everything cached from
+the catalog. Before
+each request, invalidation_polling_middleware compares the counters with the ones the worker last saw and runs
+the handlers registered for the models that changed. A request that starts after a write has been published is
+never answered from what its worker cached before the write.
+
+Generations are bumped once the write commits, so a worker can't re-cache the old rows after it's been told.
+"""
+
+from django.conf import settings
+from django.db import transaction
+from threading import Lock
+import fcntl, hashlib, mmap, os, tempfile
+
+# The models whose writes are published, by label, and the watch counts, which are published separately.
+WATCH_COUNTS = "productDetails.product.watchcount"
+MODELS = ("productDetails.product", "productDetails.country", "productDetails.customer", "productDetails.watchlist", WATCH_COUNTS)
+
+
+class GenerationCounters:
+    """ One write counter per model, in a file shared by every process that opens it. """
+
+    def __init__(self, directory, models=MODELS):
+        self.models = list(models)
+        self.indexes = {label: index for index, label in enumerate(self.models)}
+
+        layout = repr(self.models).encode()
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "generations-" + hashlib.sha1(layout).hexdigest()[0:12] + ".bin")
+
+        size = len(self.models) * 8
+        with open(self.path, "a+b") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                if os.fstat(file.fileno()).st_size < size:
+                    file.truncate(size)
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+            self.mmap = mmap.mmap(file.fileno(), size)
+        self.values = memoryview(self.mmap).cast("q")
+
+        self.lock = Lock()
+        self.seen = self.values.tolist()
+
+    def bump(self, label):
+        """ Add one to a model's generation. This process has already dropped what it cached, so it won't be told. """
+
+        index = self.indexes[label]
+        with open(self.path, "r+b") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                generation = self.values[index] + 1
+                self.values[index] = generation
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+        with self.lock:
+            # Only skip the bump if nobody else's came in since this process last looked.
+            if self.seen[index] == generation - 1:
+                self.seen[index] = generation
+
+    def changed(self):
+        """ The models written to by other processes since the last call. """
+
+        if self.values.tolist() == self.seen:
+            return []
+        with self.lock:
+            current = self.values.tolist()
+            changed = [label for label, seen, generation in zip(self.models, self.seen, current) if seen != generation]
+            self.seen = current
+        return changed
+
+
+handlers = {label: [] for label in MODELS}
+
+
+def modelLabel(model):
+    """ A model's label, or the label itself for WATCH_COUNTS. """
+    return model if isinstance(model, str) else model._meta.label_lower
+
+
+def onRemoteChange(model, handler):
+    """ Call handler() in this process whenever another process writes to the model. """
+    handlers[modelLabel(model)].append(handler)
+
+
+def publishChange(*models):
+    """ Tell every other process that the models have been written to, once the current transaction commits. """
+    labels = [modelLabel(model) for model in models]
+    transaction.on_commit(lambda: [generationCounters().bump(label) for label in labels])
+
+
+def publishEverything():
+    """ Drop what every process, this one included, cached from any model, e.g. after a replica has been refreshed. """
+    for label in MODELS:
+        for handler in handlers[label]:
+            handler()
+    publishChange(*MODELS)
+
+
+def pollChanges():
+    """ Run the handlers of every model another process has written to since the last poll. """
+    for label in generationCounters().changed():
+        for handler in handlers[label]:
+            handler()
+
+
+_generationCounters = None
+
+
+def generationCounters():
+    global _generationCounters
+    if _generationCounters is None:
+        _generationCounters = GenerationCounters(getattr(settings, "INVALIDATION_DIR", os.path.join(tempfile.gettempdir(), "apiData-invalidation")))
+    return _generationCounters
@@ -0,0 +1,113 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from productDetails import urls
+from productDetails.cache import responseCache
+from productDetails.models import Product, Customer
+from jwt import encode
+import os
+
+# Query strings to request each route with on top of the plain URL, to cover the optional code paths.
+ROUTE_QUERY_VARIANTS = {
+    "Field Sorted Products Data": ["limit=20"],
+    "Filtered And Field Sorted Products Data": ["limit=20"],
+    "Field Sorted Searched Products Data": ["limit=20"],
+    "Filtered And Field Sorted Searched Products Data": ["limit=20"],
+}
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Runs EXPLAIN QUERY PLAN for the queries behind every productDetails route and flags full table scans."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--field", default="price", help="Sort field to request the listings with.")
+        parser.add_argument("--filter", default="type=Shirts&colour=Black|White&price=5,20&available=Yes", help="filterData to request the filtered listing with.")
+        parser.add_argument("--query", default="black shirt", help="Text to request the search routes with.")
+        parser.add_argument("--fail-on-scan", action="store_true", help="Exit with an error if any full table scan is found.")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError("EXPLAIN QUERY PLAN auditing is only supported on SQLite.")
+
+        scans = 0
+        try:
+            # Routes that write are run too, so everything happens in a transaction that's rolled back at the end.
+            with transaction.atomic():
+                sampleKwargs = self.sampleKwargs(options)
+                for pattern in urls.urlpatterns:
+                    scans += self.explainRoute(pattern, sampleKwargs)
+                raise Rollback()
+        except Rollback:
+            pass
+
+        if scans:
+            message = str(scans) + " full table scan(s) found."
+            if options["fail_on_scan"]:
+                raise CommandError(message)
+            self.stdout.write(self.style.WARNING(message))
+        else:
+            self.stdout.write(self.style.SUCCESS("No full table scans found."))
+
+    def sampleKwargs(self, options):
+        """ Values for every URL parameter used in productDetails/urls.py, built from the current data. """
+        products = list(Product.objects.order_by("prodID").values_list("prodID", flat=True)[0:3])
+        customer = Customer.objects.order_by("userID").first()
+        prodID = products[0] if products else "missing-product"
+        email = customer.email if customer else "missing@example.com"
+        name = customer.name if customer else "Missing Customer"
+
+        token = encode({"email": email, "name": name, "prodID": prodID, "process": "add"}, os.environ['JWT_SECRET'], algorithm="HS256")
+        return {
+            "sortType": "asc",
+            "field": options["field"],
+            "filterData": options["filter"],
+            "query": options["query"],
+            "id": prodID,
+            "ids": ",".join(products + ["missing-product"]),
+            "accessID": os.environ.get('CUSTOMER_MODEL_URL_ACCESS', ""),
+            "jwt": token,
+            "page": 1,
+        }
+
+    def explainRoute(self, pattern, sampleKwargs):
+        """ Request one route, then explain each query it ran. Returns how many full table scans were found. """
+        parameters = pattern.pattern.converters.keys()
+        url = reverse(pattern.name, kwargs={parameter: sampleKwargs[parameter] for parameter in parameters})
+
+        scans = 0
+        for query in [""] + ROUTE_QUERY_VARIANTS.get(pattern.name, []):
+            requestURL = url + ("?" + query if query else "")
+            self.stdout.write(self.style.MIGRATE_HEADING(pattern.name + ": " + requestURL))
+
+            # Start from a cold response cache so the route's queries actually run.
+            responseCache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                Client(HTTP_HOST="localhost", raise_request_exception=False).get(requestURL)
+
+            for captured in queries.captured_queries:
+                if captured["sql"].lstrip().upper().startswith("SELECT"):
+                    scans += self.explainQuery(captured["sql"])
+        return scans
+
+    def explainQuery(self, sql):
+        # Captured SQL has its parameters interpolated already, so it can be explained as-is.
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql)
+            plan = [row[-1] for row in cursor.fetchall()]
+
+        # A SCAN that doesn't go through an index reads every row of the table. Virtual tables (the FTS5 search
+        # index) report a SCAN of their own index, which only visits the matching rows.
+        scans = [step for step in plan if step.startswith("SCAN ") and " USING " not in step and " VIRTUAL TABLE " not in step]
+        self.stdout.write("  " + sql)
+        for step in plan:
+            if step in scans:
+                self.stdout.write(self.style.ERROR("    " + step + "  <-- full table scan"))
+            else:
+                self.stdout.write("    " + step)
+        return len(scans)
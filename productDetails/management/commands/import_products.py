@@ -0,0 +1,175 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models.expressions import RawSQL
+from productDetails.cache import PRODUCT_DETAILS, PRODUCT_LISTINGS
+from productDetails.columnar import productColumns
+from productDetails.conditional import bumpCatalogVersion, PRODUCTS_SCOPE
+from productDetails.invalidation import publishChange
+from productDetails.models import Product
+from productDetails.signals import invalidateNowAndOnCommit
+from decimal import Decimal, InvalidOperation
+import csv, time
+
+# Column order of the catalog feed, as in data.csv.
+COLUMNS = ("prodID", "name", "description", "price", "colour", "type", "available", "new")
+
+BOOLEAN_VALUES = {"1": True, "0": False, "true": True, "false": False, "yes": True, "no": False}
+SEEN_TABLE = "import_products_seen"
+
+
+class InvalidRow(ValueError):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Upserts products from a CSV feed (prodID, name, description, price, colour, type, available, new) in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV file to import, e.g. data.csv.")
+        parser.add_argument("--batch-size", type=int, default=5000, help="Rows upserted per transaction.")
+        parser.add_argument("--dry-run", action="store_true", help="Report what would change without writing anything.")
+        parser.add_argument("--delete-missing", action="store_true", help="Delete products that aren't in the feed.")
+        parser.add_argument("--strict", action="store_true", help="Stop at the first invalid row instead of skipping it.")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError("import_products uses SQLite temporary tables and only supports SQLite.")
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be at least 1.")
+
+        self.fieldLimits = {field.name: field for field in Product._meta.concrete_fields}
+        self.counts = {"inserted": 0, "updated": 0, "unchanged": 0, "removed": 0, "missing": 0, "invalid": 0}
+        self.dryRun = options["dry_run"]
+        start = time.perf_counter()
+
+        # Every prodID in the feed is recorded in a temporary table, so working out which products are missing
+        # from it doesn't need the whole feed in memory.
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS temp." + SEEN_TABLE)
+            cursor.execute("CREATE TEMP TABLE " + SEEN_TABLE + " (prodID TEXT PRIMARY KEY)")
+
+        try:
+            with open(options["path"], newline="", encoding="utf-8") as feed:
+                batch = {}
+                for lineNumber, row in enumerate(csv.reader(feed), start=1):
+                    if lineNumber == 1 and row and row[0] == "prodID":
+                        continue
+                    try:
+                        product = self.parseRow(row)
+                    except InvalidRow as error:
+                        if options["strict"]:
+                            raise CommandError("Line " + str(lineNumber) + ": " + str(error))
+                        self.counts["invalid"] += 1
+                        self.stderr.write("Skipping line " + str(lineNumber) + ": " + str(error))
+                        continue
+
+                    # A product repeated in the feed keeps its last row.
+                    batch[product[0]] = product
+                    if len(batch) >= options["batch_size"]:
+                        self.importBatch(batch)
+                        batch = {}
+                if batch:
+                    self.importBatch(batch)
+            self.removeMissing(options["delete_missing"])
+        except OSError as error:
+            raise CommandError("Couldn't read " + options["path"] + ": " + str(error))
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute("DROP TABLE IF EXISTS temp." + SEEN_TABLE)
+
+        elapsed = time.perf_counter() - start
+        processed = sum(self.counts[name] for name in ("inserted", "updated", "unchanged"))
+        summary = ", ".join(name + "=" + str(self.counts[name]) for name in self.counts)
+        prefix = "Dry run, nothing written: " if self.dryRun else ""
+        self.stdout.write(self.style.SUCCESS(prefix + summary + " (" + str(round(processed / elapsed if elapsed else 0)) + " rows/s)"))
+
+    def parseRow(self, row):
+        """ Validate one CSV row and return it as a tuple in COLUMNS order with model-ready values. """
+        if len(row) != len(COLUMNS):
+            raise InvalidRow("expected " + str(len(COLUMNS)) + " columns, found " + str(len(row)) + ".")
+
+        prodID, name, description, price, colour, type, available, new = [value.strip() for value in row]
+        for column, value in (("prodID", prodID), ("name", name), ("colour", colour), ("type", type)):
+            if value == "":
+                raise InvalidRow(column + " is empty.")
+            if len(value) > self.fieldLimits[column].max_length:
+                raise InvalidRow(column + " is longer than " + str(self.fieldLimits[column].max_length) + " characters.")
+
+        priceField = self.fieldLimits["price"]
+        try:
+            price = Decimal(price).quantize(Decimal(1).scaleb(-priceField.decimal_places))
+        except InvalidOperation:
+            raise InvalidRow("price '" + price + "' isn't a valid amount.")
+        if not price.is_finite() or price < 0 or len(price.as_tuple().digits) > priceField.max_digits:
+            raise InvalidRow("price '" + str(price) + "' is out of range.")
+
+        try:
+            available, new = BOOLEAN_VALUES[available.lower()], BOOLEAN_VALUES[new.lower()]
+        except KeyError:
+            raise InvalidRow("available and new must be 0 or 1.")
+
+        return (prodID, name, description, price, colour, type, available, new)
+
+    def importBatch(self, batch):
+        """ Diff one batch against the database and upsert the new and changed rows in a single transaction. """
+        existing = {row[0]: row for row in Product.objects.filter(prodID__in=list(batch)).values_list(*COLUMNS)}
+        changed = []
+        for prodID, product in batch.items():
+            if prodID not in existing:
+                self.counts["inserted"] += 1
+                changed.append(product)
+            elif existing[prodID] != product:
+                self.counts["updated"] += 1
+                changed.append(product)
+            else:
+                self.counts["unchanged"] += 1
+
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.executemany("INSERT OR IGNORE INTO " + SEEN_TABLE + " (prodID) VALUES (%s)", [(prodID,) for prodID in batch])
+
+            if changed and not self.dryRun:
+                with connection.cursor() as cursor:
+                    # Inserting in key order keeps the primary key B-tree writes local.
+                    cursor.executemany(self.upsertSQL(), [self.databaseValues(product) for product in sorted(changed)])
+                self.batchWritten()
+
+    def batchWritten(self):
+        """ Drop everything cached from the catalog once the batch commits, as the upserts don't send signals. """
+        bumpCatalogVersion(PRODUCTS_SCOPE)
+        invalidateNowAndOnCommit(PRODUCT_LISTINGS, PRODUCT_DETAILS)
+        transaction.on_commit(productColumns.markStale)
+        publishChange(Product)
+
+    def upsertSQL(self):
+        """ The INSERT ... ON CONFLICT DO UPDATE statement bulk_create(update_conflicts=True) would build for one row.
+
+        Running it through executemany() skips building a model instance per row and the 999 parameter limit
+        Django's SQLite backend puts on bulk_create batches, which together dominate the cost of large imports.
+        """
+        quote = connection.ops.quote_name
+        table = quote(Product._meta.db_table)
+        columns = [quote(Product._meta.get_field(name).column) for name in COLUMNS]
+        updates = ", ".join(column + " = excluded." + column for column in columns[1:])
+        # New products start on no watchlists, and an update leaves the count alone.
+        watchCount = quote(Product._meta.get_field("watchCount").column)
+        return ("INSERT INTO " + table + " (" + ", ".join(columns) + ", " + watchCount + ") VALUES (" + ", ".join(["%s"] * len(columns)) + ", 0)"
+                + " ON CONFLICT(" + columns[0] + ") DO UPDATE SET " + updates)
+
+    def databaseValues(self, product):
+        # parseRow() has already validated every value, so only the price needs adapting, the way Django's
+        # SQLite backend adapts decimals.
+        prodID, name, description, price, colour, type, available, new = product
+        return (prodID, name, description, str(price), colour, type, available, new)
+
+    def removeMissing(self, delete):
+        """ Count the products that weren't in the feed, deleting them if asked to. """
+        missing = Product.objects.exclude(prodID__in=RawSQL("SELECT prodID FROM temp." + SEEN_TABLE, []))
+        if delete and not self.dryRun:
+            with transaction.atomic():
+                _, deleted = missing.delete()
+                self.counts["removed"] = deleted.get(Product._meta.label, 0)
+        elif delete:
+            self.counts["removed"] = missing.count()
+        else:
+            self.counts["missing"] = missing.count()
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from productDetails.models import Product
+from productDetails.search import rebuildSearchIndex, searchAvailable
+import time
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the FTS5 product search index from the product table, e.g. after a VACUUM."
+
+    def handle(self, *args, **options):
+        if not searchAvailable():
+            raise CommandError("Product search uses SQLite FTS5 and is only available on SQLite.")
+
+        start = time.perf_counter()
+        with transaction.atomic():
+            rebuildSearchIndex()
+            count = Product.objects.count()
+        self.stdout.write(self.style.SUCCESS("Indexed " + str(count) + " products in " + str(round(time.perf_counter() - start, 2)) + "s."))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from productDetails.cache import invalidateTags, PRODUCT_DETAILS, POPULARITY_LISTINGS
+from productDetails.columnar import productColumns
+from productDetails.conditional import bumpCatalogVersion, POPULARITY_SCOPE
+from productDetails.invalidation import publishChange, WATCH_COUNTS
+from productDetails.watchlist import rebuildWatchCounts
+import time
+
+
+class Command(BaseCommand):
+    help = "Recounts every product's watchCount from the watchlist table, e.g. after editing watchlists with raw SQL."
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        corrected = rebuildWatchCounts()
+        if corrected:
+            bumpCatalogVersion(POPULARITY_SCOPE)
+            invalidateTags(POPULARITY_LISTINGS, PRODUCT_DETAILS)
+            productColumns.markCountsStale()
+            publishChange(WATCH_COUNTS)
+        self.stdout.write(self.style.SUCCESS("Corrected " + str(corrected) + " watch counts in " + str(round(time.perf_counter() - start, 2)) + "s."))
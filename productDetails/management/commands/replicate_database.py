@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from productDetails.database import replicateDatabase
+import time
+
+
+class Command(BaseCommand):
+    help = "Copies the primary SQLite database over its read replicas, once or every --interval seconds."
+
+    def add_arguments(self, parser):
+        parser.add_argument("replicas", nargs="*", help="Replica aliases to update. Defaults to every alias in DATABASE_REPLICAS.")
+        parser.add_argument("--interval", type=float, default=None, help="Keep replicating, waiting this many seconds between copies.")
+        parser.add_argument("--pages-per-step", type=int, default=-1, help="Pages copied before letting the primary's writers in again.")
+
+    def handle(self, *args, **options):
+        replicas = options["replicas"] or settings.DATABASE_REPLICAS
+        if not replicas:
+            raise CommandError("No replicas are configured. Set DATABASE_REPLICAS to a comma separated list of SQLite files.")
+        unknown = [alias for alias in replicas if alias not in settings.DATABASES]
+        if unknown:
+            raise CommandError("Unknown database aliases: " + ", ".join(unknown))
+
+        while True:
+            for alias in replicas:
+                start = time.perf_counter()
+                try:
+                    replicateDatabase(alias, pagesPerStep=options["pages_per_step"])
+                except ValueError as error:
+                    raise CommandError(str(error))
+                self.stdout.write("Replicated to " + alias + " in " + str(round(time.perf_counter() - start, 3)) + "s.")
+
+            if options["interval"] is None:
+                return
+            time.sleep(options["interval"])
@@ -0,0 +1,257 @@
+""" Per-route request metrics, shared by every worker process and exported in the Prometheus text format.
+
+For each named route in urls.py, request_metrics_middleware records the request's wall time, the number of
+queries it ran and the time spent running them, the time spent serializing its response (not counting queries
+the serializer ran) and the response size. The three times are kept as histograms.
+
+The numbers live in a memory-mapped file in METRICS_DIR, so they add up across gunicorn workers. Each worker
+process claims a slot of the file and adds to it without waiting on the others, and /metrics sums the slots. A
+slot left by a worker that has exited is claimed by the next worker to start, which carries on from its totals,
+so the counters never go backwards.
+"""
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+import fcntl, hashlib, mmap, os, tempfile
+
+METRICS_PREFIX = "productdetails"
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Requests that didn't match a named route, e.g. 404s and the admin.
+OTHER_ROUTE = "Other"
+
+# Upper bounds, in seconds, of the histogram buckets.
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# (name, help) for each histogram, in the order they're stored.
+HISTOGRAMS = (
+    ("request_duration_seconds", "Wall time of requests, by route."),
+    ("db_duration_seconds", "Time each request spent running database queries, by route."),
+    ("serialization_duration_seconds", "Time each request spent serializing its response, by route."),
+)
+COUNTERS = (
+    ("db_queries_total", "Database queries run, by route."),
+    ("response_bytes_total", "Bytes of response bodies sent, by route."),
+    ("coalesced_requests_total", "Requests answered with a response another request built, by route."),
+)
+
+# Each histogram is stored as one count per bucket, a count for values above the last bucket and the sum.
+HISTOGRAM_SIZE = len(DURATION_BUCKETS) + 2
+ROUTE_SIZE = len(HISTOGRAMS) * HISTOGRAM_SIZE + len(COUNTERS)
+
+DEFAULT_MAX_WORKERS = 64
+
+
+class RequestMetrics:
+    """ What one request has measured so far. """
+
+    __slots__ = ("queries", "dbTime", "serializationTime", "coalesced")
+
+    def __init__(self):
+        self.queries = 0
+        self.dbTime = 0.0
+        self.serializationTime = 0.0
+        self.coalesced = 0
+
+
+currentRequestMetrics = ContextVar("currentRequestMetrics", default=None)
+
+
+def timeQuery(execute, sql, params, many, context):
+    metrics = currentRequestMetrics.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.dbTime += perf_counter() - start
+        metrics.queries += 1
+
+
+@receiver(connection_created)
+def time_queries(sender, connection, **kwargs):
+    # Connections can reconnect, and the wrapper only needs adding the first time.
+    if timeQuery not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, timeQuery)
+
+
+@contextmanager
+def timedSerialization():
+    """ Count the time spent in the block, less any queries run in it, as the request's serialization time. """
+
+    metrics = currentRequestMetrics.get()
+    if metrics is None:
+        yield
+        return
+    start, dbTime = perf_counter(), metrics.dbTime
+    try:
+        yield
+    finally:
+        metrics.serializationTime += perf_counter() - start - (metrics.dbTime - dbTime)
+
+
+def processAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def escapeLabel(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def formatValue(value):
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class MetricsStore:
+    """ Histograms and counters for a fixed list of routes, in a file shared by up to `maxWorkers` processes. """
+
+    def __init__(self, directory, routes, maxWorkers=DEFAULT_MAX_WORKERS):
+        self.routes = list(routes)
+        if OTHER_ROUTE not in self.routes:
+            self.routes.append(OTHER_ROUTE)
+        self.routeIndexes = {route: index for index, route in enumerate(self.routes)}
+        self.otherIndex = self.routeIndexes[OTHER_ROUTE]
+        self.maxWorkers = maxWorkers
+
+        # A slot is the owning worker's pid followed by every route's numbers.
+        self.slotSize = 1 + len(self.routes) * ROUTE_SIZE
+
+        # The layout is part of the file name, so a deploy that changes the routes or buckets starts a new file
+        # instead of misreading the old one.
+        layout = repr((self.routes, DURATION_BUCKETS, HISTOGRAMS, COUNTERS, maxWorkers)).encode()
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "metrics-" + hashlib.sha1(layout).hexdigest()[0:12] + ".bin")
+
+        size = maxWorkers * self.slotSize * 8
+        with open(self.path, "a+b") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                if os.fstat(file.fileno()).st_size < size:
+                    file.truncate(size)
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+            self.mmap = mmap.mmap(file.fileno(), size)
+        self.values = memoryview(self.mmap).cast("d")
+
+        self.lock = Lock()
+        self.slot = None
+        os.register_at_fork(after_in_child=self.releaseSlot)
+
+    def releaseSlot(self):
+        """ Forget this process's slot, e.g. in a forked worker, which has to claim its own. """
+        self.lock = Lock()
+        self.slot = None
+
+    def claimSlot(self):
+        """ Claim a free slot, or one whose worker has exited. Called with self.lock held. """
+
+        pid = os.getpid()
+        with open(self.path, "r+b") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                for slot in range(self.maxWorkers):
+                    offset = slot * self.slotSize
+                    owner = int(self.values[offset])
+                    if owner == 0 or owner == pid or not processAlive(owner):
+                        self.values[offset] = pid
+                        self.slot = self.values[offset + 1:offset + self.slotSize]
+                        return
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+        # Every slot belongs to a running worker. Keep counting, but only in this process.
+        self.slot = memoryview(bytearray((self.slotSize - 1) * 8)).cast("d")
+
+    def record(self, route, duration, dbTime, serializationTime, queries, size, coalesced=0):
+        base = self.routeIndexes.get(route, self.otherIndex) * ROUTE_SIZE
+        with self.lock:
+            if self.slot is None:
+                self.claimSlot()
+            values = self.slot
+            # Written out rather than looped over, as this runs on every request.
+            values[base + bisect_left(DURATION_BUCKETS, duration)] += 1
+            values[base + HISTOGRAM_SIZE - 1] += duration
+            base += HISTOGRAM_SIZE
+            values[base + bisect_left(DURATION_BUCKETS, dbTime)] += 1
+            values[base + HISTOGRAM_SIZE - 1] += dbTime
+            base += HISTOGRAM_SIZE
+            values[base + bisect_left(DURATION_BUCKETS, serializationTime)] += 1
+            values[base + HISTOGRAM_SIZE - 1] += serializationTime
+            base += HISTOGRAM_SIZE
+            values[base] += queries
+            values[base + 1] += size
+            values[base + 2] += coalesced
+
+    def totals(self):
+        """ Every route's numbers summed over the workers' slots. """
+
+        totals = [0.0] * (self.slotSize - 1)
+        values = self.values
+        for slot in range(self.maxWorkers):
+            offset = slot * self.slotSize
+            if values[offset] == 0:
+                continue
+            for index, value in enumerate(values[offset + 1:offset + self.slotSize]):
+                totals[index] += value
+        return totals
+
+    def export(self):
+        """ The metrics of every route that has had a request, in the Prometheus text format. """
+
+        totals = self.totals()
+        routes = [(route, index * ROUTE_SIZE) for index, route in enumerate(self.routes)
+                  if sum(totals[index * ROUTE_SIZE:index * ROUTE_SIZE + HISTOGRAM_SIZE - 1]) > 0]
+        bounds = [formatValue(float(bound)) for bound in DURATION_BUCKETS] + ["+Inf"]
+
+        lines = []
+        for position, (name, description) in enumerate(HISTOGRAMS):
+            metric = METRICS_PREFIX + "_" + name
+            lines += ["# HELP " + metric + " " + description, "# TYPE " + metric + " histogram"]
+            for route, base in routes:
+                base += position * HISTOGRAM_SIZE
+                label = 'route="' + escapeLabel(route) + '"'
+                count = 0.0
+                for bucket, bound in enumerate(bounds):
+                    count += totals[base + bucket]
+                    lines.append(metric + "_bucket{" + label + ',le="' + bound + '"} ' + formatValue(count))
+                lines.append(metric + "_sum{" + label + "} " + formatValue(totals[base + HISTOGRAM_SIZE - 1]))
+                lines.append(metric + "_count{" + label + "} " + formatValue(count))
+
+        for position, (name, description) in enumerate(COUNTERS):
+            metric = METRICS_PREFIX + "_" + name
+            lines += ["# HELP " + metric + " " + description, "# TYPE " + metric + " counter"]
+            for route, base in routes:
+                value = totals[base + len(HISTOGRAMS) * HISTOGRAM_SIZE + position]
+                lines.append(metric + '{route="' + escapeLabel(route) + '"} ' + formatValue(value))
+
+        return "\n".join(lines) + "\n"
+
+
+def routeNames():
+    """ The names of the routes in urls.py, which are what requests are recorded under. """
+    from .urls import urlpatterns
+    return sorted({pattern.name for pattern in urlpatterns if pattern.name})
+
+
+_metricsStore = None
+
+
+def metricsStore():
+    global _metricsStore
+    if _metricsStore is None:
+        directory = getattr(settings, "METRICS_DIR", os.path.join(tempfile.gettempdir(), "apiData-metrics"))
+        _metricsStore = MetricsStore(directory, routeNames(), getattr(settings, "METRICS_MAX_WORKERS", DEFAULT_MAX_WORKERS))
+    return _metricsStore
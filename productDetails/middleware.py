@@ -0,0 +1,96 @@
+from django.conf import settings
+from django.utils.decorators import sync_and_async_middleware
+from asyncio import iscoroutinefunction
+from time import perf_counter
+from .invalidation import pollChanges
+from .metrics import OTHER_ROUTE, RequestMetrics, currentRequestMetrics, metricsStore
+from .routers import routingScope
+
+PRIMARY_PIN_COOKIE = "primary_pinned"
+
+
+def pinnedResponse(request, response, state):
+    """ Keep a client that has just written on the primary for its next few requests. """
+
+    if state.wrote:
+        response.set_cookie(PRIMARY_PIN_COOKIE, "1", max_age=getattr(settings, "REPLICA_STICKY_SECONDS", 5),
+                            secure=settings.SESSION_COOKIE_SECURE, httponly=True, samesite="Lax")
+    return response
+
+
+@sync_and_async_middleware
+def primary_pinning_middleware(get_response):
+    """ Route each request's reads on their own, starting on the primary if the client wrote recently. """
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            with routingScope(pinned=PRIMARY_PIN_COOKIE in request.COOKIES) as state:
+                return pinnedResponse(request, await get_response(request), state)
+        return middleware
+
+    def middleware(request):
+        with routingScope(pinned=PRIMARY_PIN_COOKIE in request.COOKIES) as state:
+            return pinnedResponse(request, get_response(request), state)
+    return middleware
+
+
+def recordedResponse(request, response, metrics, start):
+    """ Record a finished request's metrics, or a streamed one's once its body has been sent. """
+
+    route = request.resolver_match.url_name if request.resolver_match is not None else OTHER_ROUTE
+    if route is None:
+        route = OTHER_ROUTE
+    if response.streaming:
+        response.streaming_content = recordedStream(response.streaming_content, route, metrics, start)
+        return response
+
+    metricsStore().record(route, perf_counter() - start, metrics.dbTime, metrics.serializationTime, metrics.queries, len(response.content), metrics.coalesced)
+    return response
+
+
+def recordedStream(content, route, metrics, start):
+    size = 0
+    try:
+        for chunk in content:
+            size += len(chunk)
+            yield chunk
+    finally:
+        metricsStore().record(route, perf_counter() - start, metrics.dbTime, metrics.serializationTime, metrics.queries, size, metrics.coalesced)
+
+
+@sync_and_async_middleware
+def request_metrics_middleware(get_response):
+    """ Record each request's wall time, queries, serialization time and response size under its route's name.
+
+    The request's RequestMetrics is left in place after the response is returned, so the queries a streamed
+    response runs while it's being sent are still counted.
+    """
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            start, metrics = perf_counter(), RequestMetrics()
+            currentRequestMetrics.set(metrics)
+            return recordedResponse(request, await get_response(request), metrics, start)
+        return middleware
+
+    def middleware(request):
+        start, metrics = perf_counter(), RequestMetrics()
+        currentRequestMetrics.set(metrics)
+        return recordedResponse(request, get_response(request), metrics, start)
+    return middleware
+
+
+@sync_and_async_middleware
+def invalidation_polling_middleware(get_response):
+    """ Drop whatever other workers' writes have made stale before handling each request. """
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            pollChanges()
+            return await get_response(request)
+        return middleware
+
+    def middleware(request):
+        pollChanges()
+        return get_response(request)
+    return middleware
@@ -0,0 +1,29 @@
+# Generated by Django 4.1.4 on 2026-10-18 10:00
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def create_catalog_versions(apps, schema_editor):
+    CatalogVersion = apps.get_model("productDetails", "CatalogVersion")
+    for scope in ("products", "countries", "watchlists"):
+        CatalogVersion.objects.get_or_create(scope=scope, defaults={"version": 1, "modified": timezone.now()})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('productDetails', '0009_alter_watchlist_prodid_alter_watchlist_userid'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogVersion',
+            fields=[
+                ('scope', models.CharField(max_length=40, primary_key=True, serialize=False)),
+                ('version', models.PositiveBigIntegerField(default=0)),
+                ('modified', models.DateTimeField()),
+            ],
+        ),
+        migrations.RunPython(create_catalog_versions, migrations.RunPython.noop),
+    ]
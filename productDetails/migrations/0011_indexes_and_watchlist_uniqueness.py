@@ -0,0 +1,72 @@
+# Generated by Django 4.1.4 on 2026-10-18 18:21
+
+from django.db import migrations, models
+
+
+def remove_duplicate_watchlist_rows(apps, schema_editor):
+    """ Keep one reference per (user, product) pair so the unique constraint can be added. """
+    Watchlist = apps.get_model("productDetails", "Watchlist")
+    seen = set()
+    duplicates = []
+    for referenceID, userID, prodID in Watchlist.objects.order_by("watchlist_referenceID").values_list("watchlist_referenceID", "userID", "prodID"):
+        if (userID, prodID) in seen:
+            duplicates.append(referenceID)
+        seen.add((userID, prodID))
+    Watchlist.objects.filter(watchlist_referenceID__in=duplicates).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('productDetails', '0010_catalogversion'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='country',
+            name='name',
+            field=models.CharField(db_index=True, max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='customer',
+            name='email',
+            field=models.EmailField(db_index=True, max_length=254),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['price', 'prodID'], name='product_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['name', 'prodID'], name='product_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['colour', 'prodID'], name='product_colour_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['type', 'prodID'], name='product_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['available', 'prodID'], name='product_available_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['new', 'prodID'], name='product_new_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['type', 'price'], name='product_type_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['colour', 'price'], name='product_colour_price_idx'),
+        ),
+        migrations.RunPython(remove_duplicate_watchlist_rows, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='watchlist',
+            constraint=models.UniqueConstraint(fields=('userID', 'prodID'), name='unique_watchlist_product'),
+        ),
+    ]
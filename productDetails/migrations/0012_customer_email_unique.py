@@ -0,0 +1,37 @@
+# Generated by Django 4.1.4 on 2026-10-18 19:02
+
+from django.db import migrations, models
+
+
+def merge_duplicate_customers(apps, schema_editor):
+    """ Keep one customer per email so it can be made unique, moving the others' watchlists onto it. """
+    Customer = apps.get_model("productDetails", "Customer")
+    Watchlist = apps.get_model("productDetails", "Watchlist")
+
+    kept = {}
+    for userID, email in Customer.objects.order_by("userID").values_list("userID", "email"):
+        if email not in kept:
+            kept[email] = userID
+            continue
+
+        # Products the kept customer is already watching would break the unique watchlist constraint.
+        watched = Watchlist.objects.filter(userID=kept[email]).values_list("prodID", flat=True)
+        Watchlist.objects.filter(userID=userID, prodID__in=watched).delete()
+        Watchlist.objects.filter(userID=userID).update(userID=kept[email])
+        Customer.objects.filter(userID=userID).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('productDetails', '0011_indexes_and_watchlist_uniqueness'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_customers, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='customer',
+            name='email',
+            field=models.EmailField(max_length=254, unique=True),
+        ),
+    ]
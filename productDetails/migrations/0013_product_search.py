@@ -0,0 +1,53 @@
+# Generated by Django 4.1.4 on 2026-10-18 19:40
+
+from django.db import migrations
+
+SEARCH_TABLE = "productDetails_product_search"
+
+# An external-content index: it stores only the search terms and reads the text back from the product table,
+# matching product rows on rowid. The triggers follow FTS5's documented pattern for keeping such an index current.
+CREATE_SQL = [
+    "CREATE VIRTUAL TABLE " + SEARCH_TABLE + " USING fts5(name, description, content = 'productDetails_product', content_rowid = 'rowid', tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+    "INSERT INTO " + SEARCH_TABLE + " (" + SEARCH_TABLE + ") VALUES ('rebuild')",
+    """CREATE TRIGGER productDetails_product_search_insert AFTER INSERT ON productDetails_product BEGIN
+        INSERT INTO """ + SEARCH_TABLE + """ (rowid, name, description) VALUES (new.rowid, new.name, new.description);
+    END""",
+    """CREATE TRIGGER productDetails_product_search_delete AFTER DELETE ON productDetails_product BEGIN
+        INSERT INTO """ + SEARCH_TABLE + " (" + SEARCH_TABLE + """, rowid, name, description) VALUES ('delete', old.rowid, old.name, old.description);
+    END""",
+    """CREATE TRIGGER productDetails_product_search_update AFTER UPDATE OF name, description ON productDetails_product BEGIN
+        INSERT INTO """ + SEARCH_TABLE + " (" + SEARCH_TABLE + """, rowid, name, description) VALUES ('delete', old.rowid, old.name, old.description);
+        INSERT INTO """ + SEARCH_TABLE + """ (rowid, name, description) VALUES (new.rowid, new.name, new.description);
+    END""",
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS productDetails_product_search_update",
+    "DROP TRIGGER IF EXISTS productDetails_product_search_delete",
+    "DROP TRIGGER IF EXISTS productDetails_product_search_insert",
+    "DROP TABLE IF EXISTS " + SEARCH_TABLE,
+]
+
+
+def create_search_index(apps, schema_editor):
+    # FTS5 is SQLite-only. Other databases just don't get the search endpoints.
+    if schema_editor.connection.vendor == "sqlite":
+        for sql in CREATE_SQL:
+            schema_editor.execute(sql)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "sqlite":
+        for sql in DROP_SQL:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('productDetails', '0012_customer_email_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.1.4 on 2026-10-18 18:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('productDetails', '0013_product_search'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['colour', 'type', 'available', 'new', 'price'], name='product_facet_idx'),
+        ),
+    ]
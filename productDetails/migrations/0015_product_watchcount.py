@@ -0,0 +1,70 @@
+# Generated by Django 4.1.4 on 2026-10-18 21:40
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def watchCountField():
+    field = models.PositiveIntegerField(default=0)
+    field.set_attributes_from_name("watchCount")
+    return field
+
+
+def add_watch_count(apps, schema_editor):
+    Product = apps.get_model("productDetails", "Product")
+    if schema_editor.connection.vendor != "sqlite":
+        schema_editor.add_field(Product, watchCountField())
+        return
+
+    # SQLite's schema editor adds a NOT NULL column by copying the table, which would drop the search index's
+    # triggers and renumber the rowids it's keyed on. ADD COLUMN with a constant default changes it in place.
+    quote = schema_editor.quote_name
+    field = watchCountField()
+    definition, params = schema_editor.column_sql(Product, field, include_default=True)
+    check = field.db_parameters(schema_editor.connection)["check"]
+    if check:
+        definition += " CHECK (" + check + ")"
+    schema_editor.execute("ALTER TABLE " + quote(Product._meta.db_table) + " ADD COLUMN " + quote("watchCount") + " " + definition, params)
+
+
+def remove_watch_count(apps, schema_editor):
+    Product = apps.get_model("productDetails", "Product")
+    if schema_editor.connection.vendor != "sqlite":
+        schema_editor.remove_field(Product, Product._meta.get_field("watchCount"))
+        return
+
+    quote = schema_editor.quote_name
+    schema_editor.execute("ALTER TABLE " + quote(Product._meta.db_table) + " DROP COLUMN " + quote("watchCount"))
+
+
+def count_watchlists(apps, schema_editor):
+    Product = apps.get_model("productDetails", "Product")
+    Watchlist = apps.get_model("productDetails", "Watchlist")
+    counts = Watchlist.objects.filter(prodID=OuterRef("pk")).order_by().values("prodID").annotate(count=Count("*")).values("count")
+    Product.objects.update(watchCount=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('productDetails', '0014_product_facet_index'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[migrations.RunPython(add_watch_count, remove_watch_count)],
+            state_operations=[
+                migrations.AddField(
+                    model_name='product',
+                    name='watchCount',
+                    field=models.PositiveIntegerField(default=0),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['watchCount', 'prodID'], name='product_watchcount_idx'),
+        ),
+        migrations.RunPython(count_watchlists, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 4.1.4 on 2026-10-18 22:30
+
+from django.db import migrations
+from django.utils import timezone
+
+
+def create_popularity_version(apps, schema_editor):
+    CatalogVersion = apps.get_model("productDetails", "CatalogVersion")
+    CatalogVersion.objects.get_or_create(scope="popularity", defaults={"version": 1, "modified": timezone.now()})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('productDetails', '0015_product_watchcount'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_popularity_version, migrations.RunPython.noop),
+    ]
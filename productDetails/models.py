@@ -9,21 +9,51 @@ class Product(models.Model):
     type = models.CharField(max_length=40, null=False)
     available = models.BooleanField(null=False)
     new = models.BooleanField(null=False)
+    # How many watchlists the product is on, kept up to date by the watchlist writes (see watchlist.py).
+    watchCount = models.PositiveIntegerField(default=0, null=False)
+
+    class Meta:
+        indexes = [
+            # Sorting on any listed column, with prodID as the keyset pagination tiebreaker.
+            models.Index(fields=["price", "prodID"], name="product_price_idx"),
+            models.Index(fields=["name", "prodID"], name="product_name_idx"),
+            models.Index(fields=["colour", "prodID"], name="product_colour_idx"),
+            models.Index(fields=["type", "prodID"], name="product_type_idx"),
+            models.Index(fields=["available", "prodID"], name="product_available_idx"),
+            models.Index(fields=["new", "prodID"], name="product_new_idx"),
+            models.Index(fields=["watchCount", "prodID"], name="product_watchcount_idx"),
+            # The common filter combinations: a type or colour filter together with a price range or sort.
+            models.Index(fields=["type", "price"], name="product_type_price_idx"),
+            models.Index(fields=["colour", "price"], name="product_colour_price_idx"),
+            # Covers every column the facet counts group on, so counting the catalog never reads full rows.
+            models.Index(fields=["colour", "type", "available", "new", "price"], name="product_facet_idx"),
+        ]
 
 class Country(models.Model):
     countryID = models.CharField(max_length=100, primary_key=True, null=False, blank=False)
-    name = models.CharField(max_length=100, null=False)
+    name = models.CharField(max_length=100, null=False, db_index=True)
 
 class Customer(models.Model):
     userID = models.CharField(max_length=100, primary_key=True, null=False)
     name = models.CharField(max_length=100, null=False)
-    email = models.EmailField()
+    email = models.EmailField(unique=True)
 
 class Watchlist(models.Model):
     watchlist_referenceID = models.CharField(max_length=100, primary_key=True, null=False, blank=False)
     userID = models.ForeignKey(to=Customer, on_delete=models.CASCADE, null=False, blank=False, db_column="userID")
     prodID = models.ForeignKey(to=Product, on_delete=models.CASCADE, null=False, blank=False, db_column="prodID")
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["userID", "prodID"], name="unique_watchlist_product"),
+        ]
+
+class CatalogVersion(models.Model):
+    """ Version counter and last write time for one part of the catalog, used for ETag/Last-Modified headers. """
+    scope = models.CharField(max_length=40, primary_key=True, null=False, blank=False)
+    version = models.PositiveBigIntegerField(default=0, null=False)
+    modified = models.DateTimeField(null=False)
+
 #needs work
 """
 class Address(models.Model):
@@ -0,0 +1,122 @@
+""" Keyset (cursor) pagination for the product listings.
+
+Pages are keyed on the chosen sort field with prodID as a tiebreaker, so every page is fetched with
+an indexed range condition rather than an OFFSET scan and a deep page costs the same as the first one.
+"""
+
+from django.core.exceptions import ValidationError
+from django.db import models
+from django.db.models import Q
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from decimal import Decimal
+import binascii, json
+
+MAX_PAGE_LIMIT = 100
+
+
+class InvalidPageRequest(ValueError):
+    """ Raised when the limit or cursor of a paginated request can't be used. """
+
+
+def parseLimit(limit):
+    """ Validate the ?limit= parameter and clamp it to the maximum page size. """
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise InvalidPageRequest("limit must be a whole number.")
+    if limit < 1:
+        raise InvalidPageRequest("limit must be at least 1.")
+    return min(limit, MAX_PAGE_LIMIT)
+
+
+def encodeCursor(field, sortType, direction, product):
+    """ Build an opaque cursor pointing before or after the given product. """
+    value = getattr(product, field)
+    if isinstance(value, Decimal):
+        value = str(value)
+    cursorData = {"f": field, "s": sortType, "d": direction, "v": value, "id": product.prodID}
+    return urlsafe_b64encode(json.dumps(cursorData, separators=(",", ":")).encode()).decode()
+
+
+def decodeCursor(cursor, field, sortType, model):
+    """ Decode a cursor, making sure it belongs to the listing it's being used on. """
+    try:
+        cursorData = json.loads(urlsafe_b64decode(cursor.encode()))
+        direction, value, prodID = cursorData["d"], cursorData["v"], cursorData["id"]
+        cursorField, cursorSortType = cursorData["f"], cursorData["s"]
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise InvalidPageRequest("cursor is malformed.")
+
+    if cursorField != field or cursorSortType != sortType:
+        raise InvalidPageRequest("cursor belongs to a different sort order.")
+    if direction not in ("next", "prev") or not isinstance(prodID, str):
+        raise InvalidPageRequest("cursor is malformed.")
+    return direction, cursorValue(model, field, value), prodID
+
+
+def cursorValue(model, field, value):
+    """ Check a cursor's sort value against the type of the field it sorts on. """
+    modelField = model._meta.get_field(field)
+    if isinstance(modelField, models.DecimalField):
+        if isinstance(value, str):
+            try:
+                return modelField.clean(value, None)
+            except ValidationError:
+                pass
+    elif isinstance(modelField, models.BooleanField):
+        if isinstance(value, bool):
+            return value
+    elif isinstance(modelField, models.IntegerField):
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+    elif isinstance(modelField, (models.CharField, models.TextField)):
+        if isinstance(value, str):
+            return value
+    raise InvalidPageRequest("cursor is malformed.")
+
+
+def orderingKeys(field):
+    """ The sort field followed by the prodID tiebreaker. """
+    return [field] if field == "prodID" else [field, "prodID"]
+
+
+def seekCondition(field, value, prodID, after):
+    """ Rows strictly after (or before) the (value, prodID) position in ascending key order. """
+    lookup = "gt" if after else "lt"
+    if field == "prodID":
+        return Q(**{"prodID__" + lookup: prodID})
+    return Q(**{field + "__" + lookup: value}) | Q(**{field: value, "prodID__" + lookup: prodID})
+
+
+def keysetPage(products, field, sortType, limit, cursor=None):
+    """ Return (page of products, next cursor, prev cursor) for a product queryset.
+
+    The queryset is ordered by the sort field and prodID, then reversed for descending listings the same way
+    the unpaginated views do it. Walking backwards flips the seek condition and the ordering, and the fetched
+    rows are put back into listing order before being returned.
+    """
+
+    direction, value, prodID = ("next", None, None) if cursor is None else decodeCursor(cursor, field, sortType, products.model)
+    backwards = direction == "prev"
+
+    products = products.order_by(*orderingKeys(field))
+    if cursor is not None:
+        # Moving forwards in an ascending listing means moving to larger keys, and vice versa.
+        products = products.filter(seekCondition(field, value, prodID, after=(sortType == "asc") != backwards))
+    if (sortType == "desc") != backwards:
+        products = products.reverse()
+
+    page = list(products[0:limit + 1])
+    hasMore = len(page) > limit
+    page = page[0:limit]
+    if backwards:
+        page.reverse()
+
+    if len(page) == 0:
+        return page, None, None
+
+    hasNext = hasMore if not backwards else True
+    hasPrev = hasMore if backwards else cursor is not None
+    nextCursor = encodeCursor(field, sortType, "next", page[-1]) if hasNext else None
+    prevCursor = encodeCursor(field, sortType, "prev", page[0]) if hasPrev else None
+    return page, nextCursor, prevCursor
@@ -0,0 +1,98 @@
+""" Routing between the primary database and its read replicas.
+
+Reads of the catalog models go to one of the aliases in settings.DATABASE_REPLICAS, or every read does when
+REPLICA_READ_ALL is set. Writes always go to the primary, and once a request has written, the rest of its reads go
+to the primary too, so it reads its own writes even while the replicas lag behind. PrimaryPinningMiddleware extends
+that to the client's next requests for REPLICA_STICKY_SECONDS. What the workers cached from a replica is dropped
+each time it's replicated to (see replicateDatabase()).
+
+CatalogVersion is read from the same database as the catalog, so an ETag always matches the data it's sent with.
+The versions behind watchlist ETags are read from the database the watchlist rows are (see conditional.py).
+"""
+
+from django.conf import settings
+from contextlib import contextmanager
+from contextvars import ContextVar
+import random
+
+PRIMARY = "default"
+
+# Models read from a replica unless REPLICA_READ_ALL is set. Customers and watchlists are written to by the
+# requests that read them, so they stay on the primary.
+REPLICA_READ_MODELS = ("productDetails.product", "productDetails.country", "productDetails.catalogversion")
+
+
+class RoutingState:
+    """ Which database the reads in one request (or one management command) should use. """
+
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+        self.replica = None
+
+    def replicaFor(self, replicas):
+        # One replica per request, so all of a request's reads see the same snapshot.
+        if self.replica not in replicas:
+            self.replica = random.choice(replicas)
+        return self.replica
+
+
+routingState = ContextVar("routingState", default=None)
+
+
+def currentRoutingState():
+    state = routingState.get()
+    if state is None:
+        state = RoutingState()
+        routingState.set(state)
+    return state
+
+
+@contextmanager
+def routingScope(pinned=False):
+    """ Route the reads inside the block on their own, pinned to the primary from the start if `pinned` is set. """
+
+    state = RoutingState(pinned)
+    token = routingState.set(state)
+    try:
+        yield state
+    finally:
+        routingState.reset(token)
+
+
+def replicaAliases():
+    return list(getattr(settings, "DATABASE_REPLICAS", []))
+
+
+class PrimaryReplicaRouter:
+    """ Sends catalog reads to a replica and everything else to the primary. """
+
+    def db_for_read(self, model, **hints):
+        replicas = replicaAliases()
+        if not replicas:
+            return None
+
+        state = currentRoutingState()
+        if state.pinned:
+            return PRIMARY
+        if getattr(settings, "REPLICA_READ_ALL", False) or model._meta.label_lower in REPLICA_READ_MODELS:
+            return state.replicaFor(replicas)
+        return PRIMARY
+
+    def db_for_write(self, model, **hints):
+        state = currentRoutingState()
+        state.pinned = state.wrote = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same rows as the primary, so objects read from any of them can be related.
+        databases = {PRIMARY, *replicaAliases()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas are copies of the primary and get its schema from replication.
+        if db in replicaAliases():
+            return False
+        return None
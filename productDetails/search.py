@@ -0,0 +1,112 @@
+""" Full-text product search over the FTS5 index created in migration 0013.
+
+The index covers each product's name and description and is kept in sync by triggers on the product table, so
+bulk writes made with raw SQL (import_products) are indexed too. Index entries share their product's rowid, so
+a search is just another condition on a product queryset and combines with the usual filters and orderings.
+Without an ordering, matches are ranked with BM25, with name matches counted ten times as much as description
+matches.
+
+VACUUM can renumber the rowids of a table without an integer primary key, so run the rebuild_search_index
+command after vacuuming the database. A migration that remakes the product table renumbers them too and drops
+the triggers with the old table, so they're put back and the index rebuilt once migrate finishes.
+"""
+
+from django.db import connections
+from django.db.models.signals import post_migrate
+from django.dispatch import receiver
+from django.db.models.expressions import RawSQL
+import re
+
+SEARCH_TABLE = "productDetails_product_search"
+SEARCH_MAX_TERMS = 8
+SEARCH_DEFAULT_LIMIT = 50
+
+# bm25() takes one weight per index column: name, description.
+RANK_SQL = "bm25(" + SEARCH_TABLE + ", 10.0, 1.0)"
+
+# The triggers created in migration 0013, following FTS5's documented pattern for an external-content index.
+SEARCH_TRIGGERS = {
+    "productDetails_product_search_insert": """CREATE TRIGGER productDetails_product_search_insert AFTER INSERT ON productDetails_product BEGIN
+        INSERT INTO """ + SEARCH_TABLE + """ (rowid, name, description) VALUES (new.rowid, new.name, new.description);
+    END""",
+    "productDetails_product_search_delete": """CREATE TRIGGER productDetails_product_search_delete AFTER DELETE ON productDetails_product BEGIN
+        INSERT INTO """ + SEARCH_TABLE + " (" + SEARCH_TABLE + """, rowid, name, description) VALUES ('delete', old.rowid, old.name, old.description);
+    END""",
+    "productDetails_product_search_update": """CREATE TRIGGER productDetails_product_search_update AFTER UPDATE OF name, description ON productDetails_product BEGIN
+        INSERT INTO """ + SEARCH_TABLE + " (" + SEARCH_TABLE + """, rowid, name, description) VALUES ('delete', old.rowid, old.name, old.description);
+        INSERT INTO """ + SEARCH_TABLE + """ (rowid, name, description) VALUES (new.rowid, new.name, new.description);
+    END""",
+}
+
+
+class SearchError(ValueError):
+    """ Raised when a search query has nothing to search for. """
+
+
+def searchExpression(query):
+    """ Turn free text into an FTS5 query that matches every word, treating the last one as a prefix.
+
+    Words are quoted, so FTS5 operators and punctuation in the text are searched for literally rather than parsed.
+    """
+
+    terms = re.findall(r"\w+", query.lower())[0:SEARCH_MAX_TERMS]
+    if not terms:
+        raise SearchError("The search query must contain at least one letter or number.")
+    return " ".join('"' + term + '"' for term in terms) + "*"
+
+
+def searchAvailable(using="default"):
+    return connections[using].vendor == "sqlite"
+
+
+def rebuildSearchIndex(using="default"):
+    """ Re-read every product into the index and merge it into as few segments as possible. """
+
+    with connections[using].cursor() as cursor:
+        cursor.execute("INSERT INTO " + SEARCH_TABLE + " (" + SEARCH_TABLE + ") VALUES ('rebuild')")
+        cursor.execute("INSERT INTO " + SEARCH_TABLE + " (" + SEARCH_TABLE + ") VALUES ('optimize')")
+
+
+def restoreSearchIndex(using="default"):
+    """ Put back any missing index triggers and, if there were some, rebuild the index. Returns whether it did. """
+
+    with connections[using].cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE (type = 'table' AND name = %s) OR type = 'trigger'", [SEARCH_TABLE])
+        existing = {row[0] for row in cursor.fetchall()}
+        # Before migration 0013 (or after unapplying it) there's no index to restore.
+        if SEARCH_TABLE not in existing:
+            return False
+        missing = [name for name in SEARCH_TRIGGERS if name not in existing]
+        for name in missing:
+            cursor.execute(SEARCH_TRIGGERS[name])
+    if missing:
+        rebuildSearchIndex(using)
+    return bool(missing)
+
+
+@receiver(post_migrate)
+def restore_search_index(sender, using, **kwargs):
+    if sender.label == "productDetails" and searchAvailable(using):
+        restoreSearchIndex(using)
+
+
+def searchProducts(products, query):
+    """ Restrict a product queryset to the products matching `query`. """
+
+    # The matches are collected once and looked up as a set, so SQLite can still drive the query from a filter's
+    # index. Joining the index instead lets it probe FTS5 once per filtered product, which is far slower.
+    return products.extra(
+        where=[products.model._meta.db_table + ".rowid IN (SELECT rowid FROM " + SEARCH_TABLE + " WHERE " + SEARCH_TABLE + " MATCH %s)"],
+        params=[searchExpression(query)],
+    )
+
+
+def rankedSearch(products, query):
+    """ The products matching `query`, best match first. """
+
+    # bm25() has to be evaluated on the index's own rows, so ranking joins the index to the products.
+    return products.extra(
+        tables=[SEARCH_TABLE],
+        where=[SEARCH_TABLE + ".rowid = " + products.model._meta.db_table + ".rowid", SEARCH_TABLE + " MATCH %s"],
+        params=[searchExpression(query)],
+    ).order_by(RawSQL(RANK_SQL, []), "prodID")
@@ -1,12 +1,28 @@
-from rest_framework.serializers import ModelSerializer
+from rest_framework.serializers import ModelSerializer, BooleanField, CharField, DecimalField, IntegerField
+from rest_framework.settings import api_settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist
+from django.db import connections, models
+from decimal import Decimal
+import json
 from .models import Product, Country
+from .metrics import timedSerialization
 
-class ListedProductsSerializer(ModelSerializer):
+class SparseFieldsMixin:
+    """ Lets a ModelSerializer be built with `fields=[...]` to return only some of its declared fields. """
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+class ListedProductsSerializer(SparseFieldsMixin, ModelSerializer):
     class Meta:
         model = Product
         fields = ("prodID", "name", "price", "colour", "available", "new")
 
-class DetailedProductSerializer(ModelSerializer):
+class DetailedProductSerializer(SparseFieldsMixin, ModelSerializer):
     class Meta:
         model = Product
         fields = ("__all__")
@@ -14,4 +30,167 @@ class DetailedProductSerializer(ModelSerializer):
 class ListedCountriesSerializer(ModelSerializer):
     class Meta:
         model = Country
-        fields = ("__all__")
\ No newline at end of file
+        fields = ("__all__")
+
+
+STREAM_CHUNK_SIZE = 2000
+
+
+class ValuesListSerializer:
+    """ Fast-path list serialization for a ModelSerializer's declared fields.
+
+    Rows are fetched as tuples instead of model instances, columns are converted in bulk and the list is encoded
+    straight to JSON bytes. The output is byte-for-byte what JsonResponse(serializer.data) gives for the same
+    queryset. On SQLite the compiled query is run on a raw cursor, so the only per-value work is the conversion
+    from what SQLite stores (REAL/INTEGER for decimals, 0/1 for booleans) to the DRF representation. Elsewhere,
+    or for fields without a raw conversion, values_list() and the DRF fields' to_representation() are used.
+    """
+
+    # DRF fields whose representation is the value the database driver already returns.
+    PASSTHROUGH_FIELDS = (BooleanField, CharField, IntegerField)
+
+    def __init__(self, serializerClass, fieldNames=None):
+        self.serializerClass = serializerClass
+        self.model = serializerClass.Meta.model
+        serializer = serializerClass() if fieldNames is None else serializerClass(fields=fieldNames)
+        self.fields = [field for field in serializer.fields.values() if not field.write_only]
+        self.names = [field.field_name for field in self.fields]
+        self.sources = [field.source for field in self.fields]
+        self.converters = [self.converter(field) for field in self.fields]
+        self.rawConverters = self.sqliteConverters()
+        self.projections = {}
+
+    def project(self, fieldNames):
+        """ A serializer for only the given fields, still in declared order, which fetches only their columns.
+
+        The serializer class has to accept `fields=` (see SparseFieldsMixin). Projections are built once per
+        set of fields and reused.
+        """
+        key = frozenset(fieldNames)
+        projection = self.projections.get(key)
+        if projection is None:
+            projection = self.projections[key] = ValuesListSerializer(self.serializerClass, key)
+        return projection
+
+    def converter(self, field):
+        if type(field) in self.PASSTHROUGH_FIELDS:
+            return None
+        if type(field) is DecimalField and self.plainDecimal(field):
+            return self.decimalConverter(field)
+        return field.to_representation
+
+    def plainDecimal(self, field):
+        coerceToString = getattr(field, "coerce_to_string", api_settings.COERCE_DECIMAL_TO_STRING)
+        return coerceToString and not field.localize and field.decimal_places is not None
+
+    def decimalConverter(self, field):
+        # Values that already have the field's precision just need formatting.
+        exponent = -field.decimal_places
+
+        def convert(value):
+            if isinstance(value, Decimal) and value.as_tuple().exponent == exponent:
+                return "{:f}".format(value)
+            return field.to_representation(value)
+        return convert
+
+    def sqliteConverters(self):
+        """ Conversions from raw SQLite column values, or None if a field has no exact raw conversion. """
+        converters = []
+        for field, source in zip(self.fields, self.sources):
+            try:
+                modelField = self.model._meta.get_field(source)
+            except FieldDoesNotExist:
+                return None
+            if modelField.null:
+                return None
+
+            if type(field) is CharField and isinstance(modelField, (models.CharField, models.TextField)):
+                converters.append(None)
+            elif type(field) is BooleanField and isinstance(modelField, models.BooleanField):
+                converters.append(bool)
+            elif type(field) is IntegerField and isinstance(modelField, models.IntegerField):
+                converters.append(None)
+            elif type(field) is DecimalField and isinstance(modelField, models.DecimalField) and self.plainDecimal(field) \
+                    and field.decimal_places == modelField.decimal_places and modelField.max_digits <= 15:
+                # Stored decimals come back as floats (or ints), which print exactly at the field's precision
+                # while they have fewer than 15 significant digits.
+                converters.append(("%." + str(field.decimal_places) + "f").__mod__)
+            else:
+                return None
+        return converters
+
+    def rows(self, queryset):
+        """ Fetch and convert the rows for a queryset, returning a list of dicts in field order. """
+        queryset = queryset.values_list(*self.sources)
+        if self.rawConverters is not None and connections[queryset.db].vendor == "sqlite":
+            converters = self.rawConverters
+            try:
+                sql, params = queryset.query.sql_with_params()
+            except EmptyResultSet:
+                return []
+            with connections[queryset.db].cursor() as cursor:
+                cursor.execute(sql, params)
+                columns = list(zip(*cursor.fetchall()))
+        else:
+            converters = self.converters
+            columns = list(zip(*queryset))
+
+        if not columns:
+            return []
+
+        # Convert one column at a time so the per-value work is a single function call.
+        columns = [column if convert is None else map(convert, column) for column, convert in zip(columns, converters)]
+        names = self.names
+        return [dict(zip(names, row)) for row in zip(*columns)]
+
+    def encode(self, queryset):
+        """ Serialize a queryset straight to JSON bytes. """
+        with timedSerialization():
+            return json.dumps(self.rows(queryset), cls=DjangoJSONEncoder).encode()
+
+    async def aencode(self, queryset):
+        """ Async version of encode() for the ASGI views, reading rows through the async ORM. """
+        names = self.names
+        converters = [(index, convert) for index, convert in enumerate(self.converters) if convert is not None]
+        rows = []
+        with timedSerialization():
+            async for row in queryset.values_list(*self.sources):
+                if converters:
+                    row = list(row)
+                    for index, convert in converters:
+                        row[index] = convert(row[index])
+                rows.append(dict(zip(names, row)))
+            return json.dumps(rows, cls=DjangoJSONEncoder).encode()
+
+    def stream(self, queryset, chunkSize=STREAM_CHUNK_SIZE):
+        """ Yield the JSON array for a queryset in pieces of at most `chunkSize` rows.
+
+        Rows are read with iterator(chunk_size=...), so only one chunk is held in memory at a time. The joined
+        pieces are the same bytes encode() returns.
+        """
+        encoder = DjangoJSONEncoder()
+        names = self.names
+        converters = [(index, convert) for index, convert in enumerate(self.converters) if convert is not None]
+        rows = queryset.values_list(*self.sources).iterator(chunk_size=chunkSize)
+
+        yield b"["
+        separator = ""
+        chunk = []
+        for row in rows:
+            if converters:
+                row = list(row)
+                for index, convert in converters:
+                    row[index] = convert(row[index])
+            chunk.append(encoder.encode(dict(zip(names, row))))
+            if len(chunk) == chunkSize:
+                yield (separator + ", ".join(chunk)).encode()
+                separator = ", "
+                chunk = []
+        if chunk:
+            yield (separator + ", ".join(chunk)).encode()
+        yield b"]"
+
+
+fastListedProductsSerializer = ValuesListSerializer(ListedProductsSerializer)
+fastDetailedProductSerializer = ValuesListSerializer(DetailedProductSerializer)
+fastListedCountriesSerializer = ValuesListSerializer(ListedCountriesSerializer)
@@ -0,0 +1,117 @@
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import Product, Country, Customer, Watchlist
+from .auth import rememberCustomer, forgetCustomer, userIDCache
+from .columnar import columnarEngine, productColumns
+from .cache import invalidateTags, productTag, PRODUCT_DETAILS, PRODUCT_LISTINGS, POPULARITY_LISTINGS, COUNTRIES
+from .conditional import bumpCatalogVersion, PRODUCTS_SCOPE, COUNTRIES_SCOPE, WATCHLISTS_SCOPE, POPULARITY_SCOPE
+from .invalidation import onRemoteChange, publishChange, WATCH_COUNTS
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Set while applyWatchlistOperations() writes, as it bumps the versions and counts once for the whole batch.
+inWatchlistBatch = ContextVar("inWatchlistBatch", default=False)
+
+
+@contextmanager
+def watchlistBatch():
+    """ Skip the per-row watchlist receivers for the writes made in the block. """
+    token = inWatchlistBatch.set(True)
+    try:
+        yield
+    finally:
+        inWatchlistBatch.reset(token)
+
+
+def invalidateNowAndOnCommit(*tags):
+    """ Invalidate straight away and again once the write commits, so readers can't re-cache uncommitted state. """
+    invalidateTags(*tags)
+    transaction.on_commit(lambda: invalidateTags(*tags))
+
+
+def watchCountsChanged(prodIDs):
+    """ A watch count change only affects the products' own detail responses and the listings sorted by watchCount. """
+    bumpCatalogVersion(POPULARITY_SCOPE)
+    invalidateWatchCounts(prodIDs)
+
+
+def invalidateWatchCounts(prodIDs):
+    """ watchCountsChanged() for callers that bump POPULARITY_SCOPE themselves. """
+    invalidateNowAndOnCommit(POPULARITY_LISTINGS, *[productTag(prodID) for prodID in prodIDs])
+    publishChange(WATCH_COUNTS)
+
+    engine = columnarEngine()
+    if engine is not None:
+        prodIDs = list(prodIDs)
+        transaction.on_commit(lambda: engine.refreshCounts(prodIDs))
+
+
+@receiver([post_save, post_delete], sender=Product)
+def invalidate_product_responses(sender, instance, **kwargs):
+    """ A product change can affect any listing but only its own detail response. """
+    bumpCatalogVersion(PRODUCTS_SCOPE)
+    invalidateNowAndOnCommit(PRODUCT_LISTINGS, productTag(instance.prodID))
+    publishChange(Product)
+
+    engine = columnarEngine()
+    if engine is not None:
+        prodID = instance.prodID
+        transaction.on_commit(lambda: engine.refresh([prodID]))
+
+
+@receiver([post_save, post_delete], sender=Country)
+def invalidate_country_responses(sender, instance, **kwargs):
+    bumpCatalogVersion(COUNTRIES_SCOPE)
+    invalidateNowAndOnCommit(COUNTRIES)
+    publishChange(Country)
+
+
+@receiver(post_save, sender=Customer)
+def remember_customer(sender, instance, **kwargs):
+    """ Keep the email -> userID cache current as customers are created, once they're committed. """
+    email, userID = instance.email, instance.userID
+    transaction.on_commit(lambda: rememberCustomer(email, userID))
+
+
+@receiver(post_delete, sender=Customer)
+def forget_customer(sender, instance, **kwargs):
+    email = instance.email
+    forgetCustomer(email)
+    transaction.on_commit(lambda: forgetCustomer(email))
+
+
+@receiver([post_save, post_delete], sender=Customer)
+@receiver([post_save, post_delete], sender=Watchlist)
+def bump_watchlist_version(sender, instance, **kwargs):
+    """ Watchlist responses depend on both the user's watchlist rows and whether the customer exists. """
+    if inWatchlistBatch.get():
+        return
+    bumpCatalogVersion(WATCHLISTS_SCOPE)
+    publishChange(sender)
+
+
+@receiver(post_save, sender=Watchlist)
+def count_watchlist_addition(sender, instance, created, **kwargs):
+    """ Keep watchCount current for rows written through the ORM. The watchlist endpoints update it themselves. """
+    if created and not inWatchlistBatch.get():
+        Product.objects.filter(prodID=instance.prodID_id).update(watchCount=F("watchCount") + 1)
+        watchCountsChanged([instance.prodID_id])
+
+
+@receiver(post_delete, sender=Watchlist)
+def count_watchlist_removal(sender, instance, **kwargs):
+    if inWatchlistBatch.get():
+        return
+    Product.objects.filter(prodID=instance.prodID_id, watchCount__gt=0).update(watchCount=F("watchCount") - 1)
+    watchCountsChanged([instance.prodID_id])
+
+
+# Another worker's write only says which model changed, so everything cached from that model is dropped.
+onRemoteChange(Product, lambda: invalidateTags(PRODUCT_LISTINGS, PRODUCT_DETAILS))
+onRemoteChange(Product, productColumns.markStale)
+onRemoteChange(WATCH_COUNTS, lambda: invalidateTags(POPULARITY_LISTINGS, PRODUCT_DETAILS))
+onRemoteChange(WATCH_COUNTS, productColumns.markCountsStale)
+onRemoteChange(Country, lambda: invalidateTags(COUNTRIES))
+onRemoteChange(Customer, userIDCache.clear)
@@ -1,7 +1,58 @@
-from django.test import TestCase
-from django.test.client import Client
+from django.test import TestCase, TransactionTestCase
+from django.test.client import Client, AsyncClient
+from asgiref.sync import sync_to_async
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.conf import settings
+from django.db import connection, connections, router, IntegrityError, OperationalError
+from django.db import models
+from django.db.models import Q
 from .models import Customer, Watchlist, Product, Country
+from .cache import ResponseCache, cacheKey, responseCache
+from .coalescing import SharedResponses, singleFlight
+from .conditional import catalogValidators, PRODUCTS_SCOPE
+from .filters import planFilter
+from .watchlist import MAX_WATCHLIST_OPERATIONS
+from .database import lockForWrite, replicateDatabase
+from .invalidation import GenerationCounters
+from .routers import PrimaryReplicaRouter, routingScope
+from .middleware import PRIMARY_PIN_COOKIE
+from .columnar import ColumnarProducts, COLUMNS, numpy
+from .pagination import orderingKeys
+from .metrics import MetricsStore, PROMETHEUS_CONTENT_TYPE, routeNames
+from .auth import decodeToken, tokenCache, userIDCache, userIDForEmail
+from .serializers import ListedProductsSerializer, DetailedProductSerializer, ListedCountriesSerializer
+from .serializers import fastListedProductsSerializer, fastDetailedProductSerializer, fastListedCountriesSerializer
+from .serializers import ValuesListSerializer
+from django.http import JsonResponse, QueryDict
 from uuid import uuid4
+from decimal import Decimal
+from jwt import encode, decode
+from jwt.exceptions import ExpiredSignatureError, InvalidSignatureError
+from unittest import skipUnless
+from unittest.mock import patch
+from base64 import urlsafe_b64encode
+import time
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from .management.commands.import_products import Command as ImportProductsCommand
+from io import StringIO
+import asyncio, csv, fcntl, json, multiprocessing, tempfile, threading
+import os
+import unittest
+
+
+def setUpModule():
+    # Record the suite's requests and publish its writes in files of its own, so a server on the same host neither
+    # exports the test traffic nor drops its caches for the test writes.
+    directory = tempfile.TemporaryDirectory()
+    unittest.addModuleCleanup(directory.cleanup)
+    overridden = override_settings(METRICS_DIR=directory.name, INVALIDATION_DIR=directory.name)
+    overridden.enable()
+    unittest.addModuleCleanup(overridden.disable)
+    for name, value in [("metrics._metricsStore", None), ("invalidation._generationCounters", GenerationCounters(directory.name))]:
+        patcher = patch("productDetails." + name, value)
+        patcher.start()
+        unittest.addModuleCleanup(patcher.stop)
 
 
 
@@ -13,6 +64,316 @@ class CustomerTests(TestCase):
 
 
 
+class CustomerUpsertTests(TestCase):
+    """ Logins and bulk syncs should upsert customers on email in as few statements as possible. """
+
+    def setUp(self):
+        userIDCache.clear()
+        self.accessID = os.environ['CUSTOMER_MODEL_URL_ACCESS']
+
+    def login(self, email, name):
+        token = encode({"email": email, "name": name}, os.environ['JWT_SECRET'], algorithm="HS256")
+        return Client().get("/customers/" + self.accessID + "/" + token)
+
+    def sync(self, customers, secret=None):
+        token = encode({"customers": customers}, secret or os.environ['JWT_SECRET'], algorithm="HS256")
+        return Client().post("/customers/" + self.accessID + "/sync", token, content_type="application/jwt")
+
+    def test_login_upsert(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.login("login@example.com", "First Name")
+        customer = Customer.objects.get(email="login@example.com")
+        self.assertEqual(customer.name, "First Name")
+        self.assertEqual(userIDForEmail("login@example.com"), customer.userID)
+
+        # A returning customer with the same name is one statement that writes nothing, inside a savepoint.
+        with self.assertNumQueries(3):
+            self.login("login@example.com", "First Name")
+        self.login("login@example.com", "New Name")
+        self.assertEqual(Customer.objects.get(email="login@example.com").name, "New Name")
+        self.assertEqual(Customer.objects.filter(email="login@example.com").count(), 1)
+
+        self.assertEqual(self.login("not-an-email", "Name").status_code, 400)
+        self.assertEqual(Client().get("/customers/wrong/" + "token").json(), {})
+
+    def test_unique_email(self):
+        customer = Customer.objects.get(name="M E")
+        with self.assertRaises(IntegrityError):
+            Customer.objects.create(userID=str(uuid4()), name="Copy", email=customer.email)
+
+    def test_bulk_sync(self):
+        existing = Customer.objects.get(name="M E")
+        customers = [{"email": "sync" + str(i) + "@example.com", "name": "Sync " + str(i)} for i in range(50)]
+        customers += [{"email": existing.email, "name": "Renamed"}]
+
+        # The write lock, one lookup for the whole batch, one executemany() upsert and the version bump, inside a savepoint.
+        with self.assertNumQueries(6):
+            res = self.sync(customers)
+        self.assertEqual([res.json()[key] for key in ("inserted", "updated", "unchanged")], [50, 1, 0])
+        self.assertEqual(res.json()['userIDs'][existing.email], existing.userID)
+        self.assertEqual(Customer.objects.get(email="sync7@example.com").userID, res.json()['userIDs']["sync7@example.com"])
+        self.assertEqual(Customer.objects.get(userID=existing.userID).name, "Renamed")
+
+        res = self.sync(customers)
+        self.assertEqual([res.json()[key] for key in ("inserted", "updated", "unchanged")], [0, 0, 51])
+
+    def test_bulk_sync_rejects_bad_batches(self):
+        self.assertEqual(self.sync([{"email": "a@example.com", "name": "A"}], secret="wrong-secret").status_code, 400)
+        self.assertEqual(self.sync([{"email": "a@example.com", "name": "A"}, {"email": "broken"}]).status_code, 400)
+        self.assertEqual(self.sync([]).status_code, 400)
+        self.assertFalse(Customer.objects.filter(email="a@example.com").exists())
+        self.assertEqual(Client().get("/customers/" + self.accessID + "/sync").status_code, 405)
+
+
+
+class DatabaseProfileTests(TestCase):
+    """ New SQLite connections should get the pragmas of the configured connection profile. """
+
+    def pragmas(self, wrapper):
+        with wrapper.cursor() as cursor:
+            return {name: cursor.execute("PRAGMA " + name).fetchone()[0] for name in ("journal_mode", "synchronous", "busy_timeout", "mmap_size")}
+
+    def newConnection(self, path):
+        wrapper = connections["default"].__class__(dict(connection.settings_dict, NAME=path), alias="profile-test")
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    def test_tuned_profile(self):
+        self.assertEqual(settings.SQLITE_CONNECTION_PROFILE, "tuned")
+        self.assertEqual(self.pragmas(connection), {"journal_mode": "wal", "synchronous": 1, "busy_timeout": 5000, "mmap_size": 268435456})
+
+    def test_legacy_profile(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with self.settings(SQLITE_CONNECTION_PROFILE="legacy"):
+            pragmas = self.pragmas(self.newConnection(os.path.join(directory.name, "legacy.sqlite3")))
+        self.assertEqual(pragmas['journal_mode'], "delete")
+        self.assertEqual(pragmas['mmap_size'], 0)
+
+    def test_lock_for_write(self):
+        # Inside a transaction that has taken the write lock, another connection can't start writing.
+        other = self.newConnection(connection.settings_dict['NAME'])
+        with other.cursor() as cursor:
+            cursor.execute("PRAGMA busy_timeout = 0")
+        lockForWrite(Watchlist)
+        with self.assertRaises(OperationalError):
+            with other.cursor() as cursor:
+                cursor.execute("DELETE FROM productDetails_watchlist")
+
+
+class ReplicaRoutingTests(TransactionTestCase):
+    """ Catalog reads should come from the replica, which only changes when it's replicated to, until the client writes.
+
+    Replication only copies committed data, so these tests commit, and the test database is restored afterwards.
+    """
+
+    serialized_rollback = True
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        connections.settings["replica"] = dict(connections.settings["default"], NAME=os.path.join(directory.name, "replica.sqlite3"))
+        self.addCleanup(self.removeReplica)
+
+        overridden = self.settings(DATABASE_REPLICAS=["replica"])
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+
+        responseCache.clear()
+        replicateDatabase("replica")
+        self.product = Product.objects.order_by("prodID").first()
+
+    def removeReplica(self):
+        connections["replica"].close()
+        del connections["replica"]
+        del connections.settings["replica"]
+
+    def rename(self, name):
+        with routingScope():
+            Product.objects.filter(prodID=self.product.prodID).update(name=name)
+        responseCache.clear()
+
+    def test_routing(self):
+        with routingScope():
+            self.assertEqual(router.db_for_read(Product), "replica")
+            self.assertEqual(router.db_for_read(Country), "replica")
+            self.assertEqual(router.db_for_read(Customer), "default")
+            with self.settings(REPLICA_READ_ALL=True):
+                self.assertEqual(router.db_for_read(Customer), "replica")
+
+            # Once the request has written, everything it reads comes from the primary.
+            self.assertEqual(router.db_for_write(Watchlist), "default")
+            self.assertEqual(router.db_for_read(Product), "default")
+
+        with routingScope(), self.settings(DATABASE_REPLICAS=[]):
+            self.assertIsNone(PrimaryReplicaRouter().db_for_read(Product))
+
+    def test_replication(self):
+        self.rename("Renamed Product")
+        with routingScope():
+            self.assertEqual(Product.objects.get(prodID=self.product.prodID).name, self.product.name)
+
+        replicateDatabase("replica")
+        with routingScope():
+            self.assertEqual(Product.objects.get(prodID=self.product.prodID).name, "Renamed Product")
+
+        with self.assertRaises(ValueError):
+            replicateDatabase("default")
+
+    def test_replication_drops_cached_responses(self):
+        c = Client()
+        self.rename("Renamed Product")
+        # Built from the replica, which hasn't been copied to since the write, and cached.
+        self.assertEqual(c.get("/api/product/" + self.product.prodID).json()[0]['name'], self.product.name)
+
+        replicateDatabase("replica")
+        self.assertEqual(c.get("/api/product/" + self.product.prodID).json()[0]['name'], "Renamed Product")
+
+        # Copying again without any writes in between keeps the cache.
+        generation = responseCache.generation
+        replicateDatabase("replica")
+        self.assertEqual(responseCache.generation, generation)
+
+    def test_watchlist_etag_read_with_the_watchlist(self):
+        customer = Customer.objects.get(name="M E")
+        token = encode({"email": customer.email}, os.environ['JWT_SECRET'], algorithm="HS256")
+        etag = Client().get("/api/watchlist/" + token + "/get")['ETag']
+
+        # Committed to the primary only, while the replica still has the old versions.
+        with routingScope():
+            product = Product.objects.exclude(watchlist__userID=customer).order_by("prodID").first()
+            Watchlist.objects.create(watchlist_referenceID=str(uuid4()), userID=customer, prodID=product)
+
+        # Another device, without the pin cookie, sees the change.
+        res = Client().get("/api/watchlist/" + token + "/get", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(product.prodID, [entry[0]['prodID'] for entry in res.json()])
+
+    def test_sticky_primary_after_write(self):
+        self.rename("Renamed Product")
+        reader, writer = Client(), Client()
+        self.assertEqual(reader.get("/api/product/" + self.product.prodID).json()[0]['name'], self.product.name)
+
+        customer = Customer.objects.get(name="M E")
+        token = encode({"email": customer.email, "prodID": self.product.prodID, "process": "add"}, os.environ['JWT_SECRET'], algorithm="HS256")
+        res = writer.get("/api/watchlist/" + token)
+        self.assertEqual(res.cookies[PRIMARY_PIN_COOKIE]['max-age'], settings.REPLICA_STICKY_SECONDS)
+
+        # The writer's next request reads from the primary, while other clients still get the replica.
+        responseCache.clear()
+        res = writer.get("/api/product/" + self.product.prodID)
+        self.assertEqual(res.json()[0]['name'], "Renamed Product")
+        self.assertNotIn(PRIMARY_PIN_COOKIE, res.cookies)
+        responseCache.clear()
+        self.assertEqual(reader.get("/api/product/" + self.product.prodID).json()[0]['name'], self.product.name)
+
+    def test_replicate_command(self):
+        self.rename("Renamed Product")
+        out = StringIO()
+        call_command("replicate_database", stdout=out)
+        self.assertIn("Replicated to replica", out.getvalue())
+        with routingScope():
+            self.assertEqual(Product.objects.get(prodID=self.product.prodID).name, "Renamed Product")
+
+        with self.assertRaises(CommandError):
+            call_command("replicate_database", "missing")
+
+
+def serveInWorker(pipe):
+    """ Stands in for a gunicorn worker, running the test's ("get", path), ("rename", (prodID, name)) and
+    ("deleteCustomer", email) commands until it's sent ("stop", None). """
+
+    client = Client()
+    try:
+        while True:
+            action, argument = pipe.recv()
+            if action == "get":
+                pipe.send(client.get(argument).content)
+            elif action == "rename":
+                product = Product.objects.get(prodID=argument[0])
+                product.name = argument[1]
+                product.save()
+                pipe.send(None)
+            elif action == "deleteCustomer":
+                Customer.objects.filter(email=argument).delete()
+                pipe.send(None)
+            else:
+                return
+    finally:
+        connections.close_all()
+
+
+class InvalidationBusTests(TransactionTestCase):
+    """ A write in one worker should drop what every other worker has cached from that model.
+
+    The workers are forked processes with their own caches, working on committed data, so the test database is
+    restored afterwards.
+    """
+
+    serialized_rollback = True
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        patcher = patch("productDetails.invalidation._generationCounters", GenerationCounters(self.directory))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        responseCache.clear()
+        userIDCache.clear()
+
+    def test_generation_counters(self):
+        here, elsewhere = GenerationCounters(self.directory), GenerationCounters(self.directory)
+        here.bump("productDetails.product")
+        self.assertEqual(here.changed(), [])
+        self.assertEqual(elsewhere.changed(), ["productDetails.product"])
+        self.assertEqual(elsewhere.changed(), [])
+
+        # A process's own bump doesn't hide one it hasn't seen yet.
+        elsewhere.bump("productDetails.country")
+        here.bump("productDetails.country")
+        self.assertEqual(here.changed(), ["productDetails.country"])
+        self.assertEqual(elsewhere.changed(), ["productDetails.country"])
+
+    def test_workers_drop_stale_entries(self):
+        product = Product.objects.order_by("prodID").first()
+        customer = Customer.objects.get(name="M E")
+        token = encode({"email": customer.email}, os.environ['JWT_SECRET'], algorithm="HS256")
+        detail, listing, watchlist = "/api/product/" + product.prodID, "/api/products/asc/prodID", "/api/watchlist/" + token + "/get"
+
+        # The workers have to open their own database connections.
+        connections.close_all()
+        context = multiprocessing.get_context("fork")
+        pipes, workers = [], []
+        for _ in range(2):
+            pipe, workerPipe = context.Pipe()
+            worker = context.Process(target=serveInWorker, args=(workerPipe,))
+            worker.start()
+            pipes.append(pipe)
+            workers.append(worker)
+
+        def ask(worker, action, argument):
+            pipes[worker].send((action, argument))
+            return pipes[worker].recv()
+
+        try:
+            cached = [ask(0, "get", path) for path in (detail, listing, watchlist)]
+            self.assertEqual(ask(0, "get", detail), cached[0])
+            self.assertNotEqual(json.loads(cached[2]), {})
+
+            ask(1, "rename", (product.prodID, "Renamed elsewhere"))
+            self.assertEqual(json.loads(ask(0, "get", detail))[0]["name"], "Renamed elsewhere")
+            self.assertEqual(json.loads(ask(0, "get", listing))[0]["name"], "Renamed elsewhere")
+
+            # The deleted customer's userID is forgotten too, so their watchlist isn't looked up any more.
+            ask(1, "deleteCustomer", customer.email)
+            self.assertEqual(json.loads(ask(0, "get", watchlist)), {})
+        finally:
+            for pipe, worker in zip(pipes, workers):
+                pipe.send(("stop", None))
+                worker.join()
+
+
 class CountryTests(TestCase):
     def test_view_codes(self):
         c = Client()
@@ -104,6 +465,46 @@ class ProductsTests(TestCase):
 
 
 
+class BatchProductTests(TestCase):
+    """ The batch endpoint should return the requested products in order, from a single product query. """
+
+    def setUp(self):
+        responseCache.clear()
+
+    def test_request_order_and_missing(self):
+        c = Client()
+        ids = list(Product.objects.order_by("-prodID").values_list("prodID", flat=True)[0:5])
+        requested = [ids[3], "no-such-product", ids[0], ids[4], ids[3]]
+        with CaptureQueriesContext(connection) as queries:
+            res = c.get("/api/product/batch/" + ",".join(requested) + ",")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len([query for query in queries.captured_queries if "productDetails_product" in query['sql']]), 1)
+
+        results = res.json()
+        self.assertEqual(len(results), 5)
+        self.assertEqual(results[1], {"prodID": "no-such-product", "missing": True})
+        for id, result in zip(requested, results):
+            if id != "no-such-product":
+                self.assertEqual(result, c.get("/api/product/" + id).json()[0])
+
+        # A product created later shows up, as the batch is invalidated along with its products' tags.
+        Product.objects.create(prodID="no-such-product", name="Found", description="", price="1", colour="Black",
+                               type="Shirts", available=True, new=False)
+        self.assertEqual(c.get("/api/product/batch/" + ",".join(requested)).json()[1]["name"], "Found")
+
+    def test_fields_and_limits(self):
+        c = Client()
+        ids = list(Product.objects.order_by("prodID").values_list("prodID", flat=True)[0:2])
+        results = c.get("/api/product/batch/" + ids[1] + ",missing," + ids[0], {"fields": "price,name"}).json()
+        self.assertEqual([list(result) for result in results], [["name", "price"], ["prodID", "missing"], ["name", "price"]])
+        self.assertEqual(results[2]["name"], Product.objects.get(prodID=ids[0]).name)
+
+        self.assertEqual(c.get("/api/product/batch/" + ids[0], {"fields": "unknown"}).status_code, 400)
+        self.assertEqual(c.get("/api/product/batch/,").status_code, 400)
+        self.assertEqual(c.get("/api/product/batch/" + ",".join(str(index) for index in range(101))).status_code, 400)
+
+
+
 class WatchlistTests(TestCase):
     def test_view_codes(self):
         c = Client()
@@ -121,20 +522,1163 @@ class WatchlistTests(TestCase):
 
     def test_data_addition(self):
         userID = Customer.objects.filter(name="M E")
-        all_products = [ product for product in Product.objects.all()]
+        all_products = [ product for product in Product.objects.exclude(watchlist__userID=userID[0])]
         for product in all_products:
             Watchlist(watchlist_referenceID=str(uuid4()), userID=userID[0], prodID=product).save()
 
-        self.assertEqual(len(Watchlist.objects.all().values("watchlist_referenceID").values()), 18) # 17 + 1 where there's the original product in the product database.
+        self.assertEqual(len(Watchlist.objects.all().values("watchlist_referenceID").values()), 17) # 16 + 1 where there's the original product already in the watchlist.
+
+    def test_duplicate_addition_rejected(self):
+        userID = Customer.objects.filter(name="M E")
+        product = Watchlist.objects.filter(userID=userID[0])[0].prodID
+        with self.assertRaises(IntegrityError):
+            Watchlist(watchlist_referenceID=str(uuid4()), userID=userID[0], prodID=product).save()
 
     def test_data_removal(self):
         userID = Customer.objects.filter(name="M E")
-        all_products = [ product for product in Product.objects.all()]
-        for product in all_products:
+        for product in Product.objects.exclude(watchlist__userID=userID[0]):
             Watchlist(watchlist_referenceID=str(uuid4()), userID=userID[0], prodID=product).save()
 
         # Removes all values, should become 0.
-        for product in all_products:
+        for product in Product.objects.all():
             Watchlist.objects.filter(userID=userID[0], prodID=product).delete()
 
-        self.assertEqual(len(Watchlist.objects.all().values()), 0)
\ No newline at end of file
+        self.assertEqual(len(Watchlist.objects.all().values()), 0)
+
+
+class WatchlistQueryCountTests(TestCase):
+    """ The watchlist endpoints should cost the same number of queries regardless of catalog size. """
+
+    def setUp(self):
+        userIDCache.clear()
+        self.customer = Customer.objects.create(userID=str(uuid4()), name="Query Count", email="querycount@example.com")
+        self.token = encode({"email": self.customer.email}, os.environ['JWT_SECRET'], algorithm="HS256")
+
+    def addCatalog(self, size):
+        products = [
+            Product(prodID=str(uuid4()), name="Product " + str(i), description="Generated product.", price="9.99",
+                    colour="Black", type="Shirts", available=True, new=False)
+            for i in range(size)
+        ]
+        Product.objects.bulk_create(products, batch_size=500)
+        for product in products[0:5]:
+            Watchlist.objects.create(watchlist_referenceID=str(uuid4()), userID=self.customer, prodID=product)
+
+    def assertWatchlistQueries(self, size):
+        self.addCatalog(size)
+        c = Client()
+
+        # One query for the catalog version, one for the customer and one joined query for the watchlist.
+        with self.assertNumQueries(3):
+            res = c.get("/api/watchlist/" + self.token + "/get")
+        self.assertEqual(len(res.json()), 5)
+        product, reference = res.json()[0]
+        self.assertEqual(product['prodID'], reference['prodID_id'])
+        self.assertEqual(reference['userID_id'], self.customer.userID)
+
+        # The customer is cached now, so one query for the catalog version, one for the count and one for the page.
+        with self.assertNumQueries(3):
+            res = c.get("/api/watchlist/" + self.token + "/get/2?limit=2")
+        self.assertEqual(res.json()['count'], 5)
+        self.assertEqual(res.json()['numPages'], 3)
+        self.assertEqual(len(res.json()['results']), 2)
+
+    def test_query_count_10_products(self):
+        self.assertWatchlistQueries(10)
+
+    def test_query_count_1k_products(self):
+        self.assertWatchlistQueries(1000)
+
+    def test_query_count_100k_products(self):
+        self.assertWatchlistQueries(100000)
+
+
+
+class WatchlistBatchTests(TestCase):
+    """ A batch of watchlist changes should run in a fixed number of queries and be safe to replay. """
+
+    def setUp(self):
+        userIDCache.clear()
+        self.customer = Customer.objects.get(name="M E")
+        self.products = list(Product.objects.exclude(watchlist__userID=self.customer).order_by("prodID").values_list("prodID", flat=True))
+
+    def change(self, payload):
+        payload = dict(payload, email=self.customer.email)
+        return Client().get("/api/watchlist/" + encode(payload, os.environ['JWT_SECRET'], algorithm="HS256"))
+
+    def test_batch_add_and_remove(self):
+        existing = Watchlist.objects.get(userID=self.customer).prodID_id
+        operations = [{"prodID": prodID, "process": "add"} for prodID in self.products[0:10]]
+        operations += [{"prodID": existing, "process": "remove"}, {"prodID": "missing-product", "process": "add"}]
+
+        userIDForEmail(self.customer.email)
+        # The savepoint, the write lock, the product and watchlist lookups, one insert, the delete's select and
+        # delete, the version bump, the watchCount update and the release.
+        with self.assertNumQueries(10):
+            res = self.change({"operations": operations})
+        results = [entry['result'] for entry in res.json()['results']]
+        self.assertEqual(results, ["added"] * 10 + ["removed", "notFound"])
+        self.assertEqual(set(Watchlist.objects.filter(userID=self.customer).values_list("prodID", flat=True)), set(self.products[0:10]))
+
+        # Replaying the same batch changes nothing.
+        res = self.change({"operations": operations})
+        self.assertEqual([entry['result'] for entry in res.json()['results']], ["unchanged"] * 11 + ["notFound"])
+        self.assertEqual(Watchlist.objects.filter(userID=self.customer).count(), 10)
+
+    def test_batch_bumps_watchlist_etag(self):
+        c = Client()
+        token = encode({"email": self.customer.email}, os.environ['JWT_SECRET'], algorithm="HS256")
+        etag = c.get("/api/watchlist/" + token + "/get")['ETag']
+        self.change({"operations": [{"prodID": self.products[0], "process": "add"}]})
+        res = c.get("/api/watchlist/" + token + "/get", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(self.products[0], [entry[0]['prodID'] for entry in res.json()])
+
+    def test_last_operation_wins(self):
+        prodID = self.products[0]
+        res = self.change({"operations": [{"prodID": prodID, "process": "add"}, {"prodID": prodID, "process": "remove"}]})
+        self.assertEqual([entry['result'] for entry in res.json()['results']], ["superseded", "unchanged"])
+        self.assertFalse(Watchlist.objects.filter(userID=self.customer, prodID=prodID).exists())
+
+    def test_single_operation_form(self):
+        self.assertEqual(self.change({"prodID": self.products[0], "process": "add"}).json(), ["Done"])
+        self.assertEqual(self.change({"prodID": self.products[0], "process": "add"}).json(), ["Done"])
+        self.assertEqual(self.change({"prodID": "missing-product", "process": "add"}).json(), {})
+        self.assertEqual(Watchlist.objects.filter(userID=self.customer, prodID=self.products[0]).count(), 1)
+        self.assertEqual(self.change({"prodID": self.products[0], "process": "remove"}).json(), ["Done"])
+        self.assertFalse(Watchlist.objects.filter(userID=self.customer, prodID=self.products[0]).exists())
+
+    def test_invalid_batches(self):
+        for operations in [[], "add", [{"prodID": self.products[0], "process": "move"}], [{"process": "add"}],
+                           [{"prodID": self.products[0], "process": "add"}] * (MAX_WATCHLIST_OPERATIONS + 1)]:
+            res = self.change({"operations": operations})
+            self.assertEqual(res.status_code, 400)
+        self.assertEqual(Watchlist.objects.filter(userID=self.customer).count(), 1)
+
+
+
+class WatchCountTests(TestCase):
+    """ Each product's watchCount should match the number of watchlists it's on, however they were changed. """
+
+    def setUp(self):
+        userIDCache.clear()
+        responseCache.clear()
+        self.customer = Customer.objects.get(name="M E")
+        self.products = list(Product.objects.exclude(watchlist__userID=self.customer).order_by("prodID").values_list("prodID", flat=True))
+
+    def change(self, payload):
+        payload = dict(payload, email=self.customer.email)
+        return Client().get("/api/watchlist/" + encode(payload, os.environ['JWT_SECRET'], algorithm="HS256"))
+
+    def assertCountsMatch(self):
+        for prodID, watchCount in Product.objects.values_list("prodID", "watchCount"):
+            self.assertEqual(watchCount, Watchlist.objects.filter(prodID=prodID).count(), prodID)
+
+    def test_migration_counted_existing_watchlists(self):
+        self.assertTrue(Watchlist.objects.exists())
+        self.assertCountsMatch()
+
+    def test_endpoint_changes(self):
+        before = Product.objects.get(prodID=self.products[0]).watchCount
+        self.change({"prodID": self.products[0], "process": "add"})
+        self.assertEqual(Product.objects.get(prodID=self.products[0]).watchCount, before + 1)
+
+        existing = Watchlist.objects.get(userID=self.customer, prodID=self.products[0]).prodID_id
+        operations = [{"prodID": prodID, "process": "add"} for prodID in self.products[0:5]]
+        operations.append({"prodID": existing, "process": "remove"})
+        self.change({"operations": operations})
+        self.assertCountsMatch()
+
+        # Replays and removing products that aren't on the watchlist leave the counts alone.
+        self.change({"operations": operations})
+        self.change({"prodID": self.products[9], "process": "remove"})
+        self.assertCountsMatch()
+
+    def test_orm_changes(self):
+        product = Product.objects.get(prodID=self.products[0])
+        entry = Watchlist.objects.create(watchlist_referenceID=str(uuid4()), userID=self.customer, prodID=product)
+        self.assertEqual(Product.objects.get(prodID=product.prodID).watchCount, product.watchCount + 1)
+        entry.delete()
+        self.assertEqual(Product.objects.get(prodID=product.prodID).watchCount, product.watchCount)
+
+    def test_detail_and_listing_follow_counts(self):
+        c = Client()
+        self.assertEqual(c.get("/api/product/" + self.products[0]).json()[0]['watchCount'], 0)
+        etag = c.get("/api/products/desc/watchCount")['ETag']
+        self.change({"prodID": self.products[0], "process": "add"})
+        self.assertEqual(c.get("/api/product/" + self.products[0]).json()[0]['watchCount'], 1)
+
+        res = c.get("/api/products/desc/watchCount", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        expected = list(Product.objects.order_by("-watchCount", "-prodID").values_list("prodID", flat=True))
+        self.assertEqual([product['prodID'] for product in res.json()], expected)
+
+    def test_other_responses_unaffected(self):
+        c = Client()
+        listing = c.get("/api/products/asc/price")
+        watched = c.get("/api/products/desc/watchCount")
+        self.change({"prodID": self.products[0], "process": "add"})
+
+        # Only the listings sorted by watchCount and the changed product's detail are rebuilt.
+        with self.assertNumQueries(0):
+            self.assertEqual(c.get("/api/products/asc/price", HTTP_IF_NONE_MATCH=listing['ETag']).status_code, 304)
+        self.assertNotEqual(c.get("/api/products/desc/watchCount")['ETag'], watched['ETag'])
+        self.assertEqual(c.get("/api/products/desc/watchCount/new=Yes")['ETag'], c.get("/api/products/desc/watchCount")['ETag'])
+        self.assertNotIn(("watchCount", 1), [(key, value) for row in listing.json() for key, value in row.items()])
+
+    def test_rebuild_command(self):
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE productDetails_product SET watchCount = 7")
+        output = StringIO()
+        call_command("rebuild_watch_counts", stdout=output)
+        self.assertIn("Corrected " + str(Product.objects.count()) + " watch counts", output.getvalue())
+        self.assertCountsMatch()
+
+        output = StringIO()
+        call_command("rebuild_watch_counts", stdout=output)
+        self.assertIn("Corrected 0 watch counts", output.getvalue())
+
+
+
+class ProductPaginationTests(TestCase):
+    """ Keyset pagination should walk the listing in order in both directions without OFFSET scans. """
+
+    def walkPages(self, url, limit):
+        c = Client()
+        pages = []
+        res = c.get(url, {"limit": limit}).json()
+        pages.append(res)
+        while res['next'] is not None:
+            res = c.get(url, {"limit": limit, "cursor": res['next']}).json()
+            pages.append(res)
+        return pages
+
+    def expectedOrder(self, products, field, sortType):
+        ids = list(products.order_by(field, "prodID").values_list("prodID", flat=True))
+        return ids[::-1] if sortType == "desc" else ids
+
+    def test_forward_and_backward_walk(self):
+        c = Client()
+        for sortType in ["asc", "desc"]:
+            for field in ["price", "prodID", "available"]:
+                url = "/api/products/" + sortType + "/" + field
+                pages = self.walkPages(url, 4)
+                walked = [product['prodID'] for page in pages for product in page['results']]
+                self.assertListEqual(walked, self.expectedOrder(Product.objects.all(), field, sortType))
+                self.assertIsNone(pages[0]['prev'])
+
+                # Walking back from the last page should return the same pages in reverse.
+                res = pages[-1]
+                for page in reversed(pages[0:-1]):
+                    res = c.get(url, {"limit": 4, "cursor": res['prev']}).json()
+                    self.assertListEqual(res['results'], page['results'])
+                self.assertIsNone(res['prev'])
+
+    def test_filtered_walk(self):
+        pages = self.walkPages("/api/products/desc/price/type=Shirts&available=Yes", 3)
+        walked = [product['prodID'] for page in pages for product in page['results']]
+        expected = self.expectedOrder(Product.objects.filter(type="Shirts", available=True), "price", "desc")
+        self.assertListEqual(walked, expected)
+
+    def test_no_offset_scans(self):
+        c = Client()
+        res = c.get("/api/products/asc/price", {"limit": 5}).json()
+        with CaptureQueriesContext(connection) as queries:
+            c.get("/api/products/asc/price", {"limit": 5, "cursor": res['next']})
+        productQueries = [query['sql'] for query in queries if "productDetails_product" in query['sql']]
+        self.assertEqual(len(productQueries), 1)
+        self.assertNotIn("OFFSET", productQueries[0])
+
+    def test_invalid_requests(self):
+        c = Client()
+        self.assertEqual(c.get("/api/products/asc/price", {"limit": "many"}).status_code, 400)
+        self.assertEqual(c.get("/api/products/asc/price", {"limit": 5, "cursor": "not-a-cursor"}).status_code, 400)
+
+        # A cursor from one sort order can't be used on another.
+        cursor = c.get("/api/products/asc/price", {"limit": 5}).json()['next']
+        self.assertEqual(c.get("/api/products/desc/price", {"limit": 5, "cursor": cursor}).status_code, 400)
+
+        # Unpaginated listings are unchanged.
+        self.assertEqual(len(c.get("/api/products/asc/price").json()), 17)
+
+    def test_cursor_values_are_type_checked(self):
+        c = Client()
+        def cursor(field, value, prodID="x"):
+            data = {"f": field, "s": "asc", "d": "next", "v": value, "id": prodID}
+            return urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+        invalid = [("price", value) for value in ["abc", {"x": 1}, [1], None, 5, "NaN", "Infinity", "1e999"]]
+        invalid += [("available", "Yes"), ("available", 1), ("name", 3), ("watchCount", "2"), ("watchCount", True)]
+        for field, value in invalid:
+            with self.subTest(field=field, value=value):
+                res = c.get("/api/products/asc/" + field, {"limit": 5, "cursor": cursor(field, value)})
+                self.assertEqual(res.status_code, 400)
+                self.assertIn("error", res.json())
+        self.assertEqual(c.get("/api/products/asc/price", {"limit": 5, "cursor": cursor("price", "7.99", 5)}).status_code, 400)
+
+        for field, value in [("price", "7.99"), ("available", True), ("name", "M"), ("watchCount", 0)]:
+            with self.subTest(field=field, value=value):
+                self.assertEqual(c.get("/api/products/asc/" + field, {"limit": 5, "cursor": cursor(field, value)}).status_code, 200)
+
+
+
+class ResponseCacheTests(TestCase):
+    """ Catalog responses should be served from the cache until a relevant write invalidates them. """
+
+    def setUp(self):
+        responseCache.clear()
+
+    def test_repeat_requests_hit_cache(self):
+        c = Client()
+        first = c.get("/api/products/asc/price/type=Shirts&available=Yes")
+        hits = responseCache.stats()['hits']
+        with self.assertNumQueries(0):
+            second = c.get("/api/products/asc/price/available=Yes&type=Shirts&")
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(responseCache.stats()['hits'], hits + 1)
+
+    def test_product_write_invalidates_only_product_entries(self):
+        c = Client()
+        product = Product.objects.order_by("prodID").first()
+        other = Product.objects.order_by("prodID").last()
+        c.get("/api/products/asc/prodID")
+        c.get("/api/product/" + product.prodID)
+        c.get("/api/product/" + other.prodID)
+        c.get("/api/countries")
+
+        product.name = "Renamed Product"
+        product.save()
+
+        # Each rebuilt response costs a catalog version lookup plus its own query.
+        with self.assertNumQueries(4):
+            self.assertEqual(c.get("/api/product/" + product.prodID).json()[0]['name'], "Renamed Product")
+            self.assertIn("Renamed Product", [p['name'] for p in c.get("/api/products/asc/prodID").json()])
+        with self.assertNumQueries(0):
+            c.get("/api/product/" + other.prodID)
+            c.get("/api/countries")
+
+    def test_country_write_invalidates_countries(self):
+        c = Client()
+        self.assertEqual(len(c.get("/api/countries").json()), 1)
+        Country.objects.create(countryID=str(uuid4()), name="France")
+        self.assertEqual(len(c.get("/api/countries").json()), 2)
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(2)
+        cache.set("a", b"1", ["x"])
+        cache.set("b", b"2", ["x"])
+        cache.get("a")
+        cache.set("c", b"3", ["y"])
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"1")
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+        cache.invalidate("y")
+        self.assertIsNone(cache.get("c"))
+        self.assertEqual(cache.stats()['size'], 1)
+
+
+
+class FilterPlannerTests(TestCase):
+    """ Filter strings should be normalized, validated and compiled into one shared plan. """
+
+    def test_equivalent_filters_share_plan(self):
+        plan = planFilter("type=Shirts&colour=black|white&price=5,10&available=Yes")
+        self.assertIs(planFilter("colour=White|Black&available=yes&price=5.00,10&type=Shirts&"), plan)
+        self.assertEqual(plan.canonical, "type=Shirts&colour=Black|White&price=5,10&available=Yes")
+        self.assertEqual(planFilter("price=0e999999,1E+3").canonical, "price=0,1000")
+        self.assertEqual(planFilter("price=0.000001,9999999999.50").canonical, "price=0.000001,9999999999.5")
+
+    def test_filtered_results(self):
+        c = Client()
+        res = c.get("/api/products/asc/price/type=Shirts&colour=black|white&available=Yes").json()
+        expected = Product.objects.filter(type="Shirts", colour__in=["Black", "White"], available=True)
+        self.assertListEqual(sorted(p['prodID'] for p in res), sorted(expected.values_list("prodID", flat=True)))
+
+        res = c.get("/api/products/asc/price/price=6,8&new=No").json()
+        self.assertEqual(len(res), len(Product.objects.filter(price__gte=6, price__lte=8, new=False)))
+        self.assertTrue(all(6 <= float(p['price']) <= 8 for p in res))
+
+    def test_malformed_filters(self):
+        c = Client()
+        for filterData in ["price", "price=5", "price=ten,20", "price=20,5", "available=Maybe", "size=XL", "type=Shirts&type=Formal", "colour=red||blue",
+                           "price=0,1e999999", "price=-1e30,5", "price=0,0.0000001", "price=0,1" + "0" * 10]:
+            res = c.get("/api/products/asc/price/" + filterData)
+            self.assertEqual(res.status_code, 400, filterData)
+            self.assertEqual(res.json()['error'], "Invalid filter.")
+            self.assertIn("detail", res.json())
+
+
+
+
+class ConditionalGetTests(TestCase):
+    """ Read endpoints should emit validators and answer matching conditional requests with a 304. """
+
+    def setUp(self):
+        responseCache.clear()
+
+    def test_etag_round_trip(self):
+        c = Client()
+        for url in ["/api/products/asc/price", "/api/products/asc/price/type=Shirts", "/api/countries",
+                    "/api/product/" + Product.objects.first().prodID]:
+            res = c.get(url)
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(res.has_header("ETag"))
+            self.assertTrue(res.has_header("Last-Modified"))
+
+            # Answered from the response cache without touching the database.
+            with self.assertNumQueries(0):
+                self.assertEqual(c.get(url, HTTP_IF_NONE_MATCH=res['ETag']).status_code, 304)
+
+            # Answered from a catalog version lookup alone once the cache is cold.
+            responseCache.clear()
+            with self.assertNumQueries(2):
+                self.assertEqual(c.get(url, HTTP_IF_NONE_MATCH=res['ETag']).status_code, 304)
+                self.assertEqual(c.get(url, HTTP_IF_MODIFIED_SINCE=res['Last-Modified']).status_code, 304)
+
+    def test_writes_change_etag(self):
+        c = Client()
+        products = c.get("/api/products/asc/prodID")
+        countries = c.get("/api/countries")
+
+        product = Product.objects.first()
+        product.price = "1.99"
+        product.save()
+
+        res = c.get("/api/products/asc/prodID", HTTP_IF_NONE_MATCH=products['ETag'])
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res['ETag'], products['ETag'])
+        self.assertEqual(c.get("/api/countries", HTTP_IF_NONE_MATCH=countries['ETag']).status_code, 304)
+
+    def test_watchlist_etag(self):
+        customer = Customer.objects.get(name="M E")
+        token = encode({"email": customer.email}, os.environ['JWT_SECRET'], algorithm="HS256")
+        c = Client()
+        res = c.get("/api/watchlist/" + token + "/get")
+        self.assertEqual(c.get("/api/watchlist/" + token + "/get", HTTP_IF_NONE_MATCH=res['ETag']).status_code, 304)
+
+        Watchlist.objects.filter(userID=customer).delete()
+        res = c.get("/api/watchlist/" + token + "/get", HTTP_IF_NONE_MATCH=res['ETag'])
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json(), [])
+
+
+
+
+class QueryPlanTests(TestCase):
+    """ The queries behind every route should be answered through indexes. """
+
+    def test_no_full_table_scans(self):
+        output = StringIO()
+        call_command("explain_routes", "--fail-on-scan", stdout=output)
+        self.assertIn("No full table scans found.", output.getvalue())
+        self.assertIn("USING INDEX product_type_price_idx", output.getvalue())
+
+
+
+class ProductSearchTests(TestCase):
+    """ Searches should go through the FTS5 index, stay in sync with product writes and combine with filters and sorts. """
+
+    def setUp(self):
+        responseCache.clear()
+        self.product = Product.objects.create(prodID=str(uuid4()), name="Searchable Linen Overshirt", description="A breathable summer layer.",
+                                              price="24.50", colour="White", type="Shirts", available=True, new=True)
+
+    def search(self, path, **params):
+        return Client().get("/api/search/" + path, params)
+
+    def test_ranked_search(self):
+        res = self.search("linen overshirt")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()[0]['prodID'], self.product.prodID)
+
+        # The last word is matched as a prefix, and punctuation or FTS5 syntax in the text is ignored.
+        self.assertIn(self.product.prodID, [product['prodID'] for product in self.search("overs").json()])
+        self.assertIn(self.product.prodID, [product['prodID'] for product in self.search('breathable" (summ').json()])
+        self.assertEqual(self.search("nothing-matches-this").json(), [])
+        self.assertEqual(self.search("%20-%20").status_code, 400)
+
+    def test_name_ranked_above_description(self):
+        other = Product.objects.create(prodID=str(uuid4()), name="Plain Tee", description="Not an overshirt, but similar to the searchable one.",
+                                       price="9.00", colour="Black", type="Shirts", available=True, new=False)
+        results = [product['prodID'] for product in self.search("searchable").json()]
+        self.assertEqual(results[0:2], [self.product.prodID, other.prodID])
+        self.assertEqual(len(self.search("searchable", limit=1).json()), 1)
+
+    def test_index_follows_writes(self):
+        self.product.name = "Renamed Denim Jacket"
+        self.product.save()
+        self.assertEqual(self.search("overshirt").json(), [])
+        self.assertEqual(self.search("denim jacket").json()[0]['prodID'], self.product.prodID)
+
+        self.product.delete()
+        self.assertEqual(self.search("denim jacket").json(), [])
+
+    def test_raw_sql_writes_are_indexed(self):
+        # Updates that bypass the ORM, like import_products' upserts, go through the triggers too.
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE productDetails_product SET name = %s WHERE prodID = %s", ["Corduroy Blazer", self.product.prodID])
+        responseCache.clear()
+        self.assertEqual(self.search("corduroy").json()[0]['prodID'], self.product.prodID)
+
+        output = StringIO()
+        call_command("rebuild_search_index", stdout=output)
+        self.assertIn("Indexed " + str(Product.objects.count()) + " products", output.getvalue())
+        self.assertEqual(self.search("corduroy").json()[0]['prodID'], self.product.prodID)
+
+    def test_sorted_search_breaks_ties_on_prodID(self):
+        for prodID in ["tie-c", "tie-a", "tie-b"]:
+            Product.objects.create(prodID=prodID, name="Tied Corduroy Trousers", description="", price="19.99",
+                                   colour="Brown", type="Trousers", available=True, new=False)
+        for sortType, expected in [("asc", ["tie-a", "tie-b", "tie-c"]), ("desc", ["tie-c", "tie-b", "tie-a"])]:
+            results = [product['prodID'] for product in self.search("corduroy/" + sortType + "/price").json()]
+            self.assertEqual(results, expected)
+            listing = Client().get("/api/products/" + sortType + "/price/price=19.99,19.99").json()
+            self.assertEqual([product['prodID'] for product in listing if product['prodID'].startswith("tie-")], expected)
+
+    def test_sorted_and_filtered_search(self):
+        matching = Product.objects.filter(Q(name__iregex=r"\bshirt") | Q(description__iregex=r"\bshirt"))
+        expected = list(matching.order_by("price").values_list("prodID", flat=True))
+        results = [product['prodID'] for product in self.search("shirt/asc/price").json()]
+        self.assertEqual(sorted(results), sorted(expected))
+        prices = [Decimal(product['price']) for product in self.search("shirt/asc/price").json()]
+        self.assertEqual(prices, sorted(prices))
+
+        res = self.search("overshirt/desc/price/colour=White&new=Yes")
+        self.assertEqual([product['prodID'] for product in res.json()], [self.product.prodID])
+        self.assertEqual(self.search("overshirt/desc/price/colour=Black").json(), [])
+        self.assertEqual(self.search("shirt/asc/price/colour=").status_code, 400)
+
+        page = self.search("shirt/asc/price", limit=2).json()
+        self.assertEqual([product['prodID'] for product in page['results']], list(matching.order_by("price", "prodID").values_list("prodID", flat=True))[0:2])
+
+
+
+class SearchIndexMigrationTests(TransactionTestCase):
+    """ The search index should survive a migration that remakes the product table.
+
+    SQLite can't change the schema inside the test's transaction, so these tests commit, and the test database is
+    restored afterwards.
+    """
+
+    serialized_rollback = True
+
+    def remakeProductTable(self):
+        # Making a NOT NULL column nullable (and back) is one of the changes SQLite can only make by copying the table.
+        old = Product._meta.get_field("description")
+        new = models.TextField(null=True)
+        new.set_attributes_from_name("description")
+        with connection.schema_editor() as editor:
+            editor.alter_field(Product, old, new)
+            editor.alter_field(Product, new, old)
+
+    def test_index_restored_after_migrate(self):
+        # Deleting a product leaves a gap in the rowids, which the copied table doesn't have.
+        Product.objects.create(prodID="search-gap", name="Removed Gabardine Coat", description="", price="50.00",
+                               colour="Beige", type="Coats", available=True, new=False)
+        kept = Product.objects.create(prodID="search-kept", name="Kept Chambray Shirt", description="", price="30.00",
+                                      colour="Blue", type="Shirts", available=True, new=False)
+        Product.objects.filter(prodID="search-gap").delete()
+
+        self.remakeProductTable()
+        call_command("migrate", verbosity=0)
+
+        responseCache.clear()
+        self.assertEqual([product['prodID'] for product in Client().get("/api/search/chambray").json()], [kept.prodID])
+        self.assertEqual(Client().get("/api/search/gabardine").json(), [])
+
+        added = Product.objects.create(prodID="search-added", name="Added Seersucker Shorts", description="", price="20.00",
+                                       colour="Blue", type="Shorts", available=True, new=True)
+        responseCache.clear()
+        self.assertEqual([product['prodID'] for product in Client().get("/api/search/seersucker").json()], [added.prodID])
+
+
+class ProductFacetTests(TestCase):
+    """ Facet counts should match the filtered listing, come from one query and be cached per canonical filter. """
+
+    def setUp(self):
+        responseCache.clear()
+
+    def expectedFacets(self, products):
+        products = list(products)
+        counts = {name: {} for name in ("colour", "type", "available", "new")}
+        for product in products:
+            for name in counts:
+                value = getattr(product, name)
+                value = ("Yes" if value else "No") if isinstance(value, bool) else value
+                counts[name][value] = counts[name].get(value, 0) + 1
+        counts["count"] = len(products)
+        return counts
+
+    def test_counts_match_listing(self):
+        c = Client()
+        for url, products in [("/api/facets", Product.objects.all()),
+                              ("/api/facets/type=Shirts&available=Yes", Product.objects.filter(type="Shirts", available=True))]:
+            res = c.get(url).json()
+            for name, counts in self.expectedFacets(products).items():
+                self.assertEqual(res[name], counts)
+
+            # Each price bucket's range works as a price filter that selects exactly the products it counted.
+            self.assertEqual(sum(bucket['count'] for bucket in res['price']), res['count'])
+            for bucket in res['price']:
+                minPrice, maxPrice = bucket['range'].split(",")
+                self.assertEqual(bucket['count'], products.filter(price__gte=minPrice, price__lte=maxPrice).count())
+
+    def test_single_query_and_cached_per_canonical_filter(self):
+        c = Client()
+        # One query for the catalog version and one grouped query for every facet.
+        with self.assertNumQueries(2):
+            res = c.get("/api/facets/colour=white|black&new=yes")
+        self.assertEqual(res.json()['filter'], "colour=Black|White&new=Yes")
+
+        with self.assertNumQueries(0):
+            self.assertEqual(c.get("/api/facets/new=Yes&colour=Black|White").json(), res.json())
+
+        self.assertEqual(c.get("/api/facets/colour=").status_code, 400)
+
+
+
+class FastSerializerTests(TestCase):
+    """ The values_list serializer should produce exactly what the ModelSerializers produce. """
+
+    def assertSameBytes(self, serializerClass, fastSerializer, queryset):
+        expected = JsonResponse(serializerClass(queryset, many=True).data, safe=False).content
+        self.assertEqual(fastSerializer.encode(queryset), expected)
+
+    def test_byte_compatibility(self):
+        Product.objects.create(prodID=str(uuid4()), name="Café \"Quoted\" Shirt", description="Line\\nbreak", price="5",
+                               colour="Black", type="Shirts", available=False, new=True)
+        for field in ["prodID", "price", "name", "new"]:
+            self.assertSameBytes(ListedProductsSerializer, fastListedProductsSerializer, Product.objects.order_by(field))
+            self.assertSameBytes(DetailedProductSerializer, fastDetailedProductSerializer, Product.objects.order_by(field))
+        self.assertSameBytes(ListedProductsSerializer, fastListedProductsSerializer, Product.objects.none())
+        self.assertSameBytes(ListedCountriesSerializer, fastListedCountriesSerializer, Country.objects.order_by("name"))
+
+    def test_views_use_fast_path(self):
+        responseCache.clear()
+        c = Client()
+        res = c.get("/api/products/desc/price/type=Shirts")
+        expected = ListedProductsSerializer(Product.objects.filter(type="Shirts").order_by("price", "prodID").reverse(), many=True).data
+        self.assertEqual(res.content, JsonResponse(expected, safe=False).content)
+        self.assertEqual(res['Content-Type'], "application/json")
+
+
+
+class SparseFieldsetTests(TestCase):
+    """ ?fields= should narrow both the SQL and the output of the product endpoints. """
+
+    def setUp(self):
+        responseCache.clear()
+
+    def test_listing_fields(self):
+        c = Client()
+        with CaptureQueriesContext(connection) as queries:
+            res = c.get("/api/products/asc/price", {"fields": "prodID,price"})
+        expected = ListedProductsSerializer(Product.objects.order_by("price"), many=True, fields=["prodID", "price"]).data
+        self.assertEqual(res.content, JsonResponse(expected, safe=False).content)
+        self.assertEqual(list(res.json()[0]), ["prodID", "price"])
+
+        # Only the requested columns are read.
+        productQuery = [query['sql'] for query in queries.captured_queries if "productDetails_product" in query['sql']][0]
+        self.assertNotIn('"name"', productQuery)
+        self.assertNotIn('"colour"', productQuery)
+
+        # The output keeps the declared field order, whatever order the fields are asked for in.
+        res = c.get("/api/products/desc/name/type=Shirts", {"fields": "new,name", "stream": "1"})
+        self.assertEqual(list(json.loads(b"".join(res.streaming_content))[0]), ["name", "new"])
+
+    def test_paginated_and_detail_fields(self):
+        c = Client()
+        page = c.get("/api/products/asc/price", {"fields": "name", "limit": 3}).json()
+        self.assertEqual([list(product) for product in page['results']], [["name"]] * 3)
+        nextPage = c.get("/api/products/asc/price", {"fields": "name", "limit": 3, "cursor": page['next']}).json()
+        self.assertEqual([product['name'] for product in nextPage['results']],
+                         list(Product.objects.order_by("price", "prodID").values_list("name", flat=True)[3:6]))
+
+        product = Product.objects.order_by("prodID")[0]
+        res = c.get("/api/product/" + product.prodID, {"fields": "description,prodID"})
+        self.assertEqual(res.json(), [{"prodID": product.prodID, "description": product.description}])
+
+    def test_invalid_fields_rejected(self):
+        c = Client()
+        product = Product.objects.order_by("prodID")[0]
+        # description is a Product field, but not one the listings return.
+        for url, fields in [("/api/products/asc/price", "description"), ("/api/products/asc/price", "price,colour,unknown"),
+                            ("/api/products/asc/price", ""), ("/api/product/" + product.prodID, "watchlist")]:
+            res = c.get(url, {"fields": fields})
+            self.assertEqual(res.status_code, 400)
+            self.assertIn("fields must be", res.json()['error'])
+
+
+
+class StreamingListingTests(TestCase):
+    """ ?stream=1 should stream the same bytes as the buffered listing, one chunk at a time. """
+
+    def setUp(self):
+        responseCache.clear()
+
+    def test_stream_matches_buffered(self):
+        c = Client()
+        for url in ["/api/products/asc/price", "/api/products/desc/name/type=Shirts&available=Yes", "/api/products/asc/price/type=Jumpers"]:
+            buffered = c.get(url)
+            streamed = c.get(url, {"stream": "1"})
+            self.assertTrue(streamed.streaming)
+            self.assertEqual(b"".join(streamed.streaming_content), buffered.content)
+            self.assertTrue(streamed.has_header("ETag"))
+
+    def test_stream_is_chunked(self):
+        chunks = list(fastListedProductsSerializer.stream(Product.objects.order_by("prodID"), chunkSize=5))
+        # Opening bracket, 17 products in chunks of 5, closing bracket.
+        self.assertEqual(len(chunks), 6)
+        self.assertEqual(b"".join(chunks), fastListedProductsSerializer.encode(Product.objects.order_by("prodID")))
+
+
+
+@skipUnless(numpy, "NumPy isn't installed.")
+class ColumnarEngineTests(TestCase):
+    """ The columnar index should return exactly what the ORM listings return. """
+
+    FILTERS = ["", "type=Shirts", "colour=Black|White", "price=5,20", "price=7.99,7.99", "available=Yes&new=No",
+               "type=Jumpers&colour=Blue&price=0,100", "colour=Mauve", "type=Shirts&available=No&new=Yes"]
+    FIELDS = [None, ["prodID", "price"], ["new", "name"]]
+
+    def setUp(self):
+        responseCache.clear()
+        # Ties, unusual text and an integral price, to check the orderings and encodings match SQLite's.
+        for index, (name, price, colour) in enumerate([("Émile", "7.99", "Black"), ("a lower name", "7.99", "black"),
+                                                       ("Zed \"quoted\"", "12", "Blue"), ("Émile", "0.5", "White")]):
+            Product.objects.create(prodID="extra" + str(index), name=name, description="", price=price, colour=colour,
+                                   type="Shirts", available=index % 2 == 0, new=index % 3 == 0)
+
+    def ormListing(self, field, sortType, serializer, canonical):
+        products = Product.objects.all()
+        if canonical:
+            products = products.filter(planFilter(canonical).query)
+        products = products.order_by(*orderingKeys(field))
+        if sortType == "desc":
+            products = products.reverse()
+        return serializer.encode(products)
+
+    def assertMatchesORM(self, engine):
+        for field in COLUMNS:
+            for sortType in ["asc", "desc"]:
+                for canonical in self.FILTERS:
+                    for fields in self.FIELDS:
+                        serializer = fastListedProductsSerializer if fields is None else fastListedProductsSerializer.project(fields)
+                        with self.subTest(field=field, sortType=sortType, filter=canonical, fields=fields):
+                            self.assertEqual(engine.listing(field, sortType, serializer, canonical),
+                                             self.ormListing(field, sortType, serializer, canonical))
+
+    def test_matches_orm(self):
+        self.assertMatchesORM(ColumnarProducts())
+
+    def test_applies_committed_changes(self):
+        engine = ColumnarProducts()
+        with override_settings(COLUMNAR_ENGINE=True), patch("productDetails.columnar.productColumns", engine):
+            engine.listing("prodID", "asc", fastListedProductsSerializer)
+            with self.captureOnCommitCallbacks(execute=True):
+                product = Product.objects.get(prodID="extra0")
+                product.price, product.colour = "1.25", "Mauve"
+                product.save()
+                Product.objects.filter(prodID="extra1").delete()
+                Product.objects.create(prodID="extra9", name="New", description="", price="99.5", colour="Mauve",
+                                       type="Hats", available=True, new=True)
+        self.assertMatchesORM(engine)
+
+        # Writes that don't send signals are picked up once the index is marked stale.
+        Product.objects.filter(type="Jumpers").update(price="3.5")
+        engine.markStale()
+        self.assertMatchesORM(engine)
+
+    def test_applies_watch_count_changes(self):
+        engine = ColumnarProducts()
+        customer = Customer.objects.get(name="M E")
+        with override_settings(COLUMNAR_ENGINE=True), patch("productDetails.columnar.productColumns", engine):
+            engine.listing("watchCount", "asc", fastListedProductsSerializer)
+            with self.captureOnCommitCallbacks(execute=True):
+                Watchlist.objects.create(watchlist_referenceID=str(uuid4()), userID=customer, prodID_id="extra2")
+        self.assertEqual(engine.listing("watchCount", "desc", fastListedProductsSerializer),
+                         self.ormListing("watchCount", "desc", fastListedProductsSerializer, ""))
+
+        # Other workers' count changes only re-read the column, and only for listings sorted by it.
+        Product.objects.filter(prodID="extra3").update(watchCount=5)
+        engine.markCountsStale()
+        with self.assertNumQueries(0):
+            engine.listing("price", "asc", fastListedProductsSerializer)
+        self.assertMatchesORM(engine)
+
+    def test_views_skip_the_product_query(self):
+        c = Client()
+        urls = ["/api/products/desc/price", "/api/products/asc/colour/type=Shirts&available=Yes", "/api/products/asc/watchlist"]
+        expected = [c.get(url, {"fields": "name,price"}).content for url in urls]
+        responseCache.clear()
+
+        with override_settings(COLUMNAR_ENGINE=True), patch("productDetails.columnar.productColumns", ColumnarProducts()):
+            c.get(urls[0])
+            for url, content in zip(urls, expected):
+                with CaptureQueriesContext(connection) as queries:
+                    self.assertEqual(c.get(url, {"fields": "name,price"}).content, content)
+                productQueries = [query for query in queries.captured_queries if "productDetails_product" in query['sql']]
+                # Sorting on a relation falls back to the ORM.
+                self.assertEqual(len(productQueries), 1 if url.endswith("watchlist") else 0)
+
+
+
+class CoalescingTests(TestCase):
+    """ Identical concurrent listing requests should share one query and serialization. """
+
+    def setUp(self):
+        responseCache.clear()
+
+    def slowEncode(self, calls):
+        encode = ValuesListSerializer.encode
+        def slowEncode(serializer, queryset):
+            calls.append(queryset)
+            time.sleep(0.3)
+            return encode(serializer, queryset)
+        return slowEncode
+
+    def test_threads_share_one_build(self):
+        calls, responses = [], []
+        def fetch():
+            try:
+                responses.append(Client().get("/api/products/desc/price/type=Shirts"))
+            finally:
+                connections.close_all()
+
+        coalesced = singleFlight.stats()["coalesced"]
+        with patch.object(ValuesListSerializer, "encode", self.slowEncode(calls)):
+            threads = [threading.Thread(target=fetch) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(singleFlight.stats()["coalesced"], coalesced + 4)
+        self.assertEqual(len({(response.content, response['ETag']) for response in responses}), 1)
+        self.assertEqual(responses[0].content, Client().get("/api/products/desc/price/type=Shirts").content)
+        self.assertEqual(Client().get("/api/cache/stats").json()["coalescing"]["inFlight"], 0)
+
+    async def test_async_tasks_share_one_build(self):
+        calls = []
+        aencode = ValuesListSerializer.aencode
+        async def slowAencode(serializer, queryset):
+            calls.append(queryset)
+            await asyncio.sleep(0.3)
+            return await aencode(serializer, queryset)
+
+        with patch.object(ValuesListSerializer, "aencode", slowAencode):
+            responses = await asyncio.gather(*[AsyncClient().get("/api/async/products/asc/name") for _ in range(5)])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len({response.content for response in responses}), 1)
+
+    def test_across_workers(self):
+        temporary = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary.cleanup)
+        directory = temporary.name
+        shared = SharedResponses(directory)
+        etag = catalogValidators((PRODUCTS_SCOPE,))[0]
+        key = (cacheKey("products", {"sortType": "asc", "field": "price"}, QueryDict()), etag)
+        lockPath, _ = shared.paths(key)
+        os.makedirs(directory, exist_ok=True)
+
+        with override_settings(COALESCE_ACROSS_WORKERS="wait", COALESCE_DIR=directory):
+            # Another worker is building the listing, so this one waits for its response instead of querying.
+            with open(lockPath, "a+b") as lockFile:
+                fcntl.flock(lockFile, fcntl.LOCK_EX)
+                responses = []
+                def fetch():
+                    try:
+                        responses.append(Client().get("/api/products/asc/price"))
+                    finally:
+                        connections.close_all()
+                waiting = threading.Thread(target=fetch)
+                waiting.start()
+                time.sleep(0.1)
+                shared.write(key, (200, "application/json", b'["built by another worker"]', etag))
+            waiting.join()
+            self.assertEqual(responses[0].content, b'["built by another worker"]')
+            self.assertEqual(responses[0]['ETag'], etag)
+
+        with override_settings(COALESCE_ACROSS_WORKERS="stale", COALESCE_DIR=directory):
+            # After a write, a worker that finds the listing being rebuilt sends the old response with its old ETag.
+            Product.objects.filter(prodID=Product.objects.order_by("prodID")[0].prodID)[0].save()
+            responseCache.clear()
+            with open(lockPath, "a+b") as lockFile:
+                fcntl.flock(lockFile, fcntl.LOCK_EX)
+                res = Client().get("/api/products/asc/price")
+            self.assertEqual(res.content, b'["built by another worker"]')
+            self.assertEqual(res['ETag'], etag)
+            self.assertEqual(responseCache.stats()["size"], 0)
+
+            # Once nobody holds the lock, the listing is rebuilt and shared again.
+            res = Client().get("/api/products/asc/price")
+            self.assertNotEqual(res['ETag'], etag)
+            self.assertEqual(shared.read((key[0], res['ETag']))[0], True)
+
+    def test_shared_files_are_bounded(self):
+        temporary = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary.cleanup)
+        directory = temporary.name
+        shared = SharedResponses(directory, maxResponses=3)
+        etag = catalogValidators((PRODUCTS_SCOPE,))[0]
+        def key(query):
+            return (cacheKey("products", {"sortType": "asc", "field": "price"}, QueryDict(query)), etag)
+
+        # Parameters the views don't read share the listing's files.
+        self.assertEqual(shared.paths(key("x=1")), shared.paths(key("")))
+        self.assertNotEqual(shared.paths(key("limit=5"))[1], shared.paths(key(""))[1])
+        shared.write(key("x=1"), (200, "application/json", b"[]", etag))
+        self.assertEqual(shared.read(key("x=2"))[0], True)
+
+        with override_settings(COALESCE_ACROSS_WORKERS="wait", COALESCE_DIR=directory, COALESCE_MAX_RESPONSES=3):
+            for index in range(10):
+                Client().get("/api/products/asc/price", {"limit": index + 1, "junk": str(uuid4())})
+        names = os.listdir(directory)
+        self.assertEqual(len([name for name in names if name.endswith(".response")]), 3)
+        self.assertLessEqual(len([name for name in names if name.endswith(".lock")]), 10)
+        self.assertEqual(len(names), len([name for name in names if name.endswith((".response", ".lock"))]))
+
+
+
+class ImportProductsTests(TestCase):
+    """ import_products should upsert a CSV feed in batches and report what changed. """
+
+    def writeFeed(self, rows):
+        feed = tempfile.NamedTemporaryFile("w", suffix=".csv", newline="", delete=False)
+        with feed:
+            csv.writer(feed).writerows(rows)
+        self.addCleanup(os.remove, feed.name)
+        return feed.name
+
+    def importFeed(self, path, *args):
+        output = StringIO()
+        call_command("import_products", path, *args, stdout=output, stderr=StringIO())
+        return output.getvalue()
+
+    def test_upsert_and_summary(self):
+        existing = Product.objects.order_by("prodID")[0]
+        unchanged = Product.objects.order_by("prodID")[1]
+        newID = str(uuid4())
+        path = self.writeFeed([
+            ["prodID", "name", "description", "price", "colour", "type", "available", "new"],
+            [existing.prodID, "Updated Name", existing.description, "12.5", existing.colour, existing.type, "1", "0"],
+            [unchanged.prodID, unchanged.name, unchanged.description, str(unchanged.price), unchanged.colour, unchanged.type,
+             "1" if unchanged.available else "0", "1" if unchanged.new else "0"],
+            [newID, "New Product", "Brand new.", "3.99", "Red", "Shirts", "1", "1"],
+            ["bad-row", "Missing Columns"],
+            [str(uuid4()), "Bad Price", "Invalid.", "cheap", "Red", "Shirts", "1", "1"],
+        ])
+
+        output = self.importFeed(path, "--dry-run", "--batch-size", "2")
+        self.assertIn("inserted=1, updated=1, unchanged=1, removed=0, missing=15, invalid=2", output)
+        self.assertFalse(Product.objects.filter(prodID=newID).exists())
+
+        output = self.importFeed(path, "--batch-size", "2")
+        self.assertIn("inserted=1, updated=1, unchanged=1, removed=0, missing=15, invalid=2", output)
+        existing.refresh_from_db()
+        self.assertEqual(existing.name, "Updated Name")
+        self.assertEqual(str(existing.price), "12.50")
+        self.assertTrue(Product.objects.get(prodID=newID).new)
+
+        # Importing the same feed again changes nothing.
+        output = self.importFeed(path)
+        self.assertIn("inserted=0, updated=0, unchanged=3", output)
+
+    def test_caches_dropped_after_each_batch(self):
+        c = Client()
+        product = Product.objects.order_by("prodID")[0]
+        c.get("/api/product/" + product.prodID)
+        path = self.writeFeed([
+            [product.prodID, "Updated Name", product.description, str(product.price), product.colour, product.type, "1", "0"],
+            [str(uuid4()), "New Product", "Brand new.", "3.99", "Red", "Shirts", "1", "1"],
+        ])
+
+        # Responses read between batches already show the batches written so far.
+        names = []
+        importBatch = ImportProductsCommand.importBatch
+        def importAndRead(command, batch):
+            importBatch(command, batch)
+            names.append(c.get("/api/product/" + product.prodID).json()[0]['name'])
+        with patch.object(ImportProductsCommand, "importBatch", importAndRead):
+            self.importFeed(path, "--batch-size", "1")
+        self.assertEqual(names, ["Updated Name", "Updated Name"])
+
+    def test_delete_missing(self):
+        keep = Product.objects.order_by("prodID")[0]
+        path = self.writeFeed([[keep.prodID, keep.name, keep.description, str(keep.price), keep.colour, keep.type, "1", "1"]])
+        output = self.importFeed(path, "--delete-missing")
+        self.assertIn("removed=16", output)
+        self.assertListEqual(list(Product.objects.values_list("prodID", flat=True)), [keep.prodID])
+
+    def test_strict_mode(self):
+        path = self.writeFeed([["only", "three", "columns"]])
+        with self.assertRaises(CommandError):
+            self.importFeed(path, "--strict")
+
+
+
+
+class AuthCacheTests(TestCase):
+    """ Verified tokens and email lookups should be cached without outliving the token or the customer. """
+
+    def setUp(self):
+        tokenCache.clear()
+        userIDCache.clear()
+
+    def test_token_verified_once(self):
+        token = encode({"email": "cached@example.com"}, os.environ['JWT_SECRET'], algorithm="HS256")
+        with patch("productDetails.auth.decode", wraps=decode) as decodeSpy:
+            payload = decodeToken(token)
+            payload['userID'] = "changed by the caller"
+            self.assertEqual(decodeToken(token), {"email": "cached@example.com"})
+        self.assertEqual(decodeSpy.call_count, 1)
+
+    def test_expired_token_rejected(self):
+        token = encode({"email": "expiring@example.com", "exp": int(time.time()) + 1}, os.environ['JWT_SECRET'], algorithm="HS256")
+        decodeToken(token)
+        with patch("productDetails.auth.time.time", return_value=time.time() + 5):
+            with self.assertRaises(ExpiredSignatureError):
+                decodeToken(token)
+
+        with self.assertRaises(InvalidSignatureError):
+            decodeToken(encode({"email": "forged@example.com"}, "wrong-secret", algorithm="HS256"))
+
+    def test_user_id_cache(self):
+        customer = Customer.objects.get(name="M E")
+        with self.assertNumQueries(1):
+            self.assertEqual(userIDForEmail(customer.email), customer.userID)
+            self.assertEqual(userIDForEmail(customer.email), customer.userID)
+
+        # Unknown emails are looked up every time, so new customers are found straight away.
+        with self.assertNumQueries(2):
+            self.assertIsNone(userIDForEmail("nobody@example.com"))
+            self.assertIsNone(userIDForEmail("nobody@example.com"))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            newCustomer = Customer.objects.create(userID=str(uuid4()), name="New", email="new@example.com")
+        with self.assertNumQueries(0):
+            self.assertEqual(userIDForEmail("new@example.com"), newCustomer.userID)
+
+        newCustomer.delete()
+        with self.assertNumQueries(1):
+            self.assertIsNone(userIDForEmail("new@example.com"))
+
+
+
+class AsyncViewTests(TestCase):
+    """ The ASGI views should return exactly what their sync counterparts return. """
+
+    def setUp(self):
+        responseCache.clear()
+        userIDCache.clear()
+
+    async def test_same_bytes_as_sync(self):
+        product = await Product.objects.order_by("prodID").afirst()
+        for path in ["products/asc/price", "products/desc/name/type=Shirts&colour=black|white", "product/" + product.prodID, "countries"]:
+            responseCache.clear()
+            asyncResponse = await AsyncClient().get("/api/async/" + path)
+            responseCache.clear()
+            syncResponse = await sync_to_async(Client().get)("/api/" + path)
+            self.assertEqual(asyncResponse.status_code, 200)
+            self.assertEqual(asyncResponse.content, syncResponse.content)
+            self.assertEqual(asyncResponse['ETag'], syncResponse['ETag'])
+
+        res = await AsyncClient().get("/api/async/products/asc/price/colour=")
+        self.assertEqual(res.status_code, 400)
+
+        res = await AsyncClient().get("/api/async/products/asc/price", {"limit": 5})
+        self.assertEqual(len(res.json()['results']), 5)
+
+    async def test_watchlist(self):
+        customer = await Customer.objects.aget(name="M E")
+        product = await Product.objects.exclude(watchlist__userID=customer).afirst()
+        token = encode({"email": customer.email, "prodID": product.prodID, "process": "add"}, os.environ['JWT_SECRET'], algorithm="HS256")
+        c = AsyncClient()
+
+        before = len((await c.get("/api/async/watchlist/" + token + "/get")).json())
+        for _ in range(2):
+            self.assertEqual((await c.get("/api/async/watchlist/" + token)).json(), ["Done"])
+        watchlist = (await c.get("/api/async/watchlist/" + token + "/get")).json()
+        self.assertEqual(len(watchlist), before + 1)
+        self.assertIn(product.prodID, [entry[0]['prodID'] for entry in watchlist])
+
+        syncWatchlist = await sync_to_async(Client().get)("/api/watchlist/" + token + "/get")
+        self.assertEqual(syncWatchlist.json(), watchlist)
+
+
+def recordInWorker(store, route, requests):
+    for _ in range(requests):
+        store.record(route, 0.003, 0.001, 0.0005, 2, 100)
+
+
+class RequestMetricsTests(TestCase):
+    """ Each route's requests should be recorded once, and the numbers should add up across worker processes. """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.store = MetricsStore(self.directory, routeNames(), maxWorkers=4)
+        patcher = patch("productDetails.metrics._metricsStore", self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        responseCache.clear()
+
+    def sample(self, text, name, route):
+        line = next(line for line in text.splitlines() if line.startswith(name + '{route="' + route + '"'))
+        return float(line.rsplit(" ", 1)[1])
+
+    def test_requests_are_recorded(self):
+        c = Client()
+        listing = c.get("/api/products/asc/price")
+        c.get("/api/products/asc/price")
+        c.get("/no/such/route")
+
+        res = c.get("/metrics")
+        self.assertEqual(res["Content-Type"], PROMETHEUS_CONTENT_TYPE)
+        text = res.content.decode()
+        route = "Field Sorted Products Data"
+        self.assertEqual(self.sample(text, "productdetails_request_duration_seconds_count", route), 2)
+        self.assertEqual(self.sample(text, "productdetails_response_bytes_total", route), 2 * len(listing.content))
+        # The second request was answered from the response cache.
+        self.assertGreater(self.sample(text, "productdetails_db_queries_total", route), 0)
+        self.assertGreater(self.sample(text, "productdetails_serialization_duration_seconds_sum", route), 0)
+        self.assertEqual(self.sample(text, "productdetails_request_duration_seconds_count", "Other"), 1)
+        self.assertNotIn("Detailed Product Data", text)
+
+    def test_histogram_format(self):
+        self.store.record('Say "hi"', 0.003, 0, 0, 1, 10)
+        self.store.record('Say "hi"', 20, 0, 0, 1, 10)
+        text = self.store.export()
+        self.assertIn('productdetails_request_duration_seconds_bucket{route="Other",le="0.0025"} 0', text)
+        self.assertIn('productdetails_request_duration_seconds_bucket{route="Other",le="0.005"} 1', text)
+        self.assertIn('productdetails_request_duration_seconds_bucket{route="Other",le="10"} 1', text)
+        self.assertIn('productdetails_request_duration_seconds_bucket{route="Other",le="+Inf"} 2', text)
+        self.assertIn('productdetails_request_duration_seconds_sum{route="Other"} 20.003', text)
+        self.assertIn('# TYPE productdetails_db_queries_total counter', text)
+
+    def test_workers_share_the_metrics(self):
+        route = "Detailed Product Data"
+        context = multiprocessing.get_context("fork")
+        workers = [context.Process(target=recordInWorker, args=(self.store, route, 50)) for _ in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual([worker.exitcode for worker in workers], [0, 0, 0])
+
+        # A new worker, here a store opened on the same directory, sees the others' numbers and adds to them.
+        recordInWorker(MetricsStore(self.directory, routeNames(), maxWorkers=4), route, 1)
+        text = self.store.export()
+        self.assertEqual(self.sample(text, "productdetails_request_duration_seconds_count", route), 151)
+        self.assertEqual(self.sample(text, "productdetails_db_queries_total", route), 302)
+
+        # The exited workers' slots are taken over rather than running out.
+        workers = [context.Process(target=recordInWorker, args=(self.store, route, 1)) for _ in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(self.sample(self.store.export(), "productdetails_request_duration_seconds_count", route), 154)
@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import views, async_views
 
 urlpatterns = [
     path("", views.home, name = "Home"),
@@ -9,8 +9,26 @@ urlpatterns = [
     path("api/products/<str:sortType>/<str:field>/", views.removeEmptyFilter, name="Return From Empty Filter"),
     path("api/products/<str:sortType>/<str:field>/<str:filterData>", views.FilteredFieldSortedListedProductView.as_view(), name="Filtered And Field Sorted Products Data"),
     path("api/product/<str:id>", views.DetailedProductView.as_view(), name="Detailed Product Data"),
+    path("api/product/batch/<str:ids>", views.BatchProductView.as_view(), name="Batch Detailed Products Data"),
+    path("api/search/<str:query>", views.SearchedProductView.as_view(), name="Searched Products Data"),
+    path("api/search/<str:query>/<str:sortType>/<str:field>", views.SearchedProductView.as_view(), name="Field Sorted Searched Products Data"),
+    path("api/search/<str:query>/<str:sortType>/<str:field>/<str:filterData>", views.SearchedProductView.as_view(), name="Filtered And Field Sorted Searched Products Data"),
+    path("api/facets", views.ProductFacetsView.as_view(), name="Product Facet Counts"),
+    path("api/facets/<str:filterData>", views.ProductFacetsView.as_view(), name="Filtered Product Facet Counts"),
     path("api/countries", views.CountriesListView.as_view(), name="Name Ordered Countries List Data"),
+    path("api/cache/stats", views.cache_stats, name="Response Cache Stats"),
+    path("metrics", views.metrics, name="Metrics"),
+    path("customers/<str:accessID>/sync", views.sync_customers, name="Sync Customers"),
     path("customers/<str:accessID>/<str:jwt>", views.store_customer_details, name="Store Customer Details"),
     path("api/watchlist/<str:jwt>/get", views.get_watchlist_products, name="Get User Watchlist Products"),
+    path("api/watchlist/<str:jwt>/get/<int:page>", views.get_paginated_watchlist_products, name="Get Paginated User Watchlist Products"),
     path("api/watchlist/<str:jwt>", views.process_watchlist_change, name="Add/Remove Product in Watchlist"),
+
+    # ASGI-native versions of the read and watchlist endpoints, for deployments under an ASGI server.
+    path("api/async/products/<str:sortType>/<str:field>", async_views.field_sorted_products, name="Async Field Sorted Products Data"),
+    path("api/async/products/<str:sortType>/<str:field>/<str:filterData>", async_views.filtered_field_sorted_products, name="Async Filtered And Field Sorted Products Data"),
+    path("api/async/product/<str:id>", async_views.detailed_product, name="Async Detailed Product Data"),
+    path("api/async/countries", async_views.countries_list, name="Async Name Ordered Countries List Data"),
+    path("api/async/watchlist/<str:jwt>/get", async_views.get_watchlist_products, name="Async Get User Watchlist Products"),
+    path("api/async/watchlist/<str:jwt>", async_views.process_watchlist_change, name="Async Add/Remove Product in Watchlist"),
 ]
\ No newline at end of file
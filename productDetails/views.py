@@ -1,27 +1,81 @@
-from django.http import HttpResponseRedirect, JsonResponse
-from django.db.models import Q
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
+from django.core.paginator import Paginator
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from rest_framework.views import APIView
-from .models import Product, Customer, Country, Watchlist
-from .serializers import ListedProductsSerializer, DetailedProductSerializer, ListedCountriesSerializer
-from uuid import uuid4
-import os
-from jwt import decode
+from jwt.exceptions import InvalidTokenError
+from .models import Product, Country, Watchlist
+from .serializers import ListedProductsSerializer, fastListedProductsSerializer, fastDetailedProductSerializer, fastListedCountriesSerializer
+from .auth import decodeToken, userIDForEmail
+from .customers import InvalidCustomerRecords, parseCustomer, parseCustomerBatch, upsertCustomer, upsertCustomers
+from .cache import cachedResponse, listingTags, productTag, responseCache, PRODUCT_DETAILS, PRODUCT_LISTINGS, COUNTRIES
+from .coalescing import coalescedResponse, singleFlight
+from .columnar import columnarEngine
+from .conditional import conditionalResponse, popularityScopes, PRODUCTS_SCOPE, COUNTRIES_SCOPE, WATCHLISTS_SCOPE, POPULARITY_SCOPE
+from .facets import facetCounts
+from .filters import FilterError, planFilter
+from .metrics import PROMETHEUS_CONTENT_TYPE, metricsStore, timedSerialization
+from .pagination import InvalidPageRequest, keysetPage, orderingKeys, parseLimit
+from .search import SearchError, SEARCH_DEFAULT_LIMIT, rankedSearch, searchAvailable, searchExpression, searchProducts
+from .watchlist import InvalidWatchlistOperations, applyWatchlistOperations, parseOperations, watchlistChangeResponse
+from functools import lru_cache
+import json, os
+
+WATCHLIST_PAGE_SIZE = 20
+WATCHLIST_MAX_PAGE_SIZE = 100
+BATCH_MAX_PRODUCTS = 100
 
 class DetailedProductView(APIView):
     """ Display the full product information for one product only. """
 
+    @cachedResponse("product", lambda kwargs: [productTag(kwargs['id']), PRODUCT_DETAILS])
+    @method_decorator(conditionalResponse(PRODUCTS_SCOPE, POPULARITY_SCOPE))
     def get(self, request, *args, **kwargs):
         """ Display the full product information for one product only. """
 
         id = kwargs['id']
+        serializer = fieldSelection(request, fastDetailedProductSerializer)
+        if serializer is None:
+            return invalidFieldsResponse(fastDetailedProductSerializer)
+
         product = Product.objects.filter(prodID=id)
-        serializer = DetailedProductSerializer(product, many=True)
-        return JsonResponse(serializer.data, safe=False)
+        return HttpResponse(serializer.encode(product), content_type="application/json")
+
+
+class BatchProductView(APIView):
+    """ Display the full product information for several products, given as a comma separated list of IDs. """
+
+    @cachedResponse("product-batch", lambda kwargs: [productTag(id) for id in batchIDs(kwargs['ids'])] + [PRODUCT_DETAILS])
+    @method_decorator(conditionalResponse(PRODUCTS_SCOPE, POPULARITY_SCOPE))
+    def get(self, request, *args, **kwargs):
+        """ Display the full product information for several products, in the order their IDs were given. """
+
+        ids = batchIDs(kwargs['ids'])
+        if not ids or len(ids) > BATCH_MAX_PRODUCTS:
+            return JsonResponse({"error": "Between 1 and " + str(BATCH_MAX_PRODUCTS) + " product IDs must be given."}, status=400)
+
+        serializer = fieldSelection(request, fastDetailedProductSerializer)
+        if serializer is None:
+            return invalidFieldsResponse(fastDetailedProductSerializer)
+
+        # Every product in one IN query, read with prodID even when it isn't asked for so rows can be matched up.
+        names = serializer.names
+        query = serializer if "prodID" in names else fastDetailedProductSerializer.project(names + ["prodID"])
+        rows = {row["prodID"]: row for row in query.rows(Product.objects.filter(prodID__in=set(ids)))}
+
+        with timedSerialization():
+            results = [{name: rows[id][name] for name in names} if id in rows else {"prodID": id, "missing": True} for id in ids]
+            return HttpResponse(json.dumps(results, cls=DjangoJSONEncoder), content_type="application/json")
 
 
 class FieldSortedListedProductView(APIView):
     """ Display the list of products sorted upon the user's choice. """
 
+    @cachedResponse("products", listingTags)
+    @method_decorator(conditionalResponse(PRODUCTS_SCOPE, extraScopes=popularityScopes))
+    @coalescedResponse("products")
     def get(self, request, *args, **kwargs):
         """ Display the list of products sorted upon the user's choice. """
 
@@ -31,18 +85,37 @@ class FieldSortedListedProductView(APIView):
         # Check that all the data is valid.
         if not (validateSortType(sortType) and validateFieldEntered(field, Product)):
             return JsonResponse({}, safe=False)
-        
-        allProducts = Product.objects.all().order_by(field)
+
+        # Only fetch and return the fields asked for with ?fields=.
+        serializer = fieldSelection(request, fastListedProductsSerializer)
+        if serializer is None:
+            return invalidFieldsResponse(fastListedProductsSerializer)
+
+        # Opt-in cursor pagination when a page size is requested.
+        if "limit" in request.GET:
+            return paginatedProductsResponse(request, Product.objects.all(), field, sortType)
+
+        allProducts = Product.objects.all().order_by(*orderingKeys(field))
         
         if sortType == "desc":
             allProducts = allProducts.reverse()
 
-        serializer = ListedProductsSerializer(allProducts, many=True)
-        return JsonResponse(serializer.data, safe=False)
+        # Stream unbounded listings in chunks when asked to, keeping memory flat however many rows match.
+        if request.GET.get("stream") == "1":
+            return StreamingHttpResponse(serializer.stream(allProducts), content_type="application/json")
+
+        content = columnarListing(field, sortType, serializer)
+        if content is not None:
+            return HttpResponse(content, content_type="application/json")
+
+        return HttpResponse(serializer.encode(allProducts), content_type="application/json")
 
 class FilteredFieldSortedListedProductView(APIView):
     """ Display the list of chosen, filtered products sorted upon the user's choice. """
 
+    @cachedResponse("filtered-products", listingTags)
+    @method_decorator(conditionalResponse(PRODUCTS_SCOPE, extraScopes=popularityScopes))
+    @coalescedResponse("filtered-products")
     def get(self, request, *args, **kwargs):
         """ Display the list of chosen, filtered products sorted upon the user's choice. """
 
@@ -54,71 +127,127 @@ class FilteredFieldSortedListedProductView(APIView):
         if not (validateSortType(sortType) and validateFieldEntered(field, Product)) or filterData == "":
             return JsonResponse({}, safe=False)
 
-        # Remove the last character if there's an & character for better processing of filters.
-        if filterData[-1] == "&":
-            filterData = filterData[0:-1]
+        # Parse the filters into a single query, reusing the compiled plan of any equivalent filter string.
+        try:
+            filterPlan = planFilter(filterData)
+        except FilterError as error:
+            return JsonResponse(error.asDict(), status=400)
 
-        # Split filter data by the & and iterate through the list to process the filters.
-        filtersList = []
-        splitFilterData = filterData.split("&")
+        # Only fetch and return the fields asked for with ?fields=.
+        serializer = fieldSelection(request, fastListedProductsSerializer)
+        if serializer is None:
+            return invalidFieldsResponse(fastListedProductsSerializer)
 
-        # Colours will have their own set of filter parameters as they need an OR operator.
-        colourQueries = Q()
+        filteredProducts = Product.objects.filter(filterPlan.query)
 
-        # Process filter data.
-        for filter in splitFilterData:
-            filterName, filterValues = filter.split("=")
-            if filterName == "price":
-                minPrice, maxPrice = filterValues.split(",")
+        # Opt-in cursor pagination when a page size is requested.
+        if "limit" in request.GET:
+            return paginatedProductsResponse(request, filteredProducts, field, sortType)
 
-                priceFilterObjects = {}
-                priceFilterObjects[filterName + "__gte"] = minPrice
-                filtersList.append(priceFilterObjects)
+        filteredProducts = filteredProducts.order_by(*orderingKeys(field))
+
+        if sortType == "desc":
+            filteredProducts = filteredProducts.reverse()
 
-                priceFilterObjects = {}
-                priceFilterObjects[filterName + "__lte"] = maxPrice
-                filtersList.append(priceFilterObjects)
+        # Stream unbounded listings in chunks when asked to, keeping memory flat however many rows match.
+        if request.GET.get("stream") == "1":
+            return StreamingHttpResponse(serializer.stream(filteredProducts), content_type="application/json")
 
-            elif filterName == "colour":
-                coloursList = filterValues.split("|")
-                for colour in coloursList:
-                    colourQueries = colourQueries | Q(colour=str(colour).title())
+        content = columnarListing(field, sortType, serializer, filterPlan.canonical)
+        if content is not None:
+            return HttpResponse(content, content_type="application/json")
 
-            elif filterName == "available":
-                filtersList.append({"available": True if filterValues == "Yes" else False})
+        return HttpResponse(serializer.encode(filteredProducts), content_type="application/json")
 
-            elif filterName == "type":
-                filtersList.append({"type": filterValues})
+class SearchedProductView(APIView):
+    """ Search product names and descriptions, optionally sorted and filtered like the product listings. """
 
-            elif filterName == "new":
-                filtersList.append({"new": True if filterValues == "Yes" else False})
+    @cachedResponse("search", listingTags)
+    @method_decorator(conditionalResponse(PRODUCTS_SCOPE, extraScopes=popularityScopes))
+    @coalescedResponse("search")
+    def get(self, request, *args, **kwargs):
+        """ Search product names and descriptions, optionally sorted and filtered like the product listings. """
 
-        # Return data after applying normal filters (price, available, type, new).
-        filteredProducts = Product.objects.all()
-        for filter in filtersList:
-            filteredProducts = filteredProducts.filter(**filter)
+        if not searchAvailable():
+            return JsonResponse({"error": "Search is only available on SQLite."}, status=501)
 
-        # If colour filters aren't empty, apply them too.
-        if colourQueries != Q():
-            filteredProducts = filteredProducts.filter(colourQueries)
+        query = kwargs['query']
+        field = kwargs.get('field')
+        sortType = kwargs.get('sortType')
+        filterData = kwargs.get('filterData')
 
-        filteredProducts = filteredProducts.order_by(field)
+        if field is not None and not (validateSortType(sortType) and validateFieldEntered(field, Product)):
+            return JsonResponse({}, safe=False)
 
+        # Only fetch and return the fields asked for with ?fields=.
+        serializer = fieldSelection(request, fastListedProductsSerializer)
+        if serializer is None:
+            return invalidFieldsResponse(fastListedProductsSerializer)
+
+        products = Product.objects.all()
+        if filterData is not None:
+            try:
+                products = products.filter(planFilter(filterData).query)
+            except FilterError as error:
+                return JsonResponse(error.asDict(), status=400)
+
+        try:
+            searchExpression(query)
+        except SearchError as error:
+            return JsonResponse({"error": str(error)}, status=400)
+
+        # Without a sort field, return the best matches first, capped like a page.
+        if field is None:
+            try:
+                limit = parseLimit(request.GET.get("limit", SEARCH_DEFAULT_LIMIT))
+            except InvalidPageRequest as error:
+                return JsonResponse({"error": str(error)}, status=400)
+            return HttpResponse(serializer.encode(rankedSearch(products, query)[0:limit]), content_type="application/json")
+
+        # Sorted searches behave exactly like the listings, restricted to the matching products.
+        products = searchProducts(products, query)
+        if "limit" in request.GET:
+            return paginatedProductsResponse(request, products, field, sortType)
+
+        products = products.order_by(*orderingKeys(field))
         if sortType == "desc":
-            filteredProducts = filteredProducts.reverse()
+            products = products.reverse()
+
+        if request.GET.get("stream") == "1":
+            return StreamingHttpResponse(serializer.stream(products), content_type="application/json")
+
+        return HttpResponse(serializer.encode(products), content_type="application/json")
+
+class ProductFacetsView(APIView):
+    """ Count the products matching a filter per colour, type, availability, newness and price range. """
 
-        serializer = ListedProductsSerializer(filteredProducts, many=True)
-        return JsonResponse(serializer.data, safe=False)
+    @cachedResponse("facets", lambda kwargs: [PRODUCT_LISTINGS])
+    @method_decorator(conditionalResponse(PRODUCTS_SCOPE))
+    def get(self, request, *args, **kwargs):
+        """ Count the products matching a filter per colour, type, availability, newness and price range. """
+
+        products = Product.objects.all()
+        canonical = ""
+        if 'filterData' in kwargs:
+            try:
+                filterPlan = planFilter(kwargs['filterData'])
+            except FilterError as error:
+                return JsonResponse(error.asDict(), status=400)
+            products = products.filter(filterPlan.query)
+            canonical = filterPlan.canonical
+
+        return JsonResponse(dict(facetCounts(products), filter=canonical))
 
 class CountriesListView(APIView):
     """ Display the list of countries available. """
 
+    @cachedResponse("countries", lambda kwargs: [COUNTRIES])
+    @method_decorator(conditionalResponse(COUNTRIES_SCOPE))
     def get(self, request, *args, **kwargs):
         """ Display the list of countries available. """
 
         countries = Country.objects.all().order_by("name")
-        serializer = ListedCountriesSerializer(countries, many=True)
-        return JsonResponse(serializer.data, safe=False)
+        return HttpResponse(fastListedCountriesSerializer.encode(countries), content_type="application/json")
 
 def store_customer_details(request, accessID, jwt):
     """ Store the customer's new details. Updates the name of a returning user if needed. """
@@ -127,86 +256,110 @@ def store_customer_details(request, accessID, jwt):
     if accessID != os.environ['CUSTOMER_MODEL_URL_ACCESS']:
         return JsonResponse({})
 
-    # Decode data from JWT and get the email separately. keep the dictionary as it may be needed later.
-    decodedData = decode(jwt, os.environ['JWT_SECRET'], algorithms=['HS256'])
-    email = decodedData['email']
+    # Create the customer, or rename a returning one, in a single upsert on their email.
+    try:
+        upsertCustomer(*parseCustomer(decodeToken(jwt)))
+    except InvalidCustomerRecords as error:
+        return JsonResponse({"error": str(error)}, status=400)
 
-    # If not a registered user, use the dicitionary to add an ID and create a new customer.
-    if (len(Customer.objects.filter(email=email))) == 0:
-        decodedData['userID'] = str(uuid4())
-        newCustomer = Customer(**decodedData)
-        newCustomer.save()
+    return JsonResponse({})
 
-    # Check to see that the user's name is up to date. If not, update the user with that new name.
-    user_name_old = Customer.objects.filter(email=email).values_list("name")[0][0]
-    if user_name_old != decodedData['name']:
-        Customer.objects.filter(email=email).update(name=decodedData['name'])
+@csrf_exempt
+@require_POST
+def sync_customers(request, accessID):
+    """ Upsert a batch of customers from the identity service. The request body is a JWT of {"customers": [{"email", "name"}, ...]}. """
 
-    return JsonResponse({})
+    if accessID != os.environ['CUSTOMER_MODEL_URL_ACCESS']:
+        return JsonResponse({})
+
+    try:
+        customers = parseCustomerBatch(decodeToken(request.body.decode().strip()))
+    except (InvalidTokenError, UnicodeDecodeError):
+        return JsonResponse({"error": "The request body must be a signed JWT."}, status=400)
+    except InvalidCustomerRecords as error:
+        return JsonResponse({"error": str(error)}, status=400)
+
+    counts, userIDs = upsertCustomers(customers)
+    return JsonResponse(dict(counts, userIDs=userIDs))
 
 
 
+@conditionalResponse(PRODUCTS_SCOPE, WATCHLISTS_SCOPE, POPULARITY_SCOPE)
 def get_watchlist_products(request, jwt):
     """ Returns the list products that were starred by the user. """
 
     # Get the user ID using the email.
-    email = decode(jwt, os.environ['JWT_SECRET'], algorithms=['HS256'])['email']
-    customers = Customer.objects.filter(email=email).values()
-    if len(customers) == 0:
+    email = decodeToken(jwt)['email']
+    userID = userIDForEmail(email)
+    if userID is None:
         return JsonResponse({}, safe=False)
-    userID = customers[0]['userID']
 
-    # Return the user's watchlist.
-    watchlist_data = []
-    products = Product.objects.all()
-    for product in products:
-        watchlist_reference = product.watchlist_set.filter(userID=userID).values()
-        if len(watchlist_reference) == 1:
-            watchlist_data.append([list(Product.objects.filter(prodID=watchlist_reference[0]['prodID_id']).values())[0], watchlist_reference[0]])
+    # Return the user's watchlist, joining each reference to its product in the same query.
+    watchlist_references = userWatchlist(userID)
+    watchlist_data = [watchlistEntry(reference) for reference in watchlist_references]
 
     return JsonResponse(watchlist_data, safe=False)
 
+@conditionalResponse(PRODUCTS_SCOPE, WATCHLISTS_SCOPE, POPULARITY_SCOPE)
+def get_paginated_watchlist_products(request, jwt, page):
+    """ Returns one page of the products that were starred by the user. """
 
+    # Get the user ID using the email.
+    email = decodeToken(jwt)['email']
+    userID = userIDForEmail(email)
+    if userID is None:
+        return JsonResponse({}, safe=False)
 
+    # Page size can be chosen with ?limit=, within sensible bounds.
+    try:
+        limit = min(max(int(request.GET.get("limit", WATCHLIST_PAGE_SIZE)), 1), WATCHLIST_MAX_PAGE_SIZE)
+    except ValueError:
+        limit = WATCHLIST_PAGE_SIZE
 
+    paginator = Paginator(userWatchlist(userID), limit)
+    watchlist_page = paginator.get_page(page)
 
+    return JsonResponse({
+        "count": paginator.count,
+        "page": watchlist_page.number,
+        "numPages": paginator.num_pages,
+        "results": [watchlistEntry(reference) for reference in watchlist_page],
+    }, safe=False)
 
 
 
-def process_watchlist_change(request, jwt):
-    """ Adds or removes products from the user's watchlist. """
-
-    decoded_data = decode(jwt, os.environ['JWT_SECRET'], algorithms=['HS256'])
-    email = decoded_data['email']
-
-    # Get the user ID using the email.
-    customers = Customer.objects.filter(email=email).values()
-    if len(customers) == 0:
-        return JsonResponse({}, safe=False)
-    userID = customers[0]['userID']
 
-    prodID = decoded_data['prodID']
-    process = decoded_data['process']
 
-    # Process watchlist changes by adding or removing a product from the watchlist.
-    if process == "add":
-        watchlist_referenceID = str(uuid4())
 
-        if len(Product.objects.filter(prodID=prodID)) != 1:
-            return JsonResponse({}, safe=False)
 
-        Watchlist(watchlist_referenceID=watchlist_referenceID, prodID=Product.objects.get(prodID=prodID), userID=Customer.objects.get(userID=userID)).save()
-    elif process == "remove":
-        Watchlist.objects.filter(prodID=prodID, userID=userID).delete()
 
-    return JsonResponse(["Done"], safe=False)
+def process_watchlist_change(request, jwt):
+    """ Adds or removes products from the user's watchlist, either one product or a batch of operations. """
 
+    decoded_data = decodeToken(jwt)
+    email = decoded_data['email']
 
+    # Get the user ID using the email.
+    userID = userIDForEmail(email)
+    if userID is None:
+        return JsonResponse({}, safe=False)
 
+    try:
+        operations = parseOperations(decoded_data)
+    except InvalidWatchlistOperations as error:
+        return JsonResponse({"error": str(error)}, status=400)
 
+    results = applyWatchlistOperations(userID, operations)
+    return watchlistChangeResponse(decoded_data, results)
 
 
+def cache_stats(request):
+    """ Returns the response cache's size and hit/miss/eviction counters, and how many requests were coalesced, for this worker. """
+    return JsonResponse(dict(responseCache.stats(), coalescing=singleFlight.stats()))
 
+def metrics(request):
+    """ Returns the per-route request metrics of every worker in the Prometheus text format. """
+    return HttpResponse(metricsStore().export(), content_type=PROMETHEUS_CONTENT_TYPE)
 
 def home(request):
     return HttpResponseRedirect("api/products/asc/prodID")
@@ -223,12 +376,76 @@ def removeEmptyFilter(request, sortType, field):
 
 """ Not part of URLs are the functions below. """
 
+def batchIDs(ids):
+    """ The product IDs of a batch request, in order. Empty entries, e.g. from a trailing comma, are ignored. """
+    return [id.strip() for id in ids.split(",") if id.strip()]
+
 def validateFieldEntered(field, model):
-    availableFields = [field.name for field in model._meta.get_fields()]
-    if field in availableFields:
+    if field in modelFieldNames(model):
         return True
     return False
 
+@lru_cache(maxsize=None)
+def modelFieldNames(model):
+    """ The names of a model's fields. Model metadata doesn't change at runtime, so it's only walked once. """
+    return frozenset(field.name for field in model._meta.get_fields())
+
+def paginatedProductsResponse(request, products, field, sortType):
+    """ Return one keyset-paginated page of listed products with its next/prev cursors. """
+
+    # Pages are keyed on the sort field's value, so it has to be an actual column.
+    if field not in [modelField.name for modelField in Product._meta.concrete_fields]:
+        return JsonResponse({"error": "Listings can only be paginated on product columns."}, status=400)
+
+    selection = fieldSelection(request, fastListedProductsSerializer)
+    if selection is None:
+        return invalidFieldsResponse(fastListedProductsSerializer)
+    if "fields" in request.GET:
+        # The sort field is loaded too, as the cursors are built from it.
+        products = products.only(*selection.sources, field)
+
+    try:
+        limit = parseLimit(request.GET.get("limit"))
+        page, nextCursor, prevCursor = keysetPage(products, field, sortType, limit, request.GET.get("cursor"))
+    except InvalidPageRequest as error:
+        return JsonResponse({"error": str(error)}, status=400)
+
+    with timedSerialization():
+        serializer = ListedProductsSerializer(page, many=True, fields=selection.names)
+        return JsonResponse({"results": serializer.data, "next": nextCursor, "prev": prevCursor}, safe=False)
+
+def columnarListing(field, sortType, serializer, canonical=""):
+    """ A listing's body from the in-memory columnar index when it's enabled, otherwise None. """
+    engine = columnarEngine()
+    if engine is None:
+        return None
+    return engine.listing(field, sortType, serializer, canonical)
+
+def fieldSelection(request, serializer):
+    """ Narrow a fast serializer to the fields named in ?fields=. Returns None if one isn't a field it returns. """
+
+    if "fields" not in request.GET:
+        return serializer
+
+    names = [name.strip() for name in request.GET["fields"].split(",")]
+    if not all(validateFieldEntered(name, serializer.model) and name in serializer.names for name in names):
+        return None
+    return serializer.project(names)
+
+def invalidFieldsResponse(serializer):
+    return JsonResponse({"error": "fields must be a comma separated list of: " + ", ".join(serializer.names) + "."}, status=400)
+
+def userWatchlist(userID):
+    """ The user's watchlist references with their products fetched through a single join. """
+    return Watchlist.objects.filter(userID=userID).select_related("prodID").order_by("prodID")
+
+def watchlistEntry(reference):
+    """ Build the [product, watchlist reference] pair returned by the watchlist endpoints. """
+    product = reference.prodID
+    productData = {field.attname: getattr(product, field.attname) for field in Product._meta.concrete_fields}
+    referenceData = {field.attname: getattr(reference, field.attname) for field in Watchlist._meta.concrete_fields}
+    return [productData, referenceData]
+
 def validateSortType(sortType):
     if sortType == "asc" or sortType == "desc":
         return True
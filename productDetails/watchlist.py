@@ -0,0 +1,133 @@
+""" Batched watchlist mutations.
+
+A watchlist change token can carry a list of `{"prodID": ..., "process": "add" | "remove"}` operations. They're
+applied in one transaction with a fixed number of queries however many there are: one IN query for the products
+being added, one for the rows already on the watchlist, one bulk insert and one delete. Adding a product that's
+already on the watchlist or removing one that isn't does nothing, so replaying a batch is safe.
+
+Each product's watchCount is adjusted in the same transaction with one more UPDATE. Count changes only bump the
+popularity scope, so they don't invalidate listings that aren't sorted by watchCount. rebuildWatchCounts()
+recounts them all from the watchlist rows.
+"""
+
+from django.db import transaction
+from django.db.models import Case, Count, F, OuterRef, PositiveIntegerField, Subquery, When
+from django.db.models.functions import Coalesce
+from django.http import JsonResponse
+from uuid import uuid4
+from .models import Product, Watchlist
+from .conditional import bumpCatalogVersion, WATCHLISTS_SCOPE, POPULARITY_SCOPE
+from .invalidation import publishChange
+from .database import lockForWrite
+from .signals import invalidateWatchCounts, watchlistBatch
+
+MAX_WATCHLIST_OPERATIONS = 100
+PROCESSES = ("add", "remove")
+
+
+class InvalidWatchlistOperations(ValueError):
+    """ Raised when the operations in a watchlist change token can't be applied. """
+
+
+def parseOperations(decodedData):
+    """ Return the list of (prodID, process) pairs from a token, accepting the single prodID/process form too. """
+
+    if "operations" in decodedData:
+        operations = decodedData["operations"]
+        if not isinstance(operations, list) or len(operations) == 0:
+            raise InvalidWatchlistOperations("operations must be a non-empty list.")
+        if len(operations) > MAX_WATCHLIST_OPERATIONS:
+            raise InvalidWatchlistOperations("At most " + str(MAX_WATCHLIST_OPERATIONS) + " operations can be sent at once.")
+    else:
+        operations = [{"prodID": decodedData.get("prodID"), "process": decodedData.get("process")}]
+
+    parsed = []
+    for operation in operations:
+        if not isinstance(operation, dict) or not isinstance(operation.get("prodID"), str) or operation.get("process") not in PROCESSES:
+            raise InvalidWatchlistOperations("Each operation needs a prodID and a process of add or remove.")
+        parsed.append((operation["prodID"], operation["process"]))
+    return parsed
+
+
+def adjustWatchCounts(added, removed):
+    """ Count the products just added to a watchlist and uncount the ones just removed, in one UPDATE. """
+    Product.objects.filter(prodID__in=added + removed).update(watchCount=Case(
+        When(prodID__in=added, then=F("watchCount") + 1),
+        When(watchCount__gt=0, then=F("watchCount") - 1),
+        default=F("watchCount"),
+        output_field=PositiveIntegerField(),
+    ))
+    invalidateWatchCounts(added + removed)
+
+
+def rebuildWatchCounts():
+    """ Recount every product's watchlists in one UPDATE. Returns how many counts were wrong. """
+    with transaction.atomic():
+        lockForWrite(Watchlist)
+        counts = Watchlist.objects.filter(prodID=OuterRef("pk")).order_by().values("prodID").annotate(count=Count("*")).values("count")
+        counts = Coalesce(Subquery(counts), 0)
+        return Product.objects.exclude(watchCount=counts).update(watchCount=counts)
+
+
+def applyWatchlistOperations(userID, operations):
+    """ Apply (prodID, process) operations to a user's watchlist in one transaction.
+
+    When a product appears more than once, its last operation wins. Returns one result per operation, in order,
+    with a result of "added", "removed", "unchanged", "notFound" or "superseded".
+    """
+
+    finalProcess = {}
+    for prodID, process in operations:
+        finalProcess[prodID] = process
+    addIDs = [prodID for prodID, process in finalProcess.items() if process == "add"]
+    removeIDs = [prodID for prodID, process in finalProcess.items() if process == "remove"]
+
+    with transaction.atomic():
+        lockForWrite(Watchlist)
+        existingProducts = set(Product.objects.filter(prodID__in=addIDs).values_list("prodID", flat=True)) if addIDs else set()
+        onWatchlist = set(Watchlist.objects.filter(userID=userID, prodID__in=list(finalProcess)).values_list("prodID", flat=True))
+
+        toAdd = [prodID for prodID in addIDs if prodID in existingProducts and prodID not in onWatchlist]
+        toRemove = [prodID for prodID in removeIDs if prodID in onWatchlist]
+
+        if toAdd:
+            Watchlist.objects.bulk_create([
+                Watchlist(watchlist_referenceID=str(uuid4()), userID_id=userID, prodID_id=prodID) for prodID in toAdd
+            ], ignore_conflicts=True)
+        if toRemove:
+            # The post_delete receivers would bump the versions and counts once per row, so they're skipped here.
+            with watchlistBatch():
+                Watchlist.objects.filter(userID=userID, prodID__in=toRemove).delete()
+
+        # bulk_create() doesn't send signals either, so the versions and counts are updated once here.
+        if toAdd or toRemove:
+            bumpCatalogVersion(WATCHLISTS_SCOPE, POPULARITY_SCOPE)
+            publishChange(Watchlist)
+            adjustWatchCounts(toAdd, toRemove)
+
+    outcome = {}
+    for prodID in toAdd:
+        outcome[prodID] = "added"
+    for prodID in toRemove:
+        outcome[prodID] = "removed"
+    for prodID in addIDs:
+        if prodID not in existingProducts:
+            outcome[prodID] = "notFound"
+
+    # Earlier operations on a product that was changed again later in the batch are reported as superseded.
+    lastIndex = {prodID: index for index, (prodID, process) in enumerate(operations)}
+    results = []
+    for index, (prodID, process) in enumerate(operations):
+        result = outcome.get(prodID, "unchanged") if index == lastIndex[prodID] else "superseded"
+        results.append({"prodID": prodID, "process": process, "result": result})
+    return results
+
+
+def watchlistChangeResponse(decodedData, results):
+    """ The per-operation results for a batch, or the original ["Done"] / {} reply for a single-operation token. """
+
+    if "operations" in decodedData:
+        return JsonResponse({"results": results})
+    if results[0]["result"] == "notFound":
+        return JsonResponse({}, safe=False)
+    return JsonResponse(["Done"], safe=False)